@@ -0,0 +1,45 @@
+"""Compare two benchmark result files written by `pytest benchmarks`.
+
+Usage:
+
+    python -m benchmarks.compare before.json after.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+
+COLUMNS = ['p50_ms', 'p90_ms', 'p99_ms', 'ops_per_call', 'mongo_ms_per_call']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before['dataset'] != after['dataset']:
+        print("Warning: datasets differ: {} vs {}".format(
+            before['dataset'], after['dataset']))
+    print("{} -> {}".format(before['revision'], after['revision']))
+    print("{:40}".format('benchmark') +
+          ''.join('{:>22}'.format(c) for c in COLUMNS))
+    for name in sorted(set(before['results']) | set(after['results'])):
+        b = before['results'].get(name)
+        a = after['results'].get(name)
+        cells = []
+        for c in COLUMNS:
+            if a is None or b is None:
+                cells.append('-')
+                continue
+            ratio = a[c] / b[c] if b[c] else float('nan')
+            cells.append('{:.1f}->{:.1f} x{:.2f}'.format(b[c], a[c], ratio))
+        print("{:40}".format(name) + ''.join('{:>22}'.format(c)
+                                             for c in cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Fixtures for the endpoint benchmarks.
+
+The benchmarks run against a synthetic dataset (see
+`propjockey.synthetic`) in the in-process backend by default, or in the
+`propjockey_bench` database of a local mongod with
+`--bench-backend mongo`. `PROPJOCKEY_TEST_BACKEND` defaults to
+`memory`, so that, with `USE_TEST_CLIENTS`, the login token store, the
+invalidation bus and rate limits of the app are in process too. Each
+benchmark records latency percentiles and, with the app's query
+recorder, the number and duration of database commands per call, which
+are written to the `--bench-json` file at the end of the session, e.g.
+
+    export PROPJOCKEY_SETTINGS=$(pwd)/local_settings.py
+    python -m pytest benchmarks --bench-scale small --bench-json before.json
+    ...
+    python -m pytest benchmarks --bench-scale small --bench-json after.json
+    python -m benchmarks.compare before.json after.json
+"""
+from __future__ import division
+
+from contextlib import contextmanager
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+from propjockey.settings import TEST_BACKEND_ENVVAR
+
+# Before the app is imported, which opens the token store.
+os.environ.setdefault(TEST_BACKEND_ENVVAR, 'memory')
+
+from propjockey import memstore, propjockey  # noqa: E402
+from propjockey.synthetic import generate
+
+# (entries, entries with votes, users)
+SCALES = {
+    'small': (10000, 1000, 500),
+    'medium': (50000, 3000, 1000),
+    'full': (150000, 5000, 2000),
+}
+BENCH_DATABASE = 'propjockey_bench'
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('propjockey benchmarks')
+    group.addoption('--bench-scale', choices=sorted(SCALES), default='small')
+    group.addoption('--bench-backend', choices=['memory', 'mongo'],
+                    default='memory')
+    group.addoption('--bench-repeat', type=int, default=20,
+                    help='Timed calls per benchmark, after one warm-up.')
+    group.addoption('--bench-json', default='bench_results.json',
+                    help='Write results to this file.')
+    group.addoption('--bench-latency-ms', type=float, default=0,
+                    help='Simulated round-trip time of memory backend '
+                         'commands.')
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    k = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[k]
+
+
+class Recorder(object):
+    def __init__(self, query_recorder, repeat):
+        self.query_recorder = query_recorder
+        self.repeat = repeat
+        self.results = {}
+
+    @contextmanager
+    def measure(self, name):
+        """Time the body and record its commands as one call of `name`."""
+        with self.query_recorder.recording(name) as rec:
+            start = time.time()
+            yield
+            seconds = time.time() - start
+        calls = self.results.setdefault(
+            name, {'seconds': [], 'ops': [], 'mongo_ms': []})
+        calls['seconds'].append(seconds)
+        calls['ops'].append(len(rec.commands))
+        calls['mongo_ms'].append(rec.summary()['mongo_ms'])
+
+    def run(self, name, fn, repeat=None, setup=None):
+        """Call `fn` once untimed, then `repeat` times under `name`."""
+        repeat = self.repeat if repeat is None else repeat
+        for i in range(repeat + 1):
+            if setup:
+                setup()
+            if i == 0:
+                fn()
+                continue
+            with self.measure(name):
+                fn()
+
+    def summary(self):
+        summary = {}
+        for name, calls in sorted(self.results.items()):
+            seconds = sorted(calls['seconds'])
+            summary[name] = {
+                'calls': len(seconds),
+                'mean_ms': 1e3 * sum(seconds) / len(seconds),
+                'p50_ms': 1e3 * percentile(seconds, 50),
+                'p90_ms': 1e3 * percentile(seconds, 90),
+                'p99_ms': 1e3 * percentile(seconds, 99),
+                'ops_per_call': sum(calls['ops']) / len(calls['ops']),
+                'mongo_ms_per_call': (sum(calls['mongo_ms']) /
+                                      len(calls['mongo_ms'])),
+            }
+        return summary
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@pytest.fixture(scope='session')
+def dataset(request):
+    """Configure the app for a generated dataset. Return its parameters."""
+    option = request.config.getoption
+    scale = option('--bench-scale')
+    n_entries, n_voted, n_users = SCALES[scale]
+    clients = {k: {'database': BENCH_DATABASE, 'collection': k}
+               for k in ['votes', 'entries', 'workflows']}
+    if option('--bench-backend') == 'memory':
+        for cfg in clients.values():
+            cfg['backend'] = 'memory'
+    config = propjockey.app.config
+    config['CLIENTS'] = clients
+    config['TESTING'] = True
+
+    def get_workflow_ids(eids, coll):
+        wids = {d['eid']: d['wid'] for d in coll.find({'eid': {'$in': eids}})}
+        return [wids.get(eid) for eid in eids]
+    config['WORKFLOWS']['get_workflow_ids'] = get_workflow_ids
+    config['VOTES']['max_active_votes_per_user'] = n_voted
+    config['NOTIFY'].update({'MAILER': 'null', 'throttle_seconds': 0})
+
+    db = propjockey.connect_collections()
+    stats = generate(db, propjockey.econf, propjockey.vconf,
+                     n_entries=n_entries, n_voted=n_voted, n_users=n_users)
+    for s in stats:
+        print(s)
+    propjockey.entry_cache.invalidate()
+    memstore.set_latency(option('--bench-latency-ms') / 1e3)
+    return {'scale': scale, 'backend': option('--bench-backend'),
+            'entries': n_entries, 'voted': n_voted, 'users': n_users,
+            'latency_ms': option('--bench-latency-ms')}
+
+
+@pytest.fixture(scope='session')
+def bench(request, dataset):
+    recorder = Recorder(propjockey.query_recorder,
+                        request.config.getoption('--bench-repeat'))
+    yield recorder
+    output = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'dataset': dataset,
+        'results': recorder.summary(),
+    }
+    with open(request.config.getoption('--bench-json'), 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+
+@pytest.fixture
+def db(dataset):
+    return propjockey.connect_collections()
+
+
+@pytest.fixture
+def user():
+    """A requester with votes in the generated dataset."""
+    return 'user0@example.gov'
+
+
+@pytest.fixture
+def client(dataset, user):
+    client = propjockey.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user'] = user
+    return client
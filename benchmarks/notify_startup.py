@@ -0,0 +1,56 @@
+"""Benchmark startup of notify: standalone against through the web app.
+
+Each way of starting is run in fresh interpreters, which report their
+peak RSS once ready to notify. Before `propjockey-notify`, notify
+imported the web app, and so Flask, Passwordless (with its token store)
+and everything the app sets up at import.
+
+Usage:
+
+    export PROPJOCKEY_SETTINGS=$(pwd)/local_settings.py
+    python -m benchmarks.notify_startup [-n 10]
+"""
+from __future__ import division, print_function
+
+import argparse
+import subprocess
+import sys
+import time
+
+REPORT = ("import resource, sys\n"
+          "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,"
+          " len(sys.modules))\n")
+
+STARTUPS = [
+    ('via web app', "from propjockey.propjockey import app\n"
+                    "config = app.config\n"),
+    ('propjockey-notify', "from propjockey.notify import notify\n"
+                          "from propjockey.settings import load_config\n"
+                          "config = load_config()\n"),
+]
+
+
+def run(code):
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', code + REPORT])
+    seconds = time.time() - start
+    maxrss_kb, nmodules = map(int, out.split()[-2:])
+    return seconds, maxrss_kb, nmodules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=10,
+                        help='interpreters started per way')
+    args = parser.parse_args()
+    print("{:18s} {:>10s} {:>10s} {:>8s}".format(
+        'startup', 'median ms', 'RSS MiB', 'modules'))
+    for name, code in STARTUPS:
+        runs = sorted(run(code) for _ in range(args.n))
+        seconds, maxrss_kb, nmodules = runs[len(runs) // 2]
+        print("{:18s} {:10.0f} {:10.1f} {:8d}".format(
+            name, 1e3 * seconds, maxrss_kb / 1024, nmodules))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Benchmark ranking of active rows: dicts against NumPy arrays.
+
+For each number of entries with active votes, time a page of rows as
+/rows computes it from leaderboard snapshot records: building votedocs,
+filtering them by a set of matching ids and sorting with two stable
+sorts, against `ActiveRanking.select` and `ActiveRanking.page`. Both
+then build dicts for the page only.
+
+Usage:
+
+    export PROPJOCKEY_SETTINGS=$(pwd)/local_settings.py
+    python -m benchmarks.ranking [--sizes 10000 100000 1000000]
+"""
+from __future__ import division, print_function
+
+import argparse
+from operator import itemgetter
+import random
+import time
+
+from propjockey.ranking import ActiveRanking, available
+from propjockey.synthetic import ELEMENTS, zipf
+
+FILTERS = {
+    'none': None,
+    '*-O': {'chemsys': {'$in': ['-'.join(sorted([el, 'O']))
+                                for el in ELEMENTS if el != 'O']}},
+    'Fe-O': {'chemsys': 'Fe-O'},
+}
+
+
+def make_records(rng, n):
+    records, chemsys = [], {}
+    for i in range(n):
+        e_id = 'mp-{}'.format(i)
+        records.append((e_id, zipf(rng, 2.0, 1000), rng.expovariate(20)))
+        chemsys[e_id] = '-'.join(sorted(rng.sample(
+            ELEMENTS, rng.choice([1, 2, 2, 3, 3, 4]))))
+    records.sort(key=lambda r: (-r[1], r[0]))
+    return records, chemsys
+
+
+def dict_page(records, matching, skip, limit):
+    votedocs = [{'e_id': e_id, 'nvotes': n, 'extrasort': x}
+                for e_id, n, x in records]
+    if matching is not None:
+        votedocs = [d for d in votedocs if d['e_id'] in matching]
+    votedocs.sort(key=itemgetter('extrasort'))
+    votedocs.sort(key=itemgetter('nvotes'), reverse=True)
+    return len(votedocs), votedocs[skip:skip + limit]
+
+
+def array_page(ranking, user_filter, skip, limit):
+    selected = ranking.select(user_filter)
+    count, indexes = ranking.page(True, False, skip, limit, selected)
+    return count, [{'e_id': ranking.e_ids[i],
+                    'nvotes': int(ranking.nvotes[i]),
+                    'extrasort': float(ranking.extrasort[i])}
+                   for i in indexes]
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        rv = fn()
+        times.append(time.time() - start)
+    return min(times), rv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--pnum', type=int, default=3)
+    parser.add_argument('--psize', type=int, default=10)
+    args = parser.parse_args()
+    if not available:
+        parser.error("NumPy is not installed")
+
+    rng = random.Random(0)
+    skip, limit = args.pnum * args.psize, args.psize + 1
+    print("{:>9s} {:6s} {:>10s} {:>10s} {:>8s}".format(
+        'entries', 'filter', 'dicts ms', 'arrays ms', 'speedup'))
+    for n in args.sizes:
+        records, chemsys = make_records(rng, n)
+        start = time.time()
+        ranking = ActiveRanking.from_records(records, chemsys)
+        build = time.time() - start
+        for name, user_filter in sorted(FILTERS.items()):
+            matching = None
+            if user_filter is not None:
+                targets = user_filter['chemsys']
+                targets = set(targets['$in'] if isinstance(targets, dict)
+                              else [targets])
+                matching = {e_id for e_id, c in chemsys.items()
+                            if c in targets}
+            t_dicts, expected = best_of(
+                lambda: dict_page(records, matching, skip, limit),
+                args.repeat)
+            t_arrays, got = best_of(
+                lambda: array_page(ranking, user_filter, skip, limit),
+                args.repeat)
+            assert got[0] == expected[0]
+            assert [d['nvotes'] for d in got[1]] == \
+                [d['nvotes'] for d in expected[1]]
+            print("{:9d} {:6s} {:10.2f} {:10.2f} {:7.1f}x".format(
+                n, name, 1e3 * t_dicts, 1e3 * t_arrays, t_dicts / t_arrays))
+        print("{:9d} ranking built once per snapshot in {:.0f} ms".format(
+            n, 1e3 * build))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Replay recorded /rows and /vote traffic against the app.
+
+Requests recorded with the `ACCESS_LOG` setting (see
+`propjockey.accesslog`) are sent by `--concurrency` threads, through
+the WSGI test client or, with `--url`, to a running server, with
+session cookies signed by the app's secret key. Replayed votes are
+recorded, so replay against a local or test database, or pass
+`--synthetic SCALE` to serve a generated dataset (see
+`propjockey.synthetic`) from the memory backend, onto whose users and
+entries the recorded ones are mapped. `--skip-votes` leaves votes out.
+
+Requests are sent as fast as the threads allow, unless `--speed` is
+given: 1 keeps their recorded spacing, e.g. to see a voting burst,
+and 10 compresses it tenfold.
+
+Usage:
+
+    export PROPJOCKEY_SETTINGS=$(pwd)/local_settings.py
+    python -m benchmarks.replay access.jsonl --synthetic small -c 8
+    python -m benchmarks.replay access.jsonl --url http://localhost:4000
+
+`--json` writes results that `benchmarks.compare` can compare. Mongo
+operations per request are only known through the test client.
+"""
+from __future__ import division, print_function
+
+import argparse
+from collections import defaultdict
+import hashlib
+import json
+from operator import itemgetter
+import queue
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from propjockey import accesslog, propjockey
+from propjockey.synthetic import generate
+
+from .conftest import BENCH_DATABASE, SCALES, git_revision, percentile
+
+
+def load(path, skip_votes=False, limit=None):
+    """Return recorded requests, in the order they arrived."""
+    requests = sorted((r for r in accesslog.read(path)
+                       if not (skip_votes and r['ep'] == 'vote')),
+                      key=itemgetter('t'))
+    return requests[:limit] if limit else requests
+
+
+def request_args(rec):
+    """Return the method, path and form data of a recorded request."""
+    if rec['ep'] == 'rows':
+        return 'GET', '/rows?' + urlencode(rec['p'], doseq=True), None
+    return 'POST', '/vote', rec['p']
+
+
+def _pick(name, choices):
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return choices[int(digest, 16) % len(choices)]
+
+
+def use_synthetic(scale):
+    """Serve a generated dataset from the memory backend. Return a
+    function mapping recorded requests onto its users and entries."""
+    n_entries, n_voted, n_users = SCALES[scale]
+    config = propjockey.app.config
+    config['CLIENTS'] = {k: {'database': BENCH_DATABASE, 'collection': k,
+                             'backend': 'memory'}
+                         for k in ['votes', 'entries', 'workflows']}
+
+    def get_workflow_ids(eids, coll):
+        wids = {d['eid']: d['wid'] for d in coll.find({'eid': {'$in': eids}})}
+        return [wids.get(eid) for eid in eids]
+    config['WORKFLOWS']['get_workflow_ids'] = get_workflow_ids
+    config['VOTES']['max_active_votes_per_user'] = n_voted
+    db = propjockey.connect_collections()
+    generate(db, propjockey.econf, propjockey.vconf, n_entries=n_entries,
+             n_voted=n_voted, n_users=n_users)
+    propjockey.entry_cache.invalidate()
+    users = ['user{}@example.gov'.format(i) for i in range(n_users)]
+    e_id = propjockey.econf['e_id']
+    eids = sorted(d[e_id] for d in db.entries.find({}, {e_id: 1, '_id': 0}))
+
+    def remap(rec):
+        rec = dict(rec, p=dict(rec['p']))
+        if rec['u']:
+            rec['u'] = _pick(rec['u'], users)
+        if 'eid' in rec['p']:
+            rec['p']['eid'] = _pick(rec['p']['eid'], eids)
+        return rec
+    return remap
+
+
+class WsgiTarget(object):
+    """Send requests through the test client, counting Mongo commands."""
+
+    def __init__(self, app, query_recorder):
+        self.app = app
+        self.query_recorder = query_recorder
+        self._local = threading.local()
+
+    def _client(self, user):
+        if not hasattr(self._local, 'clients'):
+            self._local.clients = {}
+        if user not in self._local.clients:
+            client = self.app.test_client()
+            if user:
+                with client.session_transaction() as sess:
+                    sess['user'] = user
+            self._local.clients[user] = client
+        return self._local.clients[user]
+
+    def send(self, user, method, path, data):
+        client = self._client(user)
+        with self.query_recorder.recording('replay') as rec:
+            rv = client.open(path, method=method, data=data)
+            rv.get_data()
+            rv.close()
+        summary = rec.summary()
+        return rv.status_code, summary['ncommands'], summary['mongo_ms']
+
+
+class HttpTarget(object):
+    """Send requests to a running server."""
+
+    def __init__(self, url, app):
+        self.url = url.rstrip('/')
+        self.cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+        self.serializer = app.session_interface.get_signing_serializer(app)
+
+    def send(self, user, method, path, data):
+        headers = {}
+        if user:
+            headers['Cookie'] = '{}={}'.format(
+                self.cookie_name, self.serializer.dumps({'user': user}))
+        body = urlencode(data).encode('utf-8') if data else None
+        request = Request(self.url + path, data=body, headers=headers,
+                          method=method)
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status, None, None
+        except HTTPError as e:
+            return e.code, None, None
+
+
+def replay(requests, send, concurrency, speed=0):
+    """Send `requests` from `concurrency` threads. Return the results,
+    (endpoint, seconds, status, ops, mongo_ms) per request, and the
+    seconds taken."""
+    pending = queue.Queue(maxsize=2 * concurrency)
+    results = []
+
+    def work():
+        while True:
+            rec = pending.get()
+            if rec is None:
+                return
+            method, path, data = request_args(rec)
+            start = time.time()
+            try:
+                status, ops, mongo_ms = send(rec['u'], method, path, data)
+            except Exception:
+                status, ops, mongo_ms = None, None, None
+            results.append((rec['ep'], time.time() - start, status, ops,
+                            mongo_ms))
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    start = time.time()
+    first = requests[0]['t'] if requests else 0
+    for rec in requests:
+        if speed:
+            delay = start + (rec['t'] - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        pending.put(rec)
+    for _ in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+
+def summarize(requests, results, seconds):
+    """Return a summary per endpoint, as `pytest benchmarks` writes."""
+    recorded = defaultdict(list)
+    for rec in requests:
+        recorded[rec['ep']].append(rec['ms'])
+    by_endpoint = defaultdict(list)
+    for r in results:
+        by_endpoint[r[0]].append(r)
+    summary = {}
+    for endpoint, rs in sorted(by_endpoint.items()):
+        times = sorted(r[1] for r in rs)
+        ops = [r[3] for r in rs if r[3] is not None]
+        mongo_ms = [r[4] for r in rs if r[4] is not None]
+        summary['replay_' + endpoint] = {
+            'calls': len(rs),
+            'per_second': len(rs) / seconds,
+            'errors': sum(1 for r in rs if r[2] is None or r[2] >= 400),
+            'p50_ms': 1e3 * percentile(times, 50),
+            'p90_ms': 1e3 * percentile(times, 90),
+            'p95_ms': 1e3 * percentile(times, 95),
+            'p99_ms': 1e3 * percentile(times, 99),
+            'ops_per_call': sum(ops) / len(ops) if ops else 0,
+            'mongo_ms_per_call': (sum(mongo_ms) / len(mongo_ms)
+                                  if mongo_ms else 0),
+            'recorded_p50_ms': percentile(sorted(recorded[endpoint]), 50),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('log', help='access log written with ACCESS_LOG')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay at this multiple of the recorded rate '
+                             '(default: as fast as possible)')
+    parser.add_argument('--url', help='server to replay against, instead '
+                                      'of the test client')
+    parser.add_argument('--synthetic', choices=sorted(SCALES),
+                        help='serve a generated dataset of this scale')
+    parser.add_argument('--skip-votes', action='store_true')
+    parser.add_argument('--limit', type=int, help='replay the first LIMIT')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    requests = load(args.log, args.skip_votes, args.limit)
+    if args.synthetic:
+        if args.url:
+            parser.error("--synthetic serves data to the test client only")
+        requests = list(map(use_synthetic(args.synthetic), requests))
+    app = propjockey.app
+    app.config['TESTING'] = True
+    target = (HttpTarget(args.url, app) if args.url
+              else WsgiTarget(app, propjockey.query_recorder))
+    results, seconds = replay(requests, target.send, args.concurrency,
+                              args.speed)
+    summary = summarize(requests, results, seconds)
+
+    print("{} requests in {:.1f} s, {:.1f}/s, concurrency {}".format(
+        len(results), seconds, len(results) / seconds, args.concurrency))
+    columns = ['calls', 'per_second', 'errors', 'p50_ms', 'p95_ms',
+               'p99_ms', 'ops_per_call', 'recorded_p50_ms']
+    print("{:14}".format('endpoint') +
+          ''.join('{:>16}'.format(c) for c in columns))
+    for name, row in sorted(summary.items()):
+        print("{:14}".format(name) +
+              ''.join('{:>16.1f}'.format(row[c]) for c in columns))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'dataset': {'log': args.log, 'synthetic': args.synthetic,
+                            'url': args.url, 'concurrency': args.concurrency,
+                            'speed': args.speed},
+                'results': summary,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
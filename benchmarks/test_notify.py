@@ -0,0 +1,30 @@
+"""Duration of a full notify run."""
+from propjockey import propjockey
+from propjockey.mailers import MAILERS, NullMailer
+from propjockey.notify import notify
+
+
+class Delivered(dict):
+    status_code = 200
+
+
+class DeliveringNullMailer(NullMailer):
+    """Reports every message as delivered, so notify records it."""
+
+    def send(self, message):
+        return Delivered(super(DeliveringNullMailer, self).send(message))
+
+
+def test_notify(bench, db, monkeypatch):
+    vconf = propjockey.vconf
+    monkeypatch.setitem(MAILERS, 'delivering_null', DeliveringNullMailer)
+    monkeypatch.setitem(propjockey.app.config['NOTIFY'], 'MAILER',
+                        'delivering_null')
+
+    def reset():
+        db.votes.update_many(vconf['filter_completed'], {
+            '$set': {vconf['requesters_notified']: False}})
+
+    bench.run('notify', lambda: notify(propjockey.app.config), repeat=3,
+              setup=reset)
+    reset()
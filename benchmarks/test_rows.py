@@ -0,0 +1,100 @@
+"""Latency of the /rows endpoint."""
+import time
+
+import pytest
+
+
+def get_rows(client, **params):
+    def fn():
+        rv = client.get('/rows', query_string=params)
+        assert rv.status_code == 200
+    return fn
+
+
+@pytest.mark.parametrize('fmt', ['json', 'html'])
+def test_first_page(bench, client, fmt):
+    bench.run('rows_first_page_' + fmt, get_rows(client, format=fmt))
+
+
+def test_large_html_page(bench, client):
+    bench.run('rows_html_psize_500',
+              get_rows(client, format='html', psize=500))
+
+
+@pytest.mark.parametrize('pnum', [5, 50])
+def test_deep_page(bench, client, pnum):
+    bench.run('rows_page_{}'.format(pnum),
+              get_rows(client, format='json', pnum=pnum))
+
+
+@pytest.mark.parametrize('filt', ['Fe-O', '*-O', 'Li-*-O'])
+def test_filtered(bench, client, filt):
+    bench.run('rows_filter_' + filt,
+              get_rows(client, format='json', filter=filt))
+
+
+def test_filtered_inactive_page(bench, client):
+    bench.run('rows_filter_*-O_inactive_page_20',
+              get_rows(client, format='json', filter='*-O', pnum=20,
+                       which=['inactive_missing', 'inactive_has']))
+
+
+def test_useronly(bench, client):
+    bench.run('rows_useronly',
+              get_rows(client, format='json', useronly='true'))
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_forward_paging(bench, client, monkeypatch, prefetch):
+    """Page forward through a filter, pausing briefly between pages."""
+    from propjockey import propjockey
+    from propjockey.prefetch import Prefetcher
+    prefetcher = Prefetcher(propjockey.vote_version) if prefetch else None
+    monkeypatch.setattr(propjockey, 'prefetcher', prefetcher)
+    name = 'rows_forward_paging' + ('_prefetch' if prefetch else '')
+    for pnum in range(bench.repeat):
+        with bench.measure(name):
+            get_rows(client, format='json', filter='*-O', pnum=pnum)()
+        time.sleep(0.1)
+    if prefetcher:
+        prefetcher.shutdown()
+
+
+@pytest.mark.parametrize('path', [
+    dict(filter='*-O', pnum=3), dict(useronly='true', filter='*-O')])
+@pytest.mark.parametrize('workers', [0, 4])
+def test_parallel_queries(bench, client, monkeypatch, path, workers):
+    """/rows with and without overlapping independent queries.
+
+    Run with e.g. --bench-latency-ms 2 to see the effect of overlapping
+    round trips with the memory backend.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from propjockey import propjockey
+    monkeypatch.setattr(propjockey, 'parallel_pool',
+                        ThreadPoolExecutor(workers) if workers else None)
+    name = 'rows_{}_workers_{}'.format(
+        '_'.join('{}_{}'.format(k, v) for k, v in sorted(path.items())),
+        workers)
+    bench.run(name, get_rows(client, format='json', **path))
+
+
+@pytest.mark.parametrize('snapshot', [False, True])
+@pytest.mark.parametrize('pnum', [0, 50])
+def test_leaderboard_snapshot(bench, client, db, monkeypatch, tmpdir,
+                              snapshot, pnum):
+    """Active rows ranked from votes, or from the mapped snapshot."""
+    from propjockey import propjockey
+    from propjockey.leaderboard import Leaderboard, build_rows, publish
+    leaderboard = None
+    if snapshot:
+        path = str(tmpdir.join('leaderboard'))
+        publish(path, build_rows(db.votes, db.entries, propjockey.econf,
+                                 propjockey.vconf))
+        leaderboard = Leaderboard(path)
+        monkeypatch.setitem(propjockey.app.config, 'LEADERBOARD',
+                            {'path': path, 'max_age': 3600})
+    monkeypatch.setattr(propjockey, 'leaderboard', leaderboard)
+    monkeypatch.setitem(propjockey._local_votes, 'time', 0)
+    name = 'rows_page_{}{}'.format(pnum, '_snapshot' if snapshot else '')
+    bench.run(name, get_rows(client, format='json', pnum=pnum))
@@ -0,0 +1,34 @@
+"""Latency of voting up and down."""
+from propjockey import propjockey
+
+
+def test_vote_up_down(bench, client, db, user):
+    vconf = propjockey.vconf
+    filt = dict(vconf['filter_active'], **{vconf['requesters']: {'$ne': user}})
+    eid = db.votes.find_one(filt)[vconf['entry_id']]
+
+    def vote(how):
+        rv = client.post('/vote', data={'eid': eid, 'how': how})
+        assert rv.json[1] == 'success'
+
+    vote('up')
+    vote('down')
+    for _ in range(bench.repeat):
+        with bench.measure('vote_up'):
+            vote('up')
+        with bench.measure('vote_down'):
+            vote('down')
+
+
+def test_vote_new_entry(bench, client, db):
+    """Upvote an entry without votes, which inserts a vote document."""
+    econf, vconf = propjockey.econf, propjockey.vconf
+    voted = set(db.votes.distinct(vconf['entry_id']))
+    eids = [e[econf['e_id']] for e in db.entries.find(
+        {}, {econf['e_id']: 1}).limit(len(voted) + bench.repeat)
+        if e[econf['e_id']] not in voted][:bench.repeat]
+    for eid in eids:
+        with bench.measure('vote_up_new_entry'):
+            rv = client.post('/vote', data={'eid': eid, 'how': 'up'})
+        assert rv.json[1] == 'success'
+    db.votes.delete_many({vconf['entry_id']: {'$in': eids}})
@@ -0,0 +1,73 @@
+"""Benchmark login throughput for the passwordless token stores.
+
+A login is a token request (`store_or_update`) followed by single-use
+authentication. The atomic `pop_token` path of each store is compared
+with the generic get-then-invalidate path of `TokenStore.pop_token`.
+
+Usage:
+
+    export PROPJOCKEY_SETTINGS=$(pwd)/local_settings.py
+    python -m benchmarks.token_store [-n 2000] [--mongo-port 27017]
+
+The Mongo store is skipped if no server answers on the given port.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+import uuid
+
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
+
+import propjockey  # noqa: F401 (imported before passwordless, which uses it)
+from passwordless.token_store import (
+    TokenStore, MemoryTokenStore, MongoTokenStore)
+
+
+def run_logins(store, n, atomic=True):
+    users = ['{}@example.gov'.format(uuid.uuid4().hex) for _ in range(n)]
+    tokens = [uuid.uuid4().hex for _ in range(n)]
+    pop = store.pop_token if atomic else (
+        lambda token, user: TokenStore.pop_token(store, token, user))
+    start = time.time()
+    for token, user in zip(tokens, users):
+        store.store_or_update(token, user)
+        assert pop(token, user)
+    return n / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=2000,
+                        help='number of logins per run')
+    parser.add_argument('--mongo-host', default='localhost')
+    parser.add_argument('--mongo-port', type=int, default=27017)
+    args = parser.parse_args()
+
+    stores = [('memory', MemoryTokenStore({}))]
+    try:
+        MongoClient(args.mongo_host, args.mongo_port,
+                    serverSelectionTimeoutMS=2000).admin.command('ping')
+    except ConnectionFailure:
+        print("No MongoDB at {}:{}; skipping mongo store.".format(
+            args.mongo_host, args.mongo_port))
+    else:
+        stores.append(('mongo', MongoTokenStore({'tokenstore_client': {
+            'host': args.mongo_host,
+            'port': args.mongo_port,
+            'database': 'propjockey_test',
+            'collection': 'bench_tokenstore',
+        }})))
+
+    for name, store in stores:
+        for atomic in (False, True):
+            rate = run_logins(store, args.n, atomic=atomic)
+            print("{:8s} {:22s} {:10.0f} logins/s".format(
+                name, 'pop_token' if atomic else 'get+invalidate', rate))
+        if name == 'mongo':
+            store.collection.drop()
+
+
+if __name__ == '__main__':
+    main()
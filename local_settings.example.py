@@ -1,5 +1,11 @@
 import pymongo
-from pymatgen import MPRester
+
+
+def parse_criteria(criteria_string):
+    # Imported here, as pymatgen is slow to import and only the web app
+    # parses filters.
+    from pymatgen import MPRester
+    return MPRester.parse_criteria(criteria_string)
 
 
 def describe_entry(e, fields):
@@ -52,10 +58,14 @@ ENTRIES = {
     'prop_displayname': 'elasticity',
     'filter': {
         'placeholder': 'Fe-O',
-        'transform': MPRester.parse_criteria
+        'transform': parse_criteria
     },
     'filter_fields': ['elasticity.K_VRH', 'chemsys'],
     'rows_per_page': 10,
+    # Extra indexes for `flask ensure-indexes`, e.g. to support
+    # common user filters.
+    'indexes': [[('chemsys', pymongo.ASCENDING),
+                 ('e_above_hull', pymongo.ASCENDING)]],
 }
 
 
@@ -70,8 +80,25 @@ def get_workflow_ids(entry_ids, workflow_collection):
         idmap[entry_id] = fw['fw_id']
     return [idmap.get(e_id, None) for e_id in entry_ids]
 
+
+def iter_workflow_ids(workflow_collection, after_wid=None):
+    fireworks = workflow_collection.database.fireworks
+    fk_field = "spec.snl.about._mp_id"
+    filt = {fk_field: {"$exists": True}}
+    if after_wid is not None:
+        filt["fw_id"] = {"$gt": after_wid}
+    fws = fireworks.find(filt, {"_id": 0, "fw_id": 1, fk_field: 1},
+                         sort=[("fw_id", pymongo.ASCENDING)])
+    for fw in fws:
+        yield fw['spec']['snl']['about']['_mp_id'], fw['fw_id']
+
 WORKFLOWS = {
     'get_workflow_ids': get_workflow_ids,
+    # Optional local entry-to-workflow id index, kept next to the votes
+    # and refreshed by `flask sync-workflow-ids` (e.g. as a cron job).
+    # Ids not yet in the index are looked up with `get_workflow_ids`.
+    'index_collection': 'workflow_ids',
+    'iter_workflow_ids': iter_workflow_ids,
     'url_for': 'http://elastic.dash.materialsproject.org/wf/{w_id}',
 }
 
@@ -113,7 +140,216 @@ VOTES = {
     'requesters_notified': 'requesters_notified',
 }
 
+# Bounds for the in-process cache of entry documents, which holds only
+# the fields needed to display rows. See `propjockey.cache.LRUCache`.
+ENTRY_CACHE = {
+    'maxsize': 200000,
+    'maxbytes': 64 * 2**20,
+    'ttl': 24 * 3600,
+}
+
+# Bounds for each of the caches of entry description HTML and of
+# rendered table rows (see `row_fragment`).
+FRAGMENT_CACHE = {
+    'maxsize': 50000,
+    'ttl': 3600,
+}
+
+# Compute the next page of rows in the background after serving a
+# page, with up to `workers` threads. Pages are kept for `ttl` seconds,
+# or until the next vote.
+PREFETCH = {
+    'enabled': True,
+    'workers': 2,
+    'max_pending': 8,
+    'maxsize': 1000,
+    'ttl': 30,
+}
+
+# Keep, per filter string, the ranked ids of entries matching it, so
+# that pages of the sections without active votes are slices of a list.
+# Lists are kept for `ttl` seconds, and bounded in total by `maxbytes`.
+FILTER_CACHE = {
+    'enabled': True,
+    'maxsize': 1000,
+    'maxbytes': 128 * 2**20,
+    'ttl': 600,
+}
+
+# Workers tell each other about votes and entries gaining the property
+# through a capped collection (see `propjockey.bus`), polled at most
+# every `poll_seconds` before requests. Leave out `client` to disable.
+INVALIDATION = {
+    'client': {
+        'host': 'localhost',
+        'port': 57010,
+        'database': 'apps',
+        'collection': 'propjockey_invalidations',
+        'username': 'propjockey_readwrite',
+        'password': 'emulsify-gamester-fealty-dwarf-county',
+    },
+    'poll_seconds': 1,
+    'max_events': 10000,
+}
+
+# `/events` streams vote counts as they change (see `propjockey.events`)
+# to at most `max_subscribers` clients per worker, each reconnecting
+# after `max_seconds`. With `INVALIDATION`, changes of other workers
+# and notify are polled for every `poll_seconds` while anyone listens.
+EVENTS = {
+    'enabled': False,
+    'max_subscribers': 1000,
+    'buffer_size': 1000,
+    'heartbeat_seconds': 15,
+    'max_seconds': 600,
+    'retry_ms': 3000,
+    'poll_seconds': 1,
+}
+
+# Workers read the ranking of entries with active votes from a snapshot
+# file, mapped into memory, that `flask publish-leaderboard` rewrites
+# every `interval` seconds when votes change. Snapshots older than the
+# worker's last known vote, or than `max_age` seconds, are not used.
+# Leave out `path` to query votes on each request instead.
+LEADERBOARD = {
+    'path': '/dev/shm/propjockey-leaderboard',
+    'check_seconds': 1,
+    'interval': 5,
+    'max_age': 60,
+}
+
+# Warm up in `create_app`: connect, ensure indexes if `ensure_indexes`,
+# compile templates and fill the leaderboard, entry and filter caches
+# (the latter for each of `filters`, e.g. ['*-O']; if that fails, it is
+# only logged and reported by `/ready` as a warning). With gunicorn
+# `--preload`, set `before_fork` so the master closes its clients before
+# forking, and call `warm_worker` from `post_fork`. Without `create_app`,
+# the first request starts warm-up in the background. `/ready` answers
+# 503 until warm-up is done, and requests retry a failed one at most
+# every `retry_seconds`.
+WARMUP = {
+    'enabled': True,
+    'before_fork': True,
+    'ensure_indexes': False,
+    'filters': [],
+    'retry_seconds': 10,
+}
+
+# Threads shared by requests to overlap independent queries, such as
+# workflow id lookups and inactive-section counts. 0 runs them in turn.
+PARALLEL = {
+    'workers': 8,
+}
+
+# Each worker serves at most `max_concurrent` requests to an endpoint
+# at once, with up to `queue` more waiting at most `queue_seconds` for
+# a turn. Others get a 503 response with `Retry-After: retry_after`.
+ADMISSION = {
+    'retry_after': 2,
+    'endpoints': {
+        'rows': {'max_concurrent': 6, 'queue': 12, 'queue_seconds': 1},
+    },
+}
+
+# Token buckets per user (the email given at login), client address
+# (see `PROXY_FIX`) and overall, holding up to `burst` requests and
+# refilled at `per_minute`. They are kept per worker, or shared through
+# the collection of `client` if given. Leave out an endpoint or scope
+# for no limit.
+RATE_LIMITS = {
+    'client': {
+        'host': 'localhost',
+        'port': 57010,
+        'database': 'apps',
+        'collection': 'propjockey_rate_limits',
+        'username': 'propjockey_readwrite',
+        'password': 'emulsify-gamester-fealty-dwarf-county',
+    },
+    'login': {
+        'user': {'per_minute': 2, 'burst': 3},
+        'ip': {'per_minute': 10, 'burst': 10},
+        'global': {'per_minute': 300, 'burst': 60},
+    },
+    'authtoken': {
+        'user': {'per_minute': 2, 'burst': 3},
+        'global': {'per_minute': 300, 'burst': 60},
+    },
+    'vote': {
+        'user': {'per_minute': 30, 'burst': 20},
+        'ip': {'per_minute': 120, 'burst': 60},
+    },
+}
+
+# Queries on votes and entries are stopped after these milliseconds.
+# If those of the sections without active votes are, /rows returns the
+# rows found so far, with `partial: true`; otherwise it answers 503.
+QUERY_TIME_LIMITS = {
+    'votes_ms': 2000,
+    'entries_ms': 3000,
+}
+
+# Queries on entries with ids in (`$in`) the ones with active votes or a
+# user's completed requests send them in chunks of `chunk_size`, and
+# merge the results. Queries on the others (`$nin`) send up to `max_nin`
+# ids as is; past that, they are excluded client-side. See
+# `propjockey.idsets`.
+ID_SETS = {
+    'chunk_size': 1000,
+    'max_nin': 5000,
+}
+
+# Log a warning at startup for hot queries that would run as a
+# collection scan. See `flask ensure-indexes`.
+CHECK_QUERY_PLANS = False
+
+# Database commands are attributed to requests (see
+# `propjockey.instrument`). A JSON summary of each request is logged at
+# INFO level to the `propjockey.queries` logger, and commands taking at
+# least `slow_ms` milliseconds are logged as warnings to
+# `propjockey.slow_queries`. `reply_bytes` measures reply sizes too.
+QUERY_LOG = {
+    'slow_ms': 100,
+    'reply_bytes': True,
+}
+
+# Append the normalized parameters and timings of a `sample` fraction
+# of /rows and /vote requests to `path`, with users aliased by
+# ALIAS_KEY, for `python -m benchmarks.replay`, e.g. to
+# '/var/log/propjockey/access.jsonl'.
+ACCESS_LOG = {
+    'path': None,
+    'sample': 1.0,
+}
+
+# Staff who may add `profile=1` to a URL to download a profile of the
+# request. Calls faster than `min_ms` are left out of the call tree.
+PROFILER = {
+    'staff': ['elastiquests-staff@example.gov'],
+    'min_ms': 0.05,
+}
+
+# The number of proxies, e.g. nginx, trusted to set each X-Forwarded-*
+# header, as arguments of werkzeug's ProxyFix. Client addresses are then
+# taken from X-Forwarded-For. Leave this out when serving directly, or
+# clients could choose their address.
+PROXY_FIX = {
+    'x_for': 1,
+}
+
+# Access to Prometheus metrics at /metrics, by bearer token or client
+# address (see `PROXY_FIX`). The count of votes awaiting notification
+# is refreshed at most every `backlog_ttl` seconds.
+METRICS = {
+    'token': 'METRICS_TOKEN',
+    'allow_ips': ['127.0.0.1'],
+    'backlog_ttl': 60,
+}
+
 USE_TEST_CLIENTS = True
+# Each client may instead use the in-process backend of
+# `propjockey.memstore`, e.g.
+# {'backend': 'memory', 'database': 'propjockey_test',
+#  'collection': 'votes', 'snapshot': 'tests/propjockey_test_example.gz'}
 CLIENTS = {
     'votes': {
         'host': 'localhost',
@@ -162,6 +398,8 @@ def user_permitted(user):
 PASSWORDLESS = {
     'LOGIN_URL': 'plain',
     'TOKEN_STORE': 'mongo',
+    # Login links expire after this many seconds.
+    'TOKEN_TTL': 600,
     'tokenstore_client': {
         'database': 'propjockey_test',
         'collection': 'tokenstore',
@@ -190,6 +428,11 @@ NOTIFY = {
                    "Data online at {url_for_prop}\n"),
     'staff_to': "elastiquests-staff@example.gov",
     'staff_subject': "Sent notifications about {} materials to {} users",
+    # Seconds to wait before each notification email.
+    'throttle_seconds': 5,
+    # Write notify metrics here after each run, for node_exporter's
+    # textfile collector.
+    # 'metrics_textfile': '/var/lib/node_exporter/propjockey_notify.prom',
 }
 
 MAILGUN = {
@@ -206,3 +449,7 @@ MAILGUN = {
 # >>> import os; os.urandom(24)
 APP_SECRET_KEY = (
     'This should be as random as possible.')
+
+# Key for hashing requester emails into stable aliases in test
+# databases. Defaults to APP_SECRET_KEY.
+ALIAS_KEY = 'This should also be as random as possible.'
@@ -18,6 +18,8 @@ class Passwordless(object):
         # Does the token expire after a single login session,
         # i.e. is it bookmark-able?
         self.single_use = config.get('SINGLE_USE', True)
+        # Seconds until an unused token expires.
+        self.token_ttl = config.get('TOKEN_TTL', 600)
 
         delivery_method = config['DELIVERY_METHOD']
         self.delivery_method = DELIVERY_METHODS[delivery_method](app.config)
@@ -29,7 +31,7 @@ class Passwordless(object):
 
     def request_token(self, user, deliver=True):
         token = uuid.uuid4().hex
-        self.token_store.store_or_update(token, user)
+        self.token_store.store_or_update(token, user, ttl=self.token_ttl)
         login_url = self.login_url.generate(token, user)
         permitted = self.user_permitted(user)
         if deliver:
@@ -40,8 +42,6 @@ class Passwordless(object):
 
     def authenticate(self, flask_request):
         token, uid = self.login_url.parse(flask_request)
-        is_authenticated = self.token_store.get_by_userid(uid) == token
-        if is_authenticated and self.single_use:
-            self.token_store.invalidate_token(uid)
-
-        return is_authenticated
+        if self.single_use:
+            return self.token_store.pop_token(token, uid)
+        return self.token_store.get_by_userid(uid) == token
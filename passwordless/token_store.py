@@ -1,6 +1,10 @@
 import abc
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+import time
 
-from propjockey.util import mongoconnect
+from propjockey.util import ProcessCollection
 
 
 class TokenStore(object):
@@ -21,42 +25,102 @@ class TokenStore(object):
     def get_by_userid(self, userid):
         return
 
+    def pop_token(self, token, userid):
+        """Invalidate `userid`'s token if it is `token`.
+
+        Return True iff the token matched. Stores should override this
+        to make the check-and-delete a single atomic operation.
+        """
+        matched = token is not None and self.get_by_userid(userid) == token
+        if matched:
+            self.invalidate_token(userid)
+        return matched
+
 
 class MemoryTokenStore(TokenStore):
-    STORE = {}
+    """Bounded, expiring token store local to the current process.
+
+    Tokens are not shared across worker processes, so use
+    `MongoTokenStore` when running more than one worker. When the store
+    is full, the least recently stored or updated token is evicted.
+    """
+    STORE = OrderedDict()
+    LOCK = threading.Lock()
+
+    def __init__(self, config):
+        self.max_tokens = config.get('MEMORY_STORE_MAX_TOKENS', 10000)
 
     def store_or_update(self, token, userid, ttl=600, origin=None):
-        self.STORE[userid] = token
+        if not token or not userid:
+            return False
+        with self.LOCK:
+            self.STORE.pop(userid, None)
+            self.STORE[userid] = (token, time.time() + ttl)
+            while len(self.STORE) > self.max_tokens:
+                self.STORE.popitem(last=False)
 
     def invalidate_token(self, userid):
-        del self.STORE[userid]
+        with self.LOCK:
+            self.STORE.pop(userid, None)
 
     def get_by_userid(self, userid):
-        return self.STORE.get(userid, None)
+        with self.LOCK:
+            return self._get_unexpired(userid)
+
+    def pop_token(self, token, userid):
+        with self.LOCK:
+            matched = (token is not None and
+                       self._get_unexpired(userid) == token)
+            if matched:
+                del self.STORE[userid]
+            return matched
+
+    def _get_unexpired(self, userid):
+        token, expires = self.STORE.get(userid, (None, None))
+        if token is not None and expires <= time.time():
+            del self.STORE[userid]
+            return None
+        return token
 
 
 class MongoTokenStore(TokenStore):
+    """Token store shared by all workers.
+
+    Each token document carries an `expires` date. A TTL index lets
+    the server purge expired documents, and reads ignore documents
+    that have expired but not yet been purged.
+    """
     def __init__(self, config):
-        ts_config = config['tokenstore_client']
-        self.client = mongoconnect(ts_config)
-        self.db = self.client[ts_config['database']]
-        self.collection = self.db[ts_config['collection']]
+        self.collection = ProcessCollection(config['tokenstore_client'])
         self.collection.create_index("userid")
+        self.collection.create_index("expires", expireAfterSeconds=0)
 
-    def store_or_update(self, token, userid, ttl=None, origin=None):
+    def store_or_update(self, token, userid, ttl=600, origin=None):
         if not token or not userid:
             return False
-        self.collection.replace_one({'userid': userid},
-                                    {'userid': userid, 'token': token},
-                                    upsert=True)
+        expires = datetime.utcnow() + timedelta(seconds=ttl)
+        self.collection.replace_one(
+            {'userid': userid},
+            {'userid': userid, 'token': token, 'expires': expires},
+            upsert=True)
 
     def invalidate_token(self, userid):
         self.collection.delete_many({'userid': userid})
 
     def get_by_userid(self, userid):
-        usertoken = self.collection.find_one({'userid': userid})
+        usertoken = self.collection.find_one(
+            {'userid': userid, 'expires': {'$gt': datetime.utcnow()}})
         return usertoken.get('token') if usertoken else None
 
+    def pop_token(self, token, userid):
+        if token is None:
+            return False
+        usertoken = self.collection.find_one_and_delete(
+            {'userid': userid, 'token': token,
+             'expires': {'$gt': datetime.utcnow()}},
+            projection={'_id': 1})
+        return usertoken is not None
+
 TOKEN_STORES = {
     'memory': MemoryTokenStore,
     'mongo': MongoTokenStore,
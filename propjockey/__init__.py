@@ -1,3 +1,11 @@
 from __future__ import absolute_import
 
-from .propjockey import app
+
+def __getattr__(name):
+    # The web app is imported on first use, so that tools such as
+    # `propjockey.notify` need not import Flask.
+    if name in ('app', 'create_app'):
+        from . import propjockey
+        return getattr(propjockey, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
@@ -0,0 +1,85 @@
+"""Opt-in log of /rows and /vote traffic, for replay in load tests.
+
+`AccessRecorder` appends one JSON line per request:
+
+    {"t": 1700000000.123, "ep": "rows", "u": "<alias>", "st": 200,
+     "ms": 12.3, "ops": 4, "p": {"filter": "*-O", "pnum": 2}}
+
+`p` holds the request's parameters, normalized by `rows_params` or
+`vote_params`, leaving out those at their defaults and anything that
+does not affect the response, such as a vote's redirect path. Users
+are replaced by `requester_alias`, so a log can be replayed against a
+test database anonymized with the same key (`flask anonymize_test_db`).
+See `benchmarks/replay.py`.
+"""
+import json
+import random
+import threading
+
+from .filtercache import normalize
+from .util import requester_alias
+
+ROWS_DEFAULTS = {'psort': 'decr', 'ssort': 'incr', 'useronly': 'false',
+                 'format': 'json', 'pnum': '0'}
+ROWS_SECTIONS = ['active', 'inactive_missing', 'inactive_has']
+
+
+def rows_params(args, default_psize=None):
+    """Normalized parameters of /rows, from its query `args`."""
+    params = {k: args[k] for k in ROWS_DEFAULTS
+              if k in args and args[k] != ROWS_DEFAULTS[k]}
+    if normalize(args.get('filter')):
+        params['filter'] = normalize(args.get('filter'))
+    which = sorted(set(args.getlist('which')))
+    if which and which != sorted(ROWS_SECTIONS):
+        params['which'] = which
+    if 'psize' in args and args['psize'] != str(default_psize):
+        params['psize'] = args['psize']
+    return params
+
+
+def vote_params(form):
+    """Normalized parameters of /vote, from its `form`."""
+    return {k: form[k] for k in ('eid', 'how') if k in form}
+
+
+class AccessRecorder(object):
+    """Append requests to `path`, a `sample` fraction of them, with
+    users aliased by `key`."""
+
+    def __init__(self, path, key, sample=1.0):
+        self.path = path
+        self.key = key
+        self.sample = sample
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, t, endpoint, user, params, status, seconds, ops):
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        line = json.dumps({
+            't': round(t, 3),
+            'ep': endpoint,
+            'u': requester_alias(user, self.key) if user else None,
+            'st': status,
+            'ms': round(1e3 * seconds, 2),
+            'ops': ops,
+            'p': params,
+        }, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read(path):
+    """Yield the recorded requests in `path`."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,49 @@
+"""Bound the number of requests an endpoint serves at once.
+
+A few expensive /rows requests (big pages, broad filters, deep pages)
+can otherwise occupy every thread of every worker. A `Limiter` admits
+up to `max_concurrent` requests at once and lets up to `queue` more
+wait at most `queue_seconds` for a slot. Others are turned away at
+once, so that the app answers 503 with Retry-After rather than letting
+requests pile up. Limits apply per worker process.
+"""
+import threading
+
+
+class Limiter(object):
+    def __init__(self, max_concurrent, queue=0, queue_seconds=0.5):
+        self.max_concurrent = max_concurrent
+        self.queue = queue
+        self.queue_seconds = queue_seconds
+        self.active = self.waiting = 0
+        self.admitted = self.rejected = self.timed_out = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a slot, waiting for one if the queue has room. Return
+        whether a slot was taken."""
+        if not self._slots.acquire(False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    return False
+                self.waiting += 1
+            try:
+                admitted = self._slots.acquire(timeout=self.queue_seconds)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not admitted:
+                with self._lock:
+                    self.timed_out += 1
+                return False
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
@@ -0,0 +1,174 @@
+"""Cache invalidation events shared by workers through MongoDB.
+
+Each worker caches entries, filter results and pages of rows, which go
+stale when a vote lands on another worker, or when `notify` finds that
+entries gained the property. `InvalidationBus` appends events to a
+capped collection, numbered by a counter document in a companion
+collection (`<name>_seq`). Workers `poll` at most every `poll_seconds`:
+usually one read of the counter by `_id`, and a query for the new
+events only when it has moved. Events are dicts with `seq`, `kind`,
+`e_ids`, `source` and `time`, and are handed to the functions added
+with `subscribe`, except for those published by the same process,
+which has already applied them.
+
+If events a worker has not seen were dropped from the capped collection,
+or one is still missing `gap_seconds` after later ones arrived (its
+publisher died between numbering and inserting it), the worker gets a
+single 'reset' event instead, upon which it should drop all its caches.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import CollectionInvalid
+
+from .util import ProcessCollection
+
+# Votes on `e_ids` changed.
+VOTES = 'votes'
+# Entries `e_ids` gained the property.
+COMPLETED = 'completed'
+# Events were lost; drop everything.
+RESET = 'reset'
+
+logger = logging.getLogger('propjockey.bus')
+
+
+class InvalidationBus(object):
+    def __init__(self, collection, poll_seconds=1.0, max_events=10000,
+                 capped_bytes=4 * 2**20, gap_seconds=10.0, host=None):
+        self.events = collection
+        self.poll_seconds = poll_seconds
+        self.max_events = max_events
+        self.capped_bytes = capped_bytes
+        self.gap_seconds = gap_seconds
+        self.host = host or socket.gethostname()
+        self.last_seq = None
+        self.last_published = 0
+        self.published = 0
+        self.received = 0
+        self.resets = 0
+        self._handlers = []
+        self._ensured = False
+        self._next_poll = 0
+        self._gap_since = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the bus of the `INVALIDATION` setting, if any."""
+        bus_config = dict(config.get('INVALIDATION') or {})
+        client = bus_config.pop('client', None)
+        if not client:
+            return None
+        return cls(ProcessCollection(client), **bus_config)
+
+    @property
+    def counter(self):
+        return self.events.database[self.events.name + '_seq']
+
+    @property
+    def source(self):
+        # The pid is read each time, as workers fork after import.
+        return '{}:{}'.format(self.host, os.getpid())
+
+    def ensure(self):
+        """Create the capped collection of events, if missing."""
+        db = self.events.database
+        if self.events.name not in db.list_collection_names():
+            try:
+                db.create_collection(self.events.name, capped=True,
+                                     size=self.capped_bytes,
+                                     max=self.max_events)
+            except CollectionInvalid:
+                pass
+        self.events.create_index([('seq', ASCENDING)])
+        self._ensured = True
+
+    def subscribe(self, fn):
+        self._handlers.append(fn)
+
+    def publish(self, kind, e_ids=()):
+        """Append an event for other workers. Return its number."""
+        if not self._ensured:
+            self.ensure()
+        seq = self.counter.find_one_and_update(
+            {'_id': 'seq'}, {'$inc': {'seq': 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)['seq']
+        self.events.insert_one({'seq': seq, 'kind': kind,
+                                'e_ids': list(e_ids),
+                                'source': self.source, 'time': time.time()})
+        self.published += 1
+        self.last_published = max(self.last_published, seq)
+        return seq
+
+    def known_seq(self):
+        """Number of the latest event this process knows of."""
+        return max(self.last_seq or 0, self.last_published)
+
+    def latest_seq(self):
+        doc = self.counter.find_one({'_id': 'seq'})
+        return doc['seq'] if doc else 0
+
+    def poll(self, force=False):
+        """Apply new events, if `poll_seconds` have passed since the
+        last poll and no other thread is polling. Return them."""
+        now = time.time()
+        if not force and now < self._next_poll:
+            return []
+        if not self._lock.acquire(False):
+            return []
+        try:
+            self._next_poll = now + self.poll_seconds
+            events = self._new_events(now)
+        finally:
+            self._lock.release()
+        for event in events:
+            if event['kind'] != RESET and event['source'] == self.source:
+                continue
+            self.received += 1
+            for fn in self._handlers:
+                try:
+                    fn(event)
+                except Exception:
+                    logger.exception("handling %s event %s",
+                                     event['kind'], event['seq'])
+        return events
+
+    def _new_events(self, now):
+        latest = self.latest_seq()
+        if self.last_seq is None:
+            # A new worker has nothing cached yet.
+            self.last_seq = latest
+            return []
+        if latest <= self.last_seq:
+            return []
+        if latest - self.last_seq > self.max_events:
+            return [self._reset(latest, now)]
+        docs = self.events.find({'seq': {'$gt': self.last_seq}},
+                                sort=[('seq', ASCENDING)])
+        events = []
+        for doc in docs:
+            if doc['seq'] != self.last_seq + 1:
+                break
+            events.append(doc)
+            self.last_seq = doc['seq']
+        if self.last_seq == latest:
+            self._gap_since = None
+        elif self._gap_since is None:
+            self._gap_since = now
+        elif now - self._gap_since > self.gap_seconds:
+            return events + [self._reset(latest, now)]
+        return events
+
+    def _reset(self, latest, now):
+        logger.warning("invalidation events %d to %d missed, resetting",
+                       self.last_seq + 1, latest)
+        self.last_seq = latest
+        self._gap_since = None
+        self.resets += 1
+        return {'seq': latest, 'kind': RESET, 'e_ids': [],
+                'source': None, 'time': now}
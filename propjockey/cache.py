@@ -0,0 +1,160 @@
+"""In-process caches."""
+
+from collections import OrderedDict
+import threading
+import time
+
+from bson import BSON
+
+from .idsets import find_in
+
+
+class Version(object):
+    """A counter bumped whenever cached data may have gone stale.
+
+    Functions added with `on_change` are called after each bump.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+        for fn in self._callbacks:
+            fn()
+
+    def on_change(self, fn):
+        self._callbacks.append(fn)
+
+
+class LRUCache(object):
+    """Thread-safe mapping with least-recently-used eviction.
+
+    Bounded by number of items and, if `maxbytes` is given, by the
+    total of `sizeof(value)` over items. Items older than `ttl` seconds,
+    if given, are treated as absent.
+    """
+    def __init__(self, maxsize=10000, maxbytes=None, ttl=None,
+                 sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and (
+                    time.time() - item[2] > self.ttl):
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, time.time())
+            self.nbytes += size
+            while self._data and (
+                    len(self._data) > self.maxsize or
+                    (self.maxbytes is not None and
+                     self.nbytes > self.maxbytes)):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        value, size, _ = self._data.pop(key)
+        self.nbytes -= size
+        return value
+
+
+class EntryCache(object):
+    """Cache of entry documents, keyed by entry id.
+
+    Only projected fields are held, along with whether the entry has the
+    property (per `econf['has_property']`). All misses of a `get_many`
+    call are fetched with `$in` queries of bounded size.
+    Returned documents are copies and may be modified by the caller.
+    """
+    def __init__(self, econf, projection, **cache_kwargs):
+        self.e_id = econf['e_id']
+        self.has_property_filter = econf['has_property']
+        self.projection = projection
+        self.cache = LRUCache(sizeof=self._sizeof, **cache_kwargs)
+
+    @staticmethod
+    def _sizeof(item):
+        return len(BSON.encode(item[0]))
+
+    def get_many(self, collection, e_ids):
+        """Return a dict of entry id -> entry for existing entries."""
+        found, misses = {}, []
+        for e_id in e_ids:
+            item = self.cache.get(e_id)
+            if item is None:
+                misses.append(e_id)
+            else:
+                found[e_id] = item
+        if misses:
+            found.update(self._fetch(collection, misses))
+        return {e_id: dict(item[0]) for e_id, item in found.items()}
+
+    def has_property(self, collection, e_id):
+        """Return whether entry has the property, or None if no entry."""
+        item = self.cache.get(e_id)
+        if item is None:
+            item = self._fetch(collection, [e_id]).get(e_id)
+        return item[1] if item else None
+
+    def gained_property(self, e_ids):
+        """Drop entries now known to have the property."""
+        for e_id in e_ids:
+            item = self.cache.get(e_id)
+            if item is not None and not item[1]:
+                self.cache.pop(e_id)
+
+    def invalidate(self, e_ids=None):
+        if e_ids is None:
+            self.cache.clear()
+        for e_id in e_ids or []:
+            self.cache.pop(e_id)
+
+    def _fetch(self, collection, e_ids):
+        docs = find_in(collection, {}, self.e_id, e_ids, self.projection)
+        with_property = {d[self.e_id] for d in find_in(
+            collection, self.has_property_filter, self.e_id, e_ids,
+            {self.e_id: 1, '_id': 0})}
+        fetched = {}
+        for doc in docs:
+            e_id = doc[self.e_id]
+            fetched[e_id] = (doc, e_id in with_property)
+            self.cache.set(e_id, fetched[e_id])
+        return fetched
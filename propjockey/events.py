@@ -0,0 +1,175 @@
+"""Server-sent events of vote-count changes.
+
+An `EventHub` per worker holds the latest `buffer_size` events, each
+with an id, a name and JSON data, e.g. `votes` events whose data is a
+list of `[e_id, nvotes, state]`. Subscribers do not get a queue of
+their own: they wait on one condition and, once woken, send whatever
+was published since the id they last sent, so publishing costs the
+same however many are connected, and an idle one only wakes to send a
+heartbeat every `heartbeat_seconds`. At most `max_subscribers` are
+connected at once, each for up to `max_seconds`, after which the
+browser reconnects, possibly to another worker.
+
+Ids are `<hub>-<n>`, so that a client reconnecting with a
+`Last-Event-ID` the hub cannot continue from (another worker's, or
+older than the buffer) gets a `reset` event, upon which it should
+fetch rows again.
+
+Events of other workers arrive through the invalidation bus, which is
+otherwise only polled by requests. While anyone is subscribed, a
+thread calls `poll` every `poll_seconds`.
+"""
+import binascii
+from collections import deque
+import json
+import logging
+import os
+import threading
+import time
+
+RESET = 'reset'
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event_id, name, data):
+    """Return an event as sent on the stream."""
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event_id, name, json.dumps(data, separators=(',', ':')))
+
+
+class EventHub(object):
+    def __init__(self, max_subscribers=1000, buffer_size=1000,
+                 heartbeat_seconds=15.0, max_seconds=600.0, retry_ms=3000,
+                 poll=None, poll_seconds=1.0):
+        self.max_subscribers = max_subscribers
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_seconds = max_seconds
+        self.retry_ms = retry_ms
+        self.poll = poll
+        self.poll_seconds = poll_seconds
+        self.name = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self.last_id = 0
+        self.subscribers = 0
+        self.published = self.connected = self.rejected = 0
+        self._events = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._pump = None
+
+    @classmethod
+    def from_config(cls, config, poll=None):
+        """Return the hub of the `EVENTS` setting, if enabled."""
+        events_config = dict(config.get('EVENTS') or {})
+        if not events_config.pop('enabled', False):
+            return None
+        return cls(poll=poll, **events_config)
+
+    def publish(self, name, data):
+        """Send an event to subscribers. Return its id."""
+        with self._cond:
+            self.last_id += 1
+            self._events.append((self.last_id, name, data))
+            self.published += 1
+            self._cond.notify_all()
+        return self.last_id
+
+    def skip(self):
+        """Pass over an event no one is connected to receive, so that
+        clients reconnecting from before it are reset."""
+        with self._cond:
+            self.last_id += 1
+
+    def since(self, last_id):
+        """Return the events after `last_id`, or None if some of them
+        are gone."""
+        with self._cond:
+            events = [e for e in self._events if e[0] > last_id]
+            if len(events) != self.last_id - last_id:
+                return None
+            return events
+
+    def parse_id(self, event_id):
+        """Return the number of an id sent by this hub, else None."""
+        name, _, n = (event_id or '').partition('-')
+        if name != self.name or not n.isdigit() or int(n) > self.last_id:
+            return None
+        return int(n)
+
+    def subscribe(self, last_event_id=None):
+        """Return a stream of events after `last_event_id`, or None if
+        `max_subscribers` are connected."""
+        with self._cond:
+            if self.subscribers >= self.max_subscribers:
+                self.rejected += 1
+                return None
+            self.subscribers += 1
+            self.connected += 1
+            if self.poll is not None and self._pump is None:
+                self._pump = threading.Thread(
+                    target=self._run_pump, name='propjockey-events')
+                self._pump.daemon = True
+                self._pump.start()
+        return Stream(self, last_event_id)
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def wait(self, last_id, timeout):
+        """Wait up to `timeout` for an event after `last_id`."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.last_id > last_id, timeout)
+
+    def _run_pump(self):
+        while True:
+            with self._cond:
+                if not self.subscribers:
+                    self._pump = None
+                    return
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("polling for events failed")
+            time.sleep(self.poll_seconds)
+
+
+class Stream(object):
+    """The events of `hub` for one subscriber, as a response body."""
+
+    def __init__(self, hub, last_event_id=None):
+        self.hub = hub
+        # Events are sent from the time of subscription.
+        self.last_id = hub.parse_id(last_event_id)
+        self.reset = self.last_id is None and bool(last_event_id)
+        if self.last_id is None:
+            self.last_id = hub.last_id
+        self._closed = False
+
+    def __iter__(self):
+        return self._messages()
+
+    def _messages(self):
+        hub, last_id = self.hub, self.last_id
+        yield 'retry: {}\n\n'.format(hub.retry_ms)
+        if self.reset:
+            yield format_event('{}-{}'.format(hub.name, last_id), RESET, {})
+        end = time.time() + hub.max_seconds
+        while time.time() < end:
+            hub.wait(last_id, min(hub.heartbeat_seconds, end - time.time()))
+            events = hub.since(last_id)
+            if events is None:
+                last_id = hub.last_id
+                yield format_event('{}-{}'.format(hub.name, last_id),
+                                   RESET, {})
+            elif events:
+                last_id = events[-1][0]
+                yield ''.join(format_event('{}-{}'.format(hub.name, n),
+                                           name, data)
+                              for n, name, data in events)
+            else:
+                yield ': keep-alive\n\n'
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.hub.unsubscribe()
@@ -0,0 +1,42 @@
+"""Overlap independent round trips within one request.
+
+A `RequestExecutor` submits functions to a shared thread pool, wrapped
+by `wrap` so that they run in the context of the request that submits
+them. Results are read from the returned futures in whatever order the
+caller needs, so they do not depend on which finishes first, and
+`result()` re-raises any exception in the calling thread. Without a
+pool, functions run immediately, in order, in the calling thread.
+"""
+from concurrent.futures import Future
+
+
+class RequestExecutor(object):
+    def __init__(self, pool=None, wrap=None):
+        self.pool = pool
+        self.wrap = wrap
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        if self.pool is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        future = self.pool.submit(self.wrap(fn) if self.wrap else fn,
+                                  *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def close(self):
+        """Cancel work not yet started, and wait for work in progress.
+
+        Nothing submitted then outlives the request.
+        """
+        for future in self._futures:
+            future.cancel()
+        for future in self._futures:
+            if not future.cancelled():
+                future.exception()
+        self._futures = []
@@ -0,0 +1,74 @@
+"""Cache of user filters and the entries matching them.
+
+Users page through the same few filters again and again. For each
+normalized filter string, `FilterCache` keeps the Mongo filter given by
+`econf['filter']['transform']`, and, for each of the missing-property
+and has-property partitions, the ids of matching entries in ascending
+(extrasort, entry id) order. A page of an inactive section is then a
+slice of a cached id list, less entries with active votes, and only
+that page's entries need to be fetched.
+
+Entries gain the property over time, so the lists expire after `ttl`
+seconds, and `invalidate` drops them all.
+"""
+import copy
+
+from pymongo import ASCENDING
+
+from .cache import LRUCache
+
+
+def normalize(filter_string):
+    """Collapse runs of whitespace, which separate criteria."""
+    return ' '.join((filter_string or '').split())
+
+
+class FilterCache(object):
+    def __init__(self, econf, **cache_kwargs):
+        self.econf = econf
+        self.cache = LRUCache(sizeof=self._sizeof, **cache_kwargs)
+
+    @staticmethod
+    def _sizeof(value):
+        # Roughly, for lists of short id strings.
+        return 64 * len(value) if isinstance(value, list) else 256
+
+    def resolve(self, filter_string):
+        """Return the Mongo filter for a user's filter string."""
+        key = (normalize(filter_string), 'filter')
+        filt = self.cache.get(key)
+        if filt is None:
+            filt = self.econf['filter']['transform'](key[0])
+            self.cache.set(key, filt)
+        return copy.deepcopy(filt)
+
+    def ids(self, collection, filter_string, prop_missing=True,
+            max_time_ms=None):
+        """Return ids of entries matching the filter, in the partition
+        without (or with) the property, in ascending extrasort order."""
+        key = (normalize(filter_string), 'missing' if prop_missing else 'has')
+        ids = self.cache.get(key)
+        if ids is None:
+            e_id = self.econf['e_id']
+            filt = self.resolve(filter_string)
+            filt.update(self.econf[
+                'missing_property' if prop_missing else 'has_property'])
+            ids = [d[e_id] for d in collection.find(
+                filt, {e_id: 1, '_id': 0},
+                sort=[(self.econf['extrasort']['field'], ASCENDING),
+                      (e_id, ASCENDING)], max_time_ms=max_time_ms)]
+            self.cache.set(key, ids)
+        return ids
+
+    def page(self, collection, filter_string, prop_missing, exclude,
+             descending=False, skip=0, limit=0, max_time_ms=None):
+        """Return (number of ids not in `exclude`, a page of them)."""
+        ids = self.ids(collection, filter_string, prop_missing, max_time_ms)
+        if descending:
+            ids = reversed(ids)
+        ids = [e_id for e_id in ids if e_id not in exclude]
+        end = skip + limit if limit else None
+        return len(ids), ids[skip:end]
+
+    def invalidate(self):
+        self.cache.clear()
@@ -0,0 +1,162 @@
+"""Queries constrained to large sets of ids.
+
+A filter with an `$in` or `$nin` of every entry with active votes grows
+with the number of votes, towards the BSON document size limit, and the
+server parses it again on every request. Here, ids are sent in chunks
+of at most `chunk_size`:
+
+- `find_in` queries each chunk, with the sort and `skip + limit` of the
+  whole, and merges the sorted results with a streaming k-way merge, so
+  that reading stops once the page is full.
+- `find_not_in` sends `$nin` as is for up to `max_nin` ids. For more,
+  it reads the ids of matching documents in order, drops the excluded
+  ones client-side and fetches only the documents of the page.
+- `count_in` and `update_in` work chunk by chunk, and `count_not_in`
+  above `max_nin` ids subtracts the count of matches among them.
+
+`max_time_ms` limits each query.
+"""
+from functools import cmp_to_key
+import heapq
+from itertools import islice
+
+from pymongo import ASCENDING
+
+CHUNK_SIZE = 1000
+MAX_NIN = 5000
+
+
+def chunks(ids, chunk_size=CHUNK_SIZE):
+    """Split `ids`, without repeats, into lists of at most `chunk_size`."""
+    ids = list(dict.fromkeys(ids))
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i + chunk_size]
+
+
+def with_ids(filt, field, spec):
+    """Return `filt` constrained by `{field: spec}`, keeping any
+    constraint of its own on `field`."""
+    filt = dict(filt or {})
+    if field in filt:
+        return {'$and': [filt, {field: spec}]}
+    filt[field] = spec
+    return filt
+
+
+def _value(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _compare(a, b):
+    # Missing values and nulls sort first, as on the server.
+    a, b = (a is not None, a), (b is not None, b)
+    return (a > b) - (a < b)
+
+
+def sort_key(sort):
+    """Key function ordering documents as `sort`, a list of (field,
+    direction), would on the server."""
+    def cmp(a, b):
+        for field, direction in sort:
+            c = _compare(_value(a, field), _value(b, field))
+            if c:
+                return c if direction == ASCENDING else -c
+        return 0
+    return cmp_to_key(cmp)
+
+
+def _projected(projection, sort):
+    """Return `projection` with the sort fields included, and those it
+    added."""
+    if not projection or not sort:
+        return projection, []
+    if not any(v for k, v in projection.items() if k != '_id'):
+        # An exclusion projection keeps the sort fields, unless excluded.
+        return projection, []
+    added = [field for field, _ in sort if field not in projection]
+    return dict(projection, **{f: 1 for f in added}), added
+
+
+def _time_limit(max_time_ms):
+    return {'maxTimeMS': max_time_ms} if max_time_ms else {}
+
+
+def _strip(docs, fields):
+    for doc in docs:
+        for field in fields:
+            doc.pop(field, None)
+        yield doc
+
+
+def find_in(collection, filt, field, ids, projection=None, sort=None,
+            skip=0, limit=0, chunk_size=CHUNK_SIZE, max_time_ms=None):
+    """Yield documents matching `filt` with `field` in `ids`, in `sort`
+    order, `skip` to `skip + limit`."""
+    projection, added = _projected(projection, sort)
+    cursors = [collection.find(
+        with_ids(filt, field, {'$in': chunk}), projection, sort=sort,
+        limit=skip + limit if limit else 0, max_time_ms=max_time_ms)
+        for chunk in chunks(ids, chunk_size)]
+    if len(cursors) == 1:
+        docs = iter(cursors[0])
+    elif sort:
+        docs = heapq.merge(*cursors, key=sort_key(sort))
+    else:
+        docs = (doc for cursor in cursors for doc in cursor)
+    docs = islice(docs, skip, skip + limit if limit else None)
+    return _strip(docs, added) if added else docs
+
+
+def count_in(collection, filt, field, ids, chunk_size=CHUNK_SIZE,
+             max_time_ms=None):
+    """Count documents matching `filt` with `field` in `ids`."""
+    return sum(collection.count_documents(
+        with_ids(filt, field, {'$in': chunk}), **_time_limit(max_time_ms))
+        for chunk in chunks(ids, chunk_size))
+
+
+def find_not_in(collection, filt, field, ids, projection=None, sort=None,
+                skip=0, limit=0, chunk_size=CHUNK_SIZE, max_nin=MAX_NIN,
+                max_time_ms=None):
+    """As `find_in`, for `field` not in `ids`."""
+    ids = list(ids)
+    if len(ids) <= max_nin:
+        return iter(collection.find(
+            with_ids(filt, field, {'$nin': ids}), projection, sort=sort,
+            skip=skip, limit=limit, max_time_ms=max_time_ms))
+    excluded = set(ids)
+    id_docs = collection.find(filt, {field: 1, '_id': 0}, sort=sort,
+                              batch_size=chunk_size, max_time_ms=max_time_ms)
+    kept = (_value(d, field) for d in id_docs
+            if _value(d, field) not in excluded)
+    page = list(islice(kept, skip, skip + limit if limit else None))
+    projection, added = _projected(projection, [(field, ASCENDING)])
+    by_id = {_value(d, field): d for d in find_in(
+        collection, filt, field, page, projection, chunk_size=chunk_size,
+        max_time_ms=max_time_ms)}
+    docs = (by_id[i] for i in page if i in by_id)
+    return _strip(docs, added) if added else docs
+
+
+def count_not_in(collection, filt, field, ids, chunk_size=CHUNK_SIZE,
+                 max_nin=MAX_NIN, max_time_ms=None):
+    """Count documents matching `filt` with `field` not in `ids`."""
+    ids = list(ids)
+    if len(ids) <= max_nin:
+        return collection.count_documents(
+            with_ids(filt, field, {'$nin': ids}), **_time_limit(max_time_ms))
+    return (collection.count_documents(filt or {},
+                                       **_time_limit(max_time_ms)) -
+            count_in(collection, filt, field, ids, chunk_size, max_time_ms))
+
+
+def update_in(collection, field, ids, update, chunk_size=CHUNK_SIZE):
+    """Apply `update` to documents with `field` in `ids`. Return the
+    number modified."""
+    return sum(collection.update_many({field: {'$in': chunk}},
+                                      update).modified_count
+               for chunk in chunks(ids, chunk_size))
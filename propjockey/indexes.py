@@ -0,0 +1,137 @@
+"""Index management for the votes and entries collections.
+
+Indexes are derived from the ENTRIES and VOTES configuration so that
+they track the fields the app actually queries and sorts on.
+"""
+
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+
+logger = logging.getLogger(__name__)
+
+
+def _is_equality(spec):
+    return not isinstance(spec, dict)
+
+
+def required_indexes(econf, vconf):
+    """Return a dict of collection name -> list of index key lists.
+
+    For the votes collection, fields with an equality constraint in
+    both `filter_active` and `filter_completed` lead, followed by the
+    `nvotes` sort key and then the remaining filter fields, so that one
+    index serves both leaderboards without an in-memory sort.
+    """
+    active, completed = vconf['filter_active'], vconf['filter_completed']
+    equality = [(k, ASCENDING) for k in sorted(active)
+                if _is_equality(active[k]) and
+                _is_equality(completed.get(k, {}))]
+    others = [(k, ASCENDING) for k in sorted(set(active) | set(completed))
+              if (k, ASCENDING) not in equality]
+    leaderboard = equality + [(vconf['nvotes'], DESCENDING)] + others
+    votes = [
+        leaderboard,
+        # Multikey index for "show only what I have upvoted".
+        [(vconf['requesters'], ASCENDING)] + leaderboard,
+        # `_vote` lookups and upserts.
+        [(vconf['entry_id'], ASCENDING), (vconf['prop_field'], ASCENDING)],
+    ]
+    votes.extend(vconf.get('indexes', []))
+
+    extrasort = econf['extrasort']['field']
+    entries = [
+        [(econf['e_id'], ASCENDING)],
+        # Inactive sections are sorted by extrasort and filtered on
+        # property (non)existence and the user filter.
+        [(extrasort, ASCENDING), (econf['e_id'], ASCENDING)],
+    ]
+    entries.extend(econf.get('indexes', []))
+    return {'votes': votes, 'entries': entries}
+
+
+def ensure_indexes(db, econf, vconf):
+    """Create any missing indexes. Safe to run repeatedly.
+
+    `db` is a Bunch of collections as from `connect_collections`.
+    Returns a list of (collection name, index keys, created) tuples.
+    """
+    report = []
+    for name, specs in sorted(required_indexes(econf, vconf).items()):
+        coll = getattr(db, name)
+        existing = [[tuple(k) for k in info['key']]
+                    for info in coll.index_information().values()]
+        for keys in specs:
+            keys = [tuple(k) for k in keys]
+            created = keys not in existing
+            if created:
+                coll.create_index(keys)
+                existing.append(keys)
+            report.append((name, keys, created))
+    return report
+
+
+def hot_queries(econf, vconf):
+    """Return (label, collection name, filter, sort) for hot queries.
+
+    These mirror the query shapes of `rows()` and `_vote()`, using
+    placeholder values for ids and users.
+    """
+    eid, user = '', 'user@example.gov'
+    nvotes_sort = [(vconf['nvotes'], DESCENDING)]
+    extrasort = [(econf['extrasort']['field'], ASCENDING)]
+
+    def votes_filter(base, extra):
+        filt = vconf[base].copy()
+        filt.update(extra)
+        return filt
+
+    def entries_filter(prop):
+        filt = {econf['e_id']: {'$nin': [eid]}}
+        filt.update(econf[prop])
+        return filt
+
+    return [
+        ('active leaderboard', 'votes',
+         vconf['filter_active'], nvotes_sort),
+        ('completed leaderboard', 'votes',
+         vconf['filter_completed'], nvotes_sort),
+        ('user-only leaderboard', 'votes',
+         votes_filter('filter_active',
+                      vconf['user_voted'](user, prefilter=True)),
+         nvotes_sort),
+        ('vote lookup', 'votes',
+         votes_filter('filter_active', {vconf['entry_id']: eid}), None),
+        ('active entries', 'entries',
+         {econf['e_id']: {'$in': [eid]}}, None),
+        ('inactive missing property', 'entries',
+         entries_filter('missing_property'), extrasort),
+        ('inactive has property', 'entries',
+         entries_filter('has_property'), extrasort),
+    ]
+
+
+def _has_stage(plan, stage):
+    if plan.get('stage') == stage:
+        return True
+    children = list(plan.get('inputStages', []))
+    if 'inputStage' in plan:
+        children.append(plan['inputStage'])
+    return any(_has_stage(child, stage) for child in children)
+
+
+def check_query_plans(db, econf, vconf):
+    """Log a warning for each hot query whose winning plan is a COLLSCAN.
+
+    Returns the labels of such queries.
+    """
+    collscans = []
+    for label, name, filt, sort in hot_queries(econf, vconf):
+        cursor = getattr(db, name).find(filt, sort=sort, limit=1)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if _has_stage(plan, 'COLLSCAN'):
+            logger.warning(
+                "Query '%s' on %s collection runs as a COLLSCAN. "
+                "Run `flask ensure-indexes`.", label, name)
+            collscans.append(label)
+    return collscans
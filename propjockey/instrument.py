@@ -0,0 +1,203 @@
+"""Attribute database commands to the requests that issue them.
+
+A `QueryRecorder` is a pymongo command listener, also registered with
+the memory backend. While a recording is active on a thread, commands
+run on that thread are added to it, with their duration, the number of
+documents returned and, optionally, the size of the reply. Command
+events are published on the thread that runs the command, so
+recordings need no locking.
+
+`instrument_app` records each Flask request, logging one JSON line per
+request to the `propjockey.queries` logger and each command slower than
+a threshold to `propjockey.slow_queries`. `recorder.max_commands` lets
+tests bound the number of commands an endpoint may use.
+"""
+from __future__ import division
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+from bson import BSON, json_util
+from pymongo import monitoring
+
+from . import memstore
+
+request_logger = logging.getLogger('propjockey.queries')
+slow_logger = logging.getLogger('propjockey.slow_queries')
+
+
+class Recording(object):
+    """Database commands run during some unit of work."""
+
+    def __init__(self, name=None):
+        self.name = name
+        self.start = time.time()
+        self.commands = []
+
+    def add(self, command_name, collection, duration_ms, ndocs, nbytes):
+        self.commands.append(
+            (command_name, collection, duration_ms, ndocs, nbytes))
+
+    def summary(self):
+        return {
+            'ncommands': len(self.commands),
+            'mongo_ms': round(sum(c[2] for c in self.commands), 3),
+            'ndocs': sum(c[3] for c in self.commands),
+            'nbytes': sum(c[4] for c in self.commands),
+            'commands': dict(Counter(
+                '{}:{}'.format(c[0], c[1]) for c in self.commands)),
+        }
+
+
+def reply_ndocs(reply):
+    """Number of documents in a command reply."""
+    if not reply:
+        return 0
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if 'values' in reply:
+        return len(reply['values'])
+    if 'value' in reply:
+        return int(reply['value'] is not None)
+    return reply.get('n', 0)
+
+
+class QueryRecorder(monitoring.CommandListener):
+    """Command listener adding commands to the thread's recordings.
+
+    Commands slower than `slow_ms` are logged with their command
+    document. Reply sizes are measured, by encoding the reply, only if
+    `reply_bytes` is set.
+    """
+
+    def __init__(self, slow_ms=None, reply_bytes=False):
+        self.slow_ms = slow_ms
+        self.reply_bytes = reply_bytes
+        self._local = threading.local()
+
+    def _recordings(self):
+        if not hasattr(self._local, 'recordings'):
+            self._local.recordings = []
+            self._local.started = {}
+        return self._local.recordings
+
+    @contextmanager
+    def recording(self, name=None):
+        """Record commands run by this thread in the body."""
+        rec = self.start(name)
+        try:
+            yield rec
+        finally:
+            self.stop(rec)
+
+    def start(self, name=None):
+        rec = Recording(name)
+        self._recordings().append(rec)
+        return rec
+
+    def stop(self, rec):
+        recordings = self._recordings()
+        if rec in recordings:
+            recordings.remove(rec)
+        return rec
+
+    def current(self):
+        """Return the recordings active on this thread."""
+        return list(self._recordings())
+
+    @contextmanager
+    def attached(self, recordings):
+        """Add commands run by this thread in the body to `recordings`,
+        e.g. those of the thread that handed it work."""
+        saved = self._recordings()
+        self._local.recordings = list(recordings)
+        try:
+            yield
+        finally:
+            self._local.recordings = saved
+
+    @contextmanager
+    def max_commands(self, n):
+        """Fail unless the body runs at most `n` commands."""
+        with self.recording() as rec:
+            yield rec
+        if len(rec.commands) > n:
+            raise AssertionError("{} commands run, expected at most {}: {}"
+                                 .format(len(rec.commands), n,
+                                         rec.summary()['commands']))
+
+    def started(self, event):
+        if self._recordings():
+            self._local.started[event.request_id] = event.command
+
+    def succeeded(self, event):
+        self._finished(event, event.reply)
+
+    def failed(self, event):
+        self._finished(event, None)
+
+    def _finished(self, event, reply):
+        recordings = self._recordings()
+        if not recordings:
+            return
+        command = self._local.started.pop(event.request_id, None) or {}
+        collection = command.get(event.command_name)
+        if not isinstance(collection, str):
+            # e.g. getMore, whose value is a cursor id.
+            collection = command.get('collection')
+        duration_ms = event.duration_micros / 1000
+        ndocs = reply_ndocs(reply)
+        nbytes = len(BSON.encode(reply)) if reply and self.reply_bytes else 0
+        for rec in recordings:
+            rec.add(event.command_name, collection, duration_ms, ndocs, nbytes)
+        if self.slow_ms is not None and duration_ms >= self.slow_ms:
+            slow_logger.warning(json.dumps({
+                'name': recordings[0].name,
+                'command': event.command_name,
+                'collection': collection,
+                'ms': round(duration_ms, 3),
+                'ndocs': ndocs,
+                'detail': json_util.dumps(command)[:1000],
+            }))
+
+
+def register(recorder):
+    """Register `recorder` for pymongo and memory clients created later."""
+    monitoring.register(recorder)
+    memstore.register(recorder)
+
+
+def instrument_app(app, recorder):
+    """Record the commands of each request to `app` and log them."""
+    from flask import g, request
+
+    @app.before_request
+    def start_recording():
+        g.query_recording = recorder.start(request.endpoint)
+
+    @app.after_request
+    def log_recording(response):
+        rec = g.pop('query_recording', None)
+        if rec is not None:
+            recorder.stop(rec)
+            line = {
+                'endpoint': rec.name,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'ms': round(1e3 * (time.time() - rec.start), 3),
+            }
+            line.update(rec.summary())
+            request_logger.info(json.dumps(line, sort_keys=True))
+        return response
+
+    @app.teardown_request
+    def stop_recording(exc=None):
+        rec = g.pop('query_recording', None)
+        if rec is not None:
+            recorder.stop(rec)
@@ -0,0 +1,176 @@
+"""Memory-mapped snapshot of the active-vote leaderboard.
+
+A publisher (`flask publish-leaderboard`, one per host) writes the
+entries with active votes, by descending number of votes, to a file
+that every worker on the host maps read-only, rather than each fetching
+all active vote documents per request. The file is
+
+    header   HEADER: magic, format, generation, invalidation bus
+             sequence number when built (-1 if none), build time,
+             number of records and size of the string table
+    records  RECORD per entry: index of its id in the string table,
+             number of votes and (transformed) extrasort value
+    offsets  n + 1 little-endian uint32 offsets into the string table
+    strings  UTF-8 entry ids
+
+A new generation is written to a temporary file and renamed over the
+old one, so readers see either one whole snapshot or the other, and
+keep using the one they mapped until they next look for a new one.
+"""
+from __future__ import division
+
+from array import array
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from pymongo import ASCENDING, DESCENDING
+
+from .idsets import find_in
+
+MAGIC = b'PJLB'
+FORMAT = 1
+HEADER = struct.Struct('<4sHHQqdII')
+RECORD = struct.Struct('<IId')
+
+
+def write_snapshot(path, rows, generation, seq=-1):
+    """Write `rows` of (entry id, nvotes, extrasort), atomically."""
+    rows = list(rows)
+    encoded = [e_id.encode('utf-8') for e_id, _, _ in rows]
+    offsets = array('I', [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    strings = b''.join(encoded)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, 0, generation, seq, time.time(),
+                            len(rows), len(strings)))
+        for i, (_, nvotes, extrasort) in enumerate(rows):
+            f.write(RECORD.pack(i, nvotes, extrasort))
+        f.write(offsets.tobytes())
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Snapshot(object):
+    """One generation of the leaderboard, mapped read-only."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, fmt, _, self.generation, self.seq, self.built_at, self.n,
+         nstrings) = HEADER.unpack_from(self._map)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError("{} is not a leaderboard snapshot".format(path))
+        self._records = HEADER.size
+        self._offsets = self._records + self.n * RECORD.size
+        self._strings = self._offsets + 4 * (self.n + 1)
+        if len(self._map) != self._strings + nstrings:
+            raise ValueError("{} is truncated".format(path))
+
+    def __len__(self):
+        return self.n
+
+    def e_id(self, index):
+        start, end = struct.unpack_from(
+            '<II', self._map, self._offsets + 4 * index)
+        return self._map[self._strings + start:
+                         self._strings + end].decode('utf-8')
+
+    def records(self):
+        """Yield (entry id, nvotes, extrasort), by descending nvotes."""
+        view = memoryview(self._map)[self._records:self._offsets]
+        try:
+            for index, nvotes, extrasort in RECORD.iter_unpack(view):
+                yield self.e_id(index), nvotes, extrasort
+        finally:
+            view.release()
+
+
+class Leaderboard(object):
+    """The latest snapshot at `path`, looked for at most every
+    `check_seconds`."""
+
+    def __init__(self, path, check_seconds=1.0):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.swaps = 0
+        self._snapshot = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """Return the latest snapshot, or None if there is none."""
+        now = time.time()
+        if now < self._next_check:
+            return self._snapshot
+        with self._lock:
+            self._next_check = now + self.check_seconds
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                self._snapshot = None
+                return None
+            old = self._snapshot
+            if old is None or (stat.st_ino, stat.st_mtime) != (
+                    old.stat.st_ino, old.stat.st_mtime):
+                # The old map is closed once no request uses it.
+                self._snapshot = Snapshot(self.path)
+                self.swaps += 1
+            return self._snapshot
+
+
+def build_rows(votes, entries, econf, vconf):
+    """Return rows of the leaderboard, from the database."""
+    entry_id, nvotes = vconf['entry_id'], vconf['nvotes']
+    ranked = [(d[entry_id], d[nvotes]) for d in votes.find(
+        vconf['filter_active'], {entry_id: 1, nvotes: 1, '_id': 0},
+        sort=[(nvotes, DESCENDING), (entry_id, ASCENDING)])]
+    field = econf['extrasort']['field']
+    xform = econf['extrasort'].get('transform') or (lambda x: x)
+    extrasorts = {e[econf['e_id']]: xform(e[field]) for e in find_in(
+        entries, {}, econf['e_id'], [e_id for e_id, _ in ranked],
+        {econf['e_id']: 1, field: 1, '_id': 0})}
+    # As for live rows, entries missing from the collection are left out.
+    return [(e_id, n, extrasorts[e_id]) for e_id, n in ranked
+            if e_id in extrasorts]
+
+
+def publish(path, rows, seq=-1):
+    """Write `rows` as the next generation at `path`. Return it."""
+    try:
+        generation = Snapshot(path).generation + 1
+    except (OSError, ValueError):
+        generation = 1
+    write_snapshot(path, rows, generation, seq)
+    return generation
+
+
+def compare(snapshot, live):
+    """Return differences between `snapshot` and `live`, a list of
+    (entry id, nvotes) by descending nvotes, e.g. from `find_votes`."""
+    problems = []
+    snap = list(snapshot.records())
+    counts = [n for _, n, _ in snap]
+    if counts != sorted(counts, reverse=True):
+        problems.append("records not ordered by descending nvotes")
+    snap_votes = {e_id: n for e_id, n, _ in snap}
+    live_votes = dict(live)
+    for e_id in sorted(set(live_votes) - set(snap_votes)):
+        problems.append("{} missing".format(e_id))
+    for e_id in sorted(set(snap_votes) - set(live_votes)):
+        problems.append("{} has no active votes".format(e_id))
+    for e_id in sorted(set(snap_votes) & set(live_votes)):
+        if snap_votes[e_id] != live_votes[e_id]:
+            problems.append("{} has {} votes, not {}".format(
+                e_id, snap_votes[e_id], live_votes[e_id]))
+    return problems
@@ -0,0 +1,1119 @@
+"""In-process storage backend emulating the subset of pymongo we use.
+
+Select it for a client in the CLIENTS setting with
+`{'backend': 'memory', 'database': ..., 'collection': ...}`, optionally
+with `'snapshot': path` to load a dump or mongodump archive (see
+`propjockey.snapshot`) into the database once per process. All memory
+clients in a process share the same databases, as if connected to one
+server.
+
+Supported: find/find_one with projection, sort, skip and limit; cursor
+count/skip/limit/sort; query operators $eq, $ne, $gt(e), $lt(e), $in,
+$nin, $exists, $all, $size, $regex, $not, $elemMatch, $and, $or and
+$nor; updates with $set, $unset, $inc, $min, $max, $push, $pull,
+$addToSet and $setOnInsert, with upserts; inserts, replacements,
+deletes, find_one_and_*, counts, distinct, bulk writes and simple
+aggregation pipelines. Indexes are hash indexes on their first key,
+used for equality and $in lookups. Finds given `max_time_ms` raise
+ExecutionTimeout if matching takes longer.
+
+Listeners added with `register` are told of each command through
+started/succeeded/failed events shaped like pymongo's, so the same
+command listener can monitor both backends.
+"""
+
+from collections import OrderedDict
+import datetime
+from functools import wraps
+import itertools
+import random
+import re
+import threading
+import time
+
+from bson import ObjectId
+from bson.regex import Regex
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import (
+    CollectionInvalid, DuplicateKeyError, ExecutionTimeout, InvalidOperation,
+    OperationFailure)
+from pymongo.operations import (
+    DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne)
+from pymongo.results import (
+    BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult,
+    UpdateResult)
+
+_MISSING = object()
+_REGEX_TYPES = (type(re.compile('')), Regex)
+
+
+def _copy(value):
+    """Copy containers of a BSON-like value. Faster than deepcopy."""
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _type_rank(value):
+    """Rank of a value's type in MongoDB's cross-type sort order."""
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    if isinstance(value, dict):
+        return (4, tuple((k, _sort_key(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return (5, tuple(_sort_key(v) for v in value))
+    rank = _type_rank(value)
+    return (rank, None if rank == 1 else value)
+
+
+def _hashable(value):
+    if isinstance(value, (dict, list)):
+        return _sort_key(value)
+    return value
+
+
+# Paths and values.
+
+def _path_values(doc, parts):
+    """Return values at the dotted path `parts` of `doc`.
+
+    As in MongoDB, arrays along the path are traversed element-wise.
+    """
+    if not parts:
+        return [doc]
+    if isinstance(doc, dict):
+        if parts[0] in doc:
+            return _path_values(doc[parts[0]], parts[1:])
+        return []
+    if isinstance(doc, list):
+        values = []
+        if parts[0].isdigit() and int(parts[0]) < len(doc):
+            values.extend(_path_values(doc[int(parts[0])], parts[1:]))
+        for elt in doc:
+            if isinstance(elt, dict):
+                values.extend(_path_values(elt, parts))
+        return values
+    return []
+
+
+def _expanded(values):
+    """Values plus the elements of array values."""
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for elt in value:
+                yield elt
+
+
+def _get_path(doc, path, default=_MISSING):
+    for part in path.split('.'):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        elif isinstance(doc, list) and part.isdigit() and (
+                int(part) < len(doc)):
+            doc = doc[int(part)]
+        else:
+            return default
+    return doc
+
+
+def _set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(part)]
+        else:
+            doc = doc.setdefault(part, {})
+    if isinstance(doc, list):
+        doc[int(parts[-1])] = value
+    else:
+        doc[parts[-1]] = value
+
+
+def _unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part) if isinstance(doc, dict) else None
+        if doc is None:
+            return
+    if isinstance(doc, dict):
+        doc.pop(parts[-1], None)
+
+
+# Queries.
+
+def _compare(op):
+    def cmp(a, b):
+        if _type_rank(a) != _type_rank(b) or a is None:
+            return False
+        return op(a, b)
+    return cmp
+
+_COMPARISONS = {
+    '$gt': _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+    '$lt': _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+}
+
+
+def _regex(pattern, options=''):
+    if isinstance(pattern, Regex):
+        return pattern.try_compile()
+    if isinstance(pattern, _REGEX_TYPES):
+        return pattern
+    flags = 0
+    for opt in options:
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}[opt]
+    return re.compile(pattern, flags)
+
+
+def _equals(target):
+    """Predicate on a list of path values for equality with `target`."""
+    if isinstance(target, _REGEX_TYPES):
+        regex = _regex(target)
+        return lambda values: any(
+            isinstance(v, str) and regex.search(v) for v in _expanded(values))
+    if target is None:
+        return lambda values: (not values or
+                               any(v is None for v in _expanded(values)))
+    if isinstance(target, (dict, list)):
+        key = _hashable(target)
+        return lambda values: any(
+            _hashable(v) == key for v in _expanded(values))
+    return _in([target])
+
+
+def _in(targets):
+    """Predicate on a list of path values for membership in `targets`."""
+    special = (type(None), dict, list) + _REGEX_TYPES
+    tests = [_equals(t) for t in targets if isinstance(t, special)]
+    # Keep bools apart from equal numbers, as MongoDB does.
+    keys = {(isinstance(t, bool), t) for t in targets
+            if not isinstance(t, special)}
+
+    def test(values):
+        for v in values:
+            if isinstance(v, list):
+                if any((isinstance(e, bool), e) in keys for e in v
+                       if not isinstance(e, (dict, list))):
+                    return True
+            elif not isinstance(v, dict) and (isinstance(v, bool), v) in keys:
+                return True
+        return any(t(values) for t in tests)
+    return test
+
+
+def _compile_operator(op, arg, spec):
+    if op == '$eq':
+        return _equals(arg)
+    if op == '$ne':
+        eq = _equals(arg)
+        return lambda values: not eq(values)
+    if op in _COMPARISONS:
+        cmp = _COMPARISONS[op]
+        return lambda values: any(cmp(v, arg) for v in _expanded(values))
+    if op == '$in':
+        return _in(arg)
+    if op == '$nin':
+        test = _in(arg)
+        return lambda values: not test(values)
+    if op == '$exists':
+        return lambda values: bool(values) == bool(arg)
+    if op == '$all':
+        tests = [_equals(t) for t in arg]
+        return lambda values: bool(arg) and all(t(values) for t in tests)
+    if op == '$size':
+        return lambda values: any(
+            isinstance(v, list) and len(v) == arg for v in values)
+    if op == '$regex':
+        return _equals(_regex(arg, spec.get('$options', '')))
+    if op == '$options':
+        return lambda values: True
+    if op == '$not':
+        test = _compile_condition(arg)
+        return lambda values: not test(values)
+    if op == '$elemMatch':
+        if any(k.startswith('$') for k in arg):
+            test = _compile_condition(arg)
+            return lambda values: any(
+                isinstance(v, list) and any(test([e]) for e in v)
+                for v in values)
+        match = compile_filter(arg)
+        return lambda values: any(
+            isinstance(v, list) and any(
+                isinstance(e, dict) and match(e) for e in v)
+            for v in values)
+    raise OperationFailure("unknown operator: {}".format(op))
+
+
+def _is_operator_spec(spec):
+    return isinstance(spec, dict) and bool(spec) and all(
+        k.startswith('$') for k in spec)
+
+
+def _compile_condition(spec):
+    """Predicate on a list of path values for a field's query spec."""
+    if not _is_operator_spec(spec):
+        return _equals(spec)
+    tests = [_compile_operator(op, arg, spec) for op, arg in spec.items()]
+    if len(tests) == 1:
+        return tests[0]
+    return lambda values: all(t(values) for t in tests)
+
+
+def compile_filter(filt):
+    """Return a predicate on documents for the query `filt`."""
+    tests = []
+    for key, spec in (filt or {}).items():
+        if key in ('$and', '$or', '$nor'):
+            subtests = [compile_filter(f) for f in spec]
+            if key == '$and':
+                tests.append(lambda d, s=subtests: all(t(d) for t in s))
+            elif key == '$or':
+                tests.append(lambda d, s=subtests: any(t(d) for t in s))
+            else:
+                tests.append(lambda d, s=subtests: not any(t(d) for t in s))
+        elif key.startswith('$'):
+            raise OperationFailure("unknown top level operator: " + key)
+        elif '.' in key:
+            test = _compile_condition(spec)
+            parts = key.split('.')
+            tests.append(
+                lambda d, t=test, p=parts: t(_path_values(d, p)))
+        else:
+            test = _compile_condition(spec)
+            tests.append(
+                lambda d, t=test, k=key: t([d[k]] if k in d else []))
+    if len(tests) == 1:
+        return tests[0]
+
+    def match(doc):
+        for t in tests:
+            if not t(doc):
+                return False
+        return True
+    return match
+
+
+# Projection, sorting and updates.
+
+def _projection_tree(paths):
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is True:
+                break
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def _include(value, tree):
+    if tree is True:
+        return _copy(value)
+    if isinstance(value, list):
+        return [_include(v, tree) for v in value if isinstance(v, dict)]
+    if isinstance(value, dict):
+        return {k: _include(value[k], sub) for k, sub in tree.items()
+                if k in value}
+    return _MISSING
+
+
+def project(doc, projection):
+    """Return a projected copy of `doc`."""
+    if not projection:
+        return _copy(doc)
+    if not isinstance(projection, dict):
+        projection = {k: 1 for k in projection}
+    include_id = projection.get('_id', 1)
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    if any(fields.values()):
+        rv = _include(doc, _projection_tree(fields))
+        rv = {k: v for k, v in rv.items() if v is not _MISSING}
+        if include_id and '_id' in doc:
+            rv['_id'] = doc['_id']
+        return rv
+    rv = _copy(doc)
+    for path in fields:
+        _unset_path(rv, path)
+    if not include_id:
+        rv.pop('_id', None)
+    return rv
+
+
+def _normalize_sort(sort, direction=None):
+    if sort is None:
+        return []
+    if isinstance(sort, str):
+        return [(sort, direction or ASCENDING)]
+    if isinstance(sort, dict):
+        return list(sort.items())
+    return list(sort)
+
+
+def sort_docs(docs, sort):
+    for key, direction in reversed(_normalize_sort(sort)):
+        def sort_key(d, parts=key.split('.'), desc=direction < 0):
+            values = list(_expanded(_path_values(d, parts)))
+            if not values:
+                return _sort_key(None)
+            keys = [_sort_key(v) for v in values
+                    if not isinstance(v, list) or not v]
+            keys = keys or [_sort_key(values[0])]
+            return max(keys) if desc else min(keys)
+        docs.sort(key=sort_key, reverse=direction < 0)
+    return docs
+
+
+def _pull_test(cond):
+    if _is_operator_spec(cond):
+        test = _compile_condition(cond)
+        return lambda v: test([v])
+    if isinstance(cond, dict):
+        match = compile_filter(cond)
+        return lambda v: isinstance(v, dict) and match(v)
+    return lambda v: _equals(cond)([v]) and not isinstance(v, list)
+
+
+def apply_update(doc, update, inserting=False):
+    """Apply `update` to `doc` in place."""
+    if not any(k.startswith('$') for k in update):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(_copy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            current = _get_path(doc, path)
+            if op == '$set' or (op == '$setOnInsert' and inserting):
+                _set_path(doc, path, _copy(arg))
+            elif op == '$setOnInsert':
+                pass
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                _set_path(doc, path, (0 if current is _MISSING
+                                      else current) + arg)
+            elif op in ('$min', '$max'):
+                if current is _MISSING or (
+                        (_sort_key(arg) < _sort_key(current)) ==
+                        (op == '$min')):
+                    _set_path(doc, path, _copy(arg))
+            elif op in ('$push', '$addToSet'):
+                if current is _MISSING:
+                    current = []
+                    _set_path(doc, path, current)
+                if not isinstance(current, list):
+                    raise OperationFailure(
+                        "{} to non-array field {}".format(op, path))
+                each = (arg['$each'] if isinstance(arg, dict) and
+                        '$each' in arg else [arg])
+                for value in each:
+                    if op == '$push' or value not in current:
+                        current.append(_copy(value))
+            elif op == '$pull':
+                if isinstance(current, list):
+                    test = _pull_test(arg)
+                    current[:] = [v for v in current if not test(v)]
+            elif op == '$currentDate':
+                _set_path(doc, path, datetime.datetime.utcnow())
+            else:
+                raise OperationFailure("unknown update operator: " + op)
+
+
+def _upsert_base(filt):
+    doc = {}
+    for key, spec in (filt or {}).items():
+        if key.startswith('$'):
+            continue
+        if _is_operator_spec(spec):
+            if '$eq' in spec:
+                _set_path(doc, key, _copy(spec['$eq']))
+        elif not isinstance(spec, _REGEX_TYPES):
+            _set_path(doc, key, _copy(spec))
+    return doc
+
+
+# Command monitoring.
+
+_listeners = []
+_request_ids = itertools.count(1)
+
+
+def register(listener):
+    """Register a pymongo-style command listener for memory clients."""
+    _listeners.append(listener)
+
+
+def unregister(listener):
+    _listeners.remove(listener)
+
+
+_latency = {'seconds': 0}
+
+
+def set_latency(seconds):
+    """Delay each command by `seconds`, to simulate network round trips
+    in benchmarks."""
+    _latency['seconds'] = seconds
+
+
+class CommandEvent(object):
+    """A started, succeeded or failed command, as pymongo reports them."""
+    connection_id = ('memory', 0)
+
+    def __init__(self, command_name, collection, request_id,
+                 duration=None, reply=None, failure=None):
+        self.command_name = command_name
+        self.database_name = collection.database.name
+        self.command = {command_name: collection.name}
+        self.request_id = self.operation_id = request_id
+        if duration is not None:
+            self.duration_micros = int(duration * 1e6)
+        self.reply = reply
+        self.failure = failure
+
+
+def _reply(result):
+    if isinstance(result, list):
+        return {'cursor': {'firstBatch': result, 'id': 0}, 'ok': 1.0}
+    if isinstance(result, int):
+        return {'n': result, 'ok': 1.0}
+    return {'ok': 1.0}
+
+
+def _command(name):
+    """Decorate a method to publish command events to listeners."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if _latency['seconds']:
+                time.sleep(_latency['seconds'])
+            if not _listeners:
+                return method(self, *args, **kwargs)
+            coll = getattr(self, 'collection', self)
+            request_id = next(_request_ids)
+            event = CommandEvent(name, coll, request_id)
+            for listener in _listeners:
+                listener.started(event)
+            start = time.time()
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception as e:
+                event = CommandEvent(name, coll, request_id,
+                                     time.time() - start, failure=str(e))
+                for listener in _listeners:
+                    listener.failed(event)
+                raise
+            event = CommandEvent(name, coll, request_id,
+                                 time.time() - start, _reply(result))
+            for listener in _listeners:
+                listener.succeeded(event)
+            return result
+        return wrapper
+    return decorator
+
+
+# Collections.
+
+class MemoryCursor(object):
+    def __init__(self, collection, filt=None, projection=None, sort=None,
+                 skip=0, limit=0, **kwargs):
+        self.collection = collection
+        self._filter = filt or {}
+        self._projection = projection
+        self._sort = _normalize_sort(sort)
+        self._skip = skip
+        self._limit = abs(limit)
+        self._max_time_ms = kwargs.get('max_time_ms')
+        self._matched = None
+        self._results = None
+
+    def _matching(self):
+        """Matching stored documents, sorted. Computed once per cursor."""
+        if self._matched is None:
+            start = time.time()
+            matched = self.collection._find_docs(self._filter, self._sort)
+            if (self._max_time_ms and
+                    1e3 * (time.time() - start) > self._max_time_ms):
+                raise ExecutionTimeout("operation exceeded time limit", 50)
+            self._matched = matched
+        return self._matched
+
+    def _check_unstarted(self):
+        if self._results is not None:
+            raise InvalidOperation("cannot set options after executing query")
+
+    def sort(self, key_or_list, direction=None):
+        self._check_unstarted()
+        self._sort = _normalize_sort(key_or_list, direction)
+        self._matched = None
+        return self
+
+    def skip(self, skip):
+        self._check_unstarted()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check_unstarted()
+        self._limit = abs(limit)
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self._check_unstarted()
+        self._max_time_ms = max_time_ms
+        return self
+
+    @_command('count')
+    def count(self, with_limit_and_skip=False):
+        n = len(self._matching())
+        if with_limit_and_skip:
+            n = max(0, n - self._skip)
+            if self._limit:
+                n = min(n, self._limit)
+        return n
+
+    def explain(self):
+        field = self.collection._index_field_for(self._filter)
+        if field is None:
+            plan = {'stage': 'COLLSCAN', 'filter': self._filter}
+        else:
+            plan = {'stage': 'FETCH', 'inputStage': {
+                'stage': 'IXSCAN', 'keyPattern': {field: 1}}}
+        return {'queryPlanner': {'winningPlan': plan}}
+
+    def rewind(self):
+        self._matched = self._results = None
+        return self
+
+    def clone(self):
+        return MemoryCursor(self.collection, self._filter, self._projection,
+                            self._sort, self._skip, self._limit,
+                            max_time_ms=self._max_time_ms)
+
+    def close(self):
+        self._results = iter([])
+
+    def __iter__(self):
+        return self
+
+    @_command('find')
+    def _execute(self):
+        docs = self._matching()
+        end = self._skip + self._limit if self._limit else None
+        return [project(d, self._projection) for d in docs[self._skip:end]]
+
+    def __next__(self):
+        if self._results is None:
+            self._results = iter(self._execute())
+        return next(self._results)
+
+    next = __next__
+
+
+class MemoryCollection(object):
+    def __init__(self, database, name, capped_max=None):
+        self.database = database
+        self.name = name
+        self.full_name = '{}.{}'.format(database.name, name)
+        self.capped_max = capped_max
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._docs = OrderedDict()
+        self._indexes = {'_id_': {'key': [('_id', ASCENDING)]}}
+        self._hash = {}
+
+    def __getitem__(self, name):
+        return self.database[self.name + '.' + name]
+
+    def with_options(self, **kwargs):
+        return self
+
+    # Indexes
+
+    def create_index(self, keys, **kwargs):
+        keys = _normalize_sort(keys)
+        name = kwargs.get('name') or '_'.join(
+            '{}_{}'.format(k, d) for k, d in keys)
+        with self._lock:
+            info = {'key': keys}
+            info.update({k: v for k, v in kwargs.items() if k != 'name'})
+            self._indexes[name] = info
+            field = keys[0][0]
+            if field != '_id' and field not in self._hash:
+                self._hash[field] = {}
+                for _id, doc in self._docs.items():
+                    self._index_doc(field, _id, doc)
+        return name
+
+    def create_indexes(self, indexes):
+        return [self.create_index(i.document['key'].items(),
+                                  **{k: v for k, v in i.document.items()
+                                     if k != 'key'})
+                for i in indexes]
+
+    def index_information(self):
+        with self._lock:
+            return {name: dict(info) for name, info in self._indexes.items()}
+
+    def drop_index(self, name):
+        with self._lock:
+            del self._indexes[name]
+            fields = {info['key'][0][0] for info in self._indexes.values()}
+            for field in list(self._hash):
+                if field not in fields:
+                    del self._hash[field]
+
+    def _index_keys(self, field, doc):
+        values = _path_values(doc, field.split('.'))
+        if not values:
+            return {None}
+        return {_hashable(v) for v in _expanded(values)}
+
+    def _index_doc(self, field, _id, doc):
+        for key in self._index_keys(field, doc):
+            self._hash[field].setdefault(key, set()).add(_id)
+
+    def _unindex_doc(self, field, _id, doc):
+        for key in self._index_keys(field, doc):
+            ids = self._hash[field].get(key)
+            if ids is not None:
+                ids.discard(_id)
+                if not ids:
+                    del self._hash[field][key]
+
+    def _check_unique(self, doc, exclude_id=None):
+        for info in self._indexes.values():
+            if not info.get('unique'):
+                continue
+            field = info['key'][0][0]
+            for key in self._index_keys(field, doc):
+                if self._hash[field].get(key, set()) - {exclude_id}:
+                    raise DuplicateKeyError(
+                        "E11000 duplicate key error: {} {}".format(
+                            field, key))
+
+    def _index_field_for(self, filt):
+        """Return an indexed field the filter constrains, if any."""
+        for key, spec in (filt or {}).items():
+            if key != '_id' and key not in self._hash:
+                continue
+            if not isinstance(spec, dict) or set(spec) <= {'$eq', '$in'}:
+                return key
+        return None
+
+    # Reads
+
+    def _candidate_ids(self, filt):
+        candidates = None
+        for key, spec in (filt or {}).items():
+            if key != '_id' and key not in self._hash:
+                continue
+            if isinstance(spec, _REGEX_TYPES) or (
+                    isinstance(spec, dict) and not
+                    set(spec) <= {'$eq', '$in'}):
+                continue
+            if not isinstance(spec, dict):
+                targets = [spec]
+            else:
+                targets = list(spec.get('$in', []))
+                if '$eq' in spec:
+                    targets.append(spec['$eq'])
+            if any(isinstance(t, _REGEX_TYPES) for t in targets):
+                continue
+            ids = set()
+            for t in targets:
+                if key == '_id':
+                    if _hashable(t) in self._docs:
+                        ids.add(_hashable(t))
+                else:
+                    ids.update(self._hash[key].get(_hashable(t), ()))
+            candidates = ids if candidates is None else candidates & ids
+        return candidates
+
+    def _find_docs(self, filt, sort=None):
+        """Return stored (uncopied) documents matching `filt`, sorted."""
+        match = compile_filter(filt)
+        with self._lock:
+            candidates = self._candidate_ids(filt)
+            if candidates is None:
+                docs = [d for d in self._docs.values() if match(d)]
+            else:
+                docs = [d for _id, d in self._docs.items()
+                        if _id in candidates and match(d)]
+        return sort_docs(docs, sort) if sort else docs
+
+    def find(self, filter=None, projection=None, sort=None, skip=0,
+             limit=0, **kwargs):
+        return MemoryCursor(self, filter, projection, sort, skip, limit,
+                            max_time_ms=kwargs.get('max_time_ms'))
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in self.find(filter, projection, sort=sort, limit=1):
+            return doc
+        return None
+
+    @_command('count')
+    def count(self, filter=None, **kwargs):
+        return len(self._find_docs(filter))
+
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        return MemoryCursor(self, filter, skip=skip, limit=limit).count(True)
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._docs)
+
+    @_command('distinct')
+    def distinct(self, key, filter=None, **kwargs):
+        seen, values = set(), []
+        for doc in self._find_docs(filter):
+            for v in _expanded(_path_values(doc, key.split('.'))):
+                if isinstance(v, list) or _hashable(v) in seen:
+                    continue
+                seen.add(_hashable(v))
+                values.append(_copy(v))
+        return values
+
+    def aggregate(self, pipeline, **kwargs):
+        return iter(self._aggregate(pipeline))
+
+    @_command('aggregate')
+    def _aggregate(self, pipeline):
+        docs = [_copy(d) for d in self._find_docs({})]
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == '$match':
+                match = compile_filter(arg)
+                docs = [d for d in docs if match(d)]
+            elif op == '$project':
+                docs = [project(d, arg) for d in docs]
+            elif op == '$sort':
+                docs = sort_docs(docs, arg)
+            elif op == '$skip':
+                docs = docs[arg:]
+            elif op == '$limit':
+                docs = docs[:arg]
+            elif op == '$sample':
+                docs = random.sample(docs, min(arg['size'], len(docs)))
+            elif op == '$count':
+                docs = [{arg: len(docs)}] if docs else []
+            else:
+                raise OperationFailure("unsupported pipeline stage " + op)
+        return docs
+
+    # Writes
+
+    def _insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        _id = _hashable(doc['_id'])
+        stored = _copy(doc)
+        with self._lock:
+            if _id in self._docs:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error: _id {}".format(_id))
+            self._check_unique(stored)
+            self._docs[_id] = stored
+            for field in self._hash:
+                self._index_doc(field, _id, stored)
+            if self.capped_max and len(self._docs) > self.capped_max:
+                self._remove(next(iter(self._docs)))
+        return doc['_id']
+
+    def _remove(self, _id):
+        doc = self._docs.pop(_id)
+        for field in self._hash:
+            self._unindex_doc(field, _id, doc)
+
+    def _update_doc(self, doc, update):
+        _id = _hashable(doc['_id'])
+        new = _copy(doc)
+        apply_update(new, update)
+        if new == doc:
+            return False
+        if _hashable(new.get('_id')) != _id:
+            raise OperationFailure("the _id field cannot be changed")
+        self._check_unique(new, exclude_id=_id)
+        for field in self._hash:
+            self._unindex_doc(field, _id, doc)
+        self._docs[_id] = new
+        for field in self._hash:
+            self._index_doc(field, _id, new)
+        return True
+
+    def _update(self, filt, update, upsert=False, multi=False, sort=None):
+        """Update matching docs. Return (n matched, n modified, upserted
+        _id, the first matched document before and after update)."""
+        with self._lock:
+            docs = self._find_docs(filt, sort)
+            if not multi:
+                docs = docs[:1]
+            before = after = None
+            nmodified = 0
+            for doc in docs:
+                nmodified += self._update_doc(doc, update)
+                if before is None:
+                    before = doc
+                    after = self._docs[_hashable(doc['_id'])]
+            if docs or not upsert:
+                return len(docs), nmodified, None, before, after
+            new = _upsert_base(filt)
+            if any(k.startswith('$') for k in update):
+                apply_update(new, update, inserting=True)
+            else:
+                new = dict(_copy(update), **(
+                    {'_id': new['_id']} if '_id' in new else {}))
+            _id = self._insert(new)
+            return 0, 0, _id, None, self._docs[_hashable(_id)]
+
+    @_command('insert')
+    def insert_one(self, document, **kwargs):
+        return InsertOneResult(self._insert(document), True)
+
+    @_command('insert')
+    def insert_many(self, documents, ordered=True, **kwargs):
+        ids, errors = [], []
+        for doc in documents:
+            try:
+                ids.append(self._insert(doc))
+            except DuplicateKeyError as e:
+                if ordered:
+                    raise
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return InsertManyResult(ids, True)
+
+    def _update_result(self, nmatched, nmodified, upserted_id):
+        raw = {'n': nmatched or (1 if upserted_id is not None else 0),
+               'nModified': nmodified, 'ok': 1.0}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    @_command('update')
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return self._update_result(*self._update(filter, update, upsert)[:3])
+
+    @_command('update')
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return self._update_result(
+            *self._update(filter, update, upsert, multi=True)[:3])
+
+    @_command('update')
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        if any(k.startswith('$') for k in replacement):
+            raise ValueError("replacement can not include $ operators")
+        return self._update_result(
+            *self._update(filter, replacement, upsert)[:3])
+
+    def _delete(self, filt, multi=False, sort=None):
+        with self._lock:
+            docs = self._find_docs(filt, sort)
+            if not multi:
+                docs = docs[:1]
+            for doc in docs:
+                self._remove(_hashable(doc['_id']))
+            return docs
+
+    @_command('delete')
+    def delete_one(self, filter, **kwargs):
+        return DeleteResult({'n': len(self._delete(filter)), 'ok': 1.0}, True)
+
+    @_command('delete')
+    def delete_many(self, filter, **kwargs):
+        return DeleteResult(
+            {'n': len(self._delete(filter, multi=True)), 'ok': 1.0}, True)
+
+    @_command('findAndModify')
+    def find_one_and_delete(self, filter, projection=None, sort=None,
+                            **kwargs):
+        docs = self._delete(filter, sort=sort)
+        return project(docs[0], projection) if docs else None
+
+    @_command('findAndModify')
+    def find_one_and_update(self, filter, update, projection=None, sort=None,
+                            upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        _, _, _, before, after = self._update(filter, update, upsert,
+                                              sort=sort)
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return project(doc, projection) if doc is not None else None
+
+    def find_one_and_replace(self, filter, replacement, **kwargs):
+        if any(k.startswith('$') for k in replacement):
+            raise ValueError("replacement can not include $ operators")
+        return self.find_one_and_update(filter, replacement, **kwargs)
+
+    @_command('bulkWrite')
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                  'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        for i, op in enumerate(requests):
+            if isinstance(op, InsertOne):
+                self._insert(op._doc)
+                result['nInserted'] += 1
+            elif isinstance(op, (UpdateOne, UpdateMany, ReplaceOne)):
+                nmatched, nmodified, upserted_id, _, _ = self._update(
+                    op._filter, op._doc, op._upsert,
+                    multi=isinstance(op, UpdateMany))
+                result['nMatched'] += nmatched
+                result['nModified'] += nmodified
+                if upserted_id is not None:
+                    result['nUpserted'] += 1
+                    result['upserted'].append(
+                        {'index': i, '_id': upserted_id})
+            elif isinstance(op, (DeleteOne, DeleteMany)):
+                result['nRemoved'] += len(self._delete(
+                    op._filter, multi=isinstance(op, DeleteMany)))
+            else:
+                raise TypeError("{} is not a valid request".format(op))
+        return BulkWriteResult(result, True)
+
+    @_command('drop')
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+
+class MemoryDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    def create_collection(self, name, capped=False, max=None, **kwargs):
+        with self._lock:
+            if name in self.list_collection_names():
+                raise CollectionInvalid(
+                    "collection {} already exists".format(name))
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            coll = self._collections[name]
+            coll.capped_max = max if capped else None
+            return coll
+
+    def list_collection_names(self, **kwargs):
+        return [name for name, coll in self._collections.items()
+                if coll._docs or len(coll._indexes) > 1 or coll.capped_max]
+
+    collection_names = list_collection_names
+
+    def drop_collection(self, name):
+        # Handles stay usable after a drop, as with pymongo, so the
+        # collection is emptied in place.
+        with self._lock:
+            coll = self._collections.get(getattr(name, 'name', name))
+            if coll is not None:
+                with coll._lock:
+                    coll._clear()
+                    coll.capped_max = None
+
+    def command(self, command, *args, **kwargs):
+        if command in ('ping', 'ismaster', 'isMaster', 'hello'):
+            return {'ok': 1.0}
+        raise OperationFailure("unsupported command: {}".format(command))
+
+
+class MemoryClient(object):
+    """Client for the process-wide in-memory "server"."""
+    _databases = {}
+    _loaded = set()
+    _lock = threading.Lock()
+    # Held while loading a snapshot, so that other threads wait for it.
+    _load_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name, **kwargs):
+        return self[name]
+
+    def list_database_names(self):
+        return list(self._databases)
+
+    database_names = list_database_names
+
+    def drop_database(self, name):
+        with self._lock:
+            name = getattr(name, 'name', name)
+            self._databases.pop(name, None)
+            self._loaded.difference_update(
+                {(path, db) for path, db in self._loaded if db == name})
+
+    def server_info(self):
+        return {'version': 'memory', 'ok': 1.0}
+
+    def load_once(self, path, database):
+        """Load a snapshot file into `database`, once per process."""
+        from .snapshot import load_snapshot
+        with self._load_lock:
+            if (path, database) in self._loaded:
+                return
+            load_snapshot(path, self[database])
+            with self._lock:
+                self._loaded.add((path, database))
+
+    def close(self):
+        pass
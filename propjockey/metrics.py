@@ -0,0 +1,310 @@
+"""Counters, gauges and histograms in Prometheus text exposition format.
+
+A small registry, so that the hot path only takes a lock and bumps a
+number. Metrics are labelled by keyword arguments:
+
+    ROWS_SECONDS = REGISTRY.histogram(
+        'propjockey_rows_seconds', 'Time to serve /rows.',
+        ['sections', 'format'])
+    ROWS_SECONDS.observe(0.012, sections='active', format='html')
+
+Values computed at scrape time, such as cache sizes, come from
+`REGISTRY.callback` functions returning (labels, value) pairs.
+"""
+from __future__ import division
+
+from bisect import bisect_left
+import threading
+import time
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"')
+                         .replace('\n', r'\n'))
+        for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} expects labels {}, got {}".format(
+                self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def samples(self):
+        """Return a list of (name, labels, value) to expose."""
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, self._labels(k), v) for k, v in items]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts, then the sum of observed values.
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        rv = []
+        for key, counts in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for le, n in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += n
+                rv.append((self.name + '_bucket',
+                           labels + [('le', _format_value(float(le)))],
+                           cumulative))
+            rv.append((self.name + '_sum', labels, counts[-1]))
+            rv.append((self.name + '_count', labels, cumulative))
+        return rv
+
+
+class CallbackMetric(Metric):
+    """A metric whose samples come from calling `fn` at scrape time.
+
+    `fn` returns (labels dict, value) pairs.
+    """
+
+    def __init__(self, name, doc, kind, fn):
+        super(CallbackMetric, self).__init__(name, doc)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, sorted(labels.items()), value)
+                for labels, value in self.fn()]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(
+                        "metric {} already registered".format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._add(Counter(name, doc, labelnames))
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._add(Gauge(name, doc, labelnames))
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, doc, labelnames, buckets))
+
+    def callback(self, name, doc, kind, fn):
+        return self._add(CallbackMetric(name, doc, kind, fn))
+
+    def render(self, prefix=''):
+        """Metrics whose names start with `prefix`, in text format."""
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            if not name.startswith(prefix):
+                continue
+            samples = metric.samples()
+            lines.append('# HELP {} {}'.format(name, metric.doc))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample_name, labels, value in samples:
+                lines.append('{}{} {}'.format(
+                    sample_name, _format_labels(labels),
+                    _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class CacheStats(object):
+    """Expose hits, misses and size of named `LRUCache`s."""
+
+    def __init__(self, registry=REGISTRY):
+        self.caches = {}
+        for suffix, kind, attr, doc in [
+                ('hits_total', 'counter', 'hits', 'Cache hits.'),
+                ('misses_total', 'counter', 'misses', 'Cache misses.'),
+                ('items', 'gauge', '__len__', 'Items in cache.'),
+                ('bytes', 'gauge', 'nbytes', 'Estimated size of cache.')]:
+            registry.callback('propjockey_cache_' + suffix, doc, kind,
+                              self._collector(attr))
+
+    def _collector(self, attr):
+        def collect():
+            rv = []
+            for name, cache in sorted(self.caches.items()):
+                value = getattr(cache, attr)
+                rv.append(({'cache': name},
+                           value() if callable(value) else value))
+            return rv
+        return collect
+
+    def add(self, name, cache):
+        self.caches[name] = cache
+
+
+class AdmissionStats(object):
+    """Expose requests admitted, turned away and in flight per endpoint,
+    for `admission.Limiter`s."""
+
+    def __init__(self, registry=REGISTRY):
+        self.limiters = {}
+        for suffix, kind, attr, doc in [
+                ('admitted_total', 'counter', 'admitted',
+                 'Requests admitted.'),
+                ('rejected_total', 'counter', 'rejected',
+                 'Requests turned away with a full queue.'),
+                ('timed_out_total', 'counter', 'timed_out',
+                 'Requests turned away after waiting in the queue.'),
+                ('active', 'gauge', 'active', 'Requests being served.'),
+                ('waiting', 'gauge', 'waiting', 'Requests in the queue.')]:
+            registry.callback('propjockey_admission_' + suffix, doc, kind,
+                              self._collector(attr))
+
+    def _collector(self, attr):
+        def collect():
+            return [({'endpoint': name}, getattr(limiter, attr))
+                    for name, limiter in sorted(self.limiters.items())]
+        return collect
+
+    def add(self, endpoint, limiter):
+        self.limiters[endpoint] = limiter
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Track open and checked-out connections of pymongo pools."""
+
+    def __init__(self, registry=REGISTRY):
+        self.open = registry.gauge(
+            'propjockey_mongo_connections',
+            'Open connections to MongoDB.', ['address'])
+        self.checked_out = registry.gauge(
+            'propjockey_mongo_connections_checked_out',
+            'Connections in use.', ['address'])
+        self.checkout_failures = registry.counter(
+            'propjockey_mongo_checkout_failures_total',
+            'Failed connection checkouts.', ['address', 'reason'])
+
+    def _address(self, event):
+        return '{}:{}'.format(*event.address)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.open.inc(address=self._address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.open.inc(-1, address=self._address(event))
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures.inc(address=self._address(event),
+                                   reason=event.reason)
+
+    def connection_checked_out(self, event):
+        self.checked_out.inc(address=self._address(event))
+
+    def connection_checked_in(self, event):
+        self.checked_out.inc(-1, address=self._address(event))
+
+
+class CachedValue(object):
+    """Call `fn` at most once per `ttl` seconds."""
+
+    def __init__(self, fn, ttl):
+        self.fn = fn
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0
+
+    def __call__(self):
+        now = time.time()
+        if now >= self._expires:
+            self._value = self.fn()
+            self._expires = now + self.ttl
+        return self._value
@@ -1,39 +1,90 @@
+"""Notify requesters, and staff, of entries that gained the property.
+
+Run from cron as `propjockey-notify` (or `python -m propjockey.notify`),
+with `PROPJOCKEY_SETTINGS` set. Only the settings, pymongo and the
+mailer are loaded, not the web app.
+"""
+import os
 import time
 
+from .bus import COMPLETED, InvalidationBus
+from .idsets import find_in, update_in
 from .mailers import MAILERS
-from .propjockey import connect_collections, econf, vconf, app
+from .metrics import REGISTRY
+from .settings import load_config
+from .util import connect_collections
+
+MESSAGES = REGISTRY.counter(
+    'propjockey_notify_messages_total',
+    'Notification emails sent, by recipient and delivery success.',
+    ['to', 'delivered'])
+LAST_RUN = REGISTRY.gauge(
+    'propjockey_notify_last_run_timestamp_seconds',
+    'When notify last finished.')
+RUN_SECONDS = REGISTRY.gauge(
+    'propjockey_notify_run_seconds', 'Duration of the last notify run.')
+
+
+def delivered(response):
+    return hasattr(response, 'status_code') and response.status_code == 200
+
+
+def backlog_filter(vconf):
+    """Filter for completed votes whose requesters are not notified."""
+    filt = vconf['filter_completed'].copy()
+    filt.update({vconf['requesters_notified']: {'$ne': True}})
+    return filt
+
 
+def write_textfile(path):
+    """Write notify metrics for e.g. node_exporter's textfile collector."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.render(prefix='propjockey_notify_'))
+    os.rename(tmp, path)
 
-def notify():
-    nconf = app.config['NOTIFY']
+
+def notify(config=None):
+    """Notify with `config`, by default loaded with `load_config`."""
+    start = time.time()
+    if config is None:
+        config = load_config()
+    econf, vconf = config['ENTRIES'], config['VOTES']
+    nconf = config['NOTIFY']
     Mailer = MAILERS[nconf['MAILER']]
     mailer_config = None
     if nconf['MAILER'] == 'mailgun':
-        mailer_config = app.config['MAILGUN']
+        mailer_config = config['MAILGUN']
     mailer = Mailer(mailer_config)
-    db = connect_collections()
+    db = connect_collections(config['CLIENTS'])
     vcoll = db.votes
     ecoll = db.entries
     responses = []
 
-    requests_pending = vcoll.find(vconf['filter_active'])
-    for r in requests_pending:
-        eid = r[vconf['entry_id']]
-        filt = econf['has_property'].copy()
-        filt.update({econf['e_id']: eid})
-        entry = ecoll.find_one(filt)
-        if entry:
-            vcoll.update_one({'_id': r['_id']},
-                             {'$set': vconf['filter_completed']})
+    # Mark as completed, in bulk, pending requests whose entries now
+    # have the property.
+    requests_pending = list(vcoll.find(vconf['filter_active'],
+                                       {vconf['entry_id']: 1}))
+    eids_done = {e[econf['e_id']] for e in find_in(
+        ecoll, econf['has_property'], econf['e_id'],
+        [r[vconf['entry_id']] for r in requests_pending],
+        {econf['e_id']: 1, '_id': 0})}
+    ids_done = [r['_id'] for r in requests_pending
+                if r[vconf['entry_id']] in eids_done]
+    if ids_done:
+        update_in(vcoll, '_id', ids_done,
+                  {'$set': vconf['filter_completed']})
+        bus = InvalidationBus.from_config(config)
+        if bus is not None:
+            bus.publish(COMPLETED, sorted(eids_done))
 
-    filt_notify = vconf['filter_completed'].copy()
-    filt_notify.update({vconf['requesters_notified']: {'$ne': True}})
-    requests_needing_notification = vcoll.find(filt_notify)
+    requests_needing_notification = vcoll.find(backlog_filter(vconf))
 
+    # Throttle to mitigate delivery failure to e.g. @qq.com emails.
+    throttle = nconf.get('throttle_seconds', 5)
     requests_with_notification_sent = []
     for r in requests_needing_notification:
-        # Throttle to mitigate delivery failure to e.g. @qq.com emails.
-        time.sleep(5)
+        time.sleep(throttle)
         eid = r[vconf['entry_id']]
         response = mailer.send({
             "to": r[vconf['requesters']],
@@ -44,7 +95,9 @@ def notify():
             "use_bcc": True,
             "to_for_bcc": nconf['to_for_bcc'],
         })
-        if hasattr(response, 'status_code') and response.status_code == 200:
+        MESSAGES.inc(to='requesters',
+                     delivered=str(delivered(response)).lower())
+        if delivered(response):
             print("Sent notification about {} to {} requesters.".format(
                 eid, len(r[vconf['requesters']])))
             vcoll.update_one({'_id': r['_id']},
@@ -74,14 +127,23 @@ def notify():
             "from": nconf['from'],
             "use_bcc": False,
         })
-        if hasattr(response, 'status_code') and response.status_code == 200:
+        MESSAGES.inc(to='staff', delivered=str(delivered(response)).lower())
+        if delivered(response):
             print("Sent summary to staff. {} entries done.".format(n_entries))
         responses.append(response)
     else:
         print("No notifications required for votes collection {}".format(
             vcoll))
 
+    LAST_RUN.set(time.time())
+    RUN_SECONDS.set(time.time() - start)
+    if nconf.get('metrics_textfile'):
+        write_textfile(nconf['metrics_textfile'])
     return responses
 
-if __name__ == "__main__":
+def main():
     notify()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compute likely next pages in the background.
+
+After serving a page of rows, the app submits the computation of the
+next page to a small thread pool. Results are kept for a short time,
+keyed by the normalized request parameters and user, and are dropped
+whenever the vote version changes, so a page computed before a vote is
+never served after it. A request for a page that is being prefetched
+waits for it rather than computing it again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """Run page computations in up to `workers` threads.
+
+    At most `max_pending` computations are queued or running; further
+    submissions are ignored. `cache_kwargs` bound the `LRUCache` of
+    results.
+    """
+
+    def __init__(self, version, workers=2, max_pending=8, **cache_kwargs):
+        self.version = version
+        self.max_pending = max_pending
+        self.cache = LRUCache(**cache_kwargs)
+        self.submitted = self.served = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+        version.on_change(self.cache.clear)
+
+    def get(self, key):
+        """Return the computed value for `key`, or None."""
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            future.result()
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != self.version.value:
+            return None
+        self.served += 1
+        return entry[1]
+
+    def submit(self, key, fn):
+        """Compute `fn()` for `key` in the background, unless known.
+
+        Return the future, or None if the submission was ignored.
+        """
+        with self._lock:
+            if (key in self._pending or
+                    len(self._pending) >= self.max_pending or
+                    self.cache.get(key) is not None):
+                return None
+            self.submitted += 1
+            future = self._pending[key] = self._executor.submit(
+                self._run, key, fn, self.version.value)
+        return future
+
+    def _run(self, key, fn, version):
+        try:
+            value = fn()
+            if self.version.value == version:
+                self.cache.set(key, (version, value))
+        except Exception:
+            logger.exception("Prefetch of %s failed", key)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,216 @@
+"""Profile single requests on demand.
+
+Staff users, listed by email in `PROFILER['staff']`, can add `profile=1`
+to any URL. The request is then traced with `sys.setprofile`, and the
+response is replaced by an attachment with the call tree, the time of
+each database command, and the total database time. Work the request
+hands to pool threads, e.g. through a `RequestExecutor`, gets call trees
+of its own, if wrapped with `trace_in_thread`. Add `profile_format=json`
+for JSON rather than HTML. Other requests only pay for checking the
+query string.
+"""
+from __future__ import division
+
+import json
+import os
+import sys
+import threading
+import time
+
+from markupsafe import escape
+
+
+class Node(object):
+    __slots__ = ('name', 'calls', 'total', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.children = {}
+
+    def to_dict(self, min_seconds=0):
+        children = sorted(self.children.values(), key=lambda n: -n.total)
+        return {
+            'name': self.name,
+            'calls': self.calls,
+            'total_ms': round(1e3 * self.total, 3),
+            'self_ms': round(1e3 * (self.total - sum(
+                c.total for c in children)), 3),
+            'children': [c.to_dict(min_seconds) for c in children
+                         if c.total >= min_seconds],
+        }
+
+
+def _label(frame, event, arg):
+    if event == 'c_call':
+        module = getattr(arg, '__module__', None) or ''
+        return '{}.{}'.format(module, arg.__name__) if module \
+            else arg.__name__
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class CallTree(object):
+    """Deterministic call tree of the code run by one thread."""
+
+    def __init__(self, name):
+        self.root = Node(name)
+        self.threads = []
+        self._stack = []
+        self._lock = threading.Lock()
+
+    def add_thread(self, name):
+        """Return a new tree for code run by another thread."""
+        tree = CallTree(name)
+        with self._lock:
+            self.threads.append(tree)
+        return tree
+
+    def _profile(self, frame, event, arg):
+        if event in ('call', 'c_call'):
+            parent = self._stack[-1][0]
+            key = _label(frame, event, arg)
+            node = parent.children.get(key)
+            if node is None:
+                node = parent.children[key] = Node(key)
+            self._stack.append((node, time.time()))
+        elif len(self._stack) > 1:
+            # 'return', 'c_return' and 'c_exception'.
+            node, start = self._stack.pop()
+            node.calls += 1
+            node.total += time.time() - start
+
+    def start(self):
+        self._stack = [(self.root, time.time())]
+        sys.setprofile(self._profile)
+
+    def stop(self):
+        sys.setprofile(None)
+        while len(self._stack) > 1:
+            node, start = self._stack.pop()
+            node.total += time.time() - start
+        self.root.calls = 1
+        self.root.total = time.time() - self._stack[0][1]
+
+
+def trace_in_thread(fn, tree):
+    """Wrap `fn` to be traced, in whichever thread runs it, by a tree
+    added to the `threads` of `tree`."""
+    def run(*args, **kwargs):
+        thread_tree = tree.add_thread('{} in {}'.format(
+            getattr(fn, '__name__', 'function'),
+            threading.current_thread().name))
+        thread_tree.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            thread_tree.stop()
+    return run
+
+
+def _html_node(node, total_ms):
+    pct = 100 * node['total_ms'] / total_ms if total_ms else 0
+    summary = '{:.2f} ms ({:.1f}%, self {:.2f} ms, {} calls) {}'.format(
+        node['total_ms'], pct, node['self_ms'], node['calls'],
+        escape(node['name']))
+    if not node['children']:
+        return '<li>{}</li>'.format(summary)
+    return '<li><details{}><summary>{}</summary><ul>{}</ul></details></li>'\
+        .format(' open' if pct >= 5 else '', summary,
+                ''.join(_html_node(c, total_ms) for c in node['children']))
+
+
+def render_html(report):
+    mongo = report['mongo']
+    rows = ''.join(
+        '<tr><td>{}</td><td>{}</td><td>{:.3f}</td><td>{}</td></tr>'.format(
+            escape(c['command']), escape(str(c['collection'])),
+            c['ms'], c['ndocs'])
+        for c in mongo['commands'])
+    return (
+        '<!doctype html><html><head><meta charset="utf-8">'
+        '<title>Profile of {path}</title></head><body>'
+        '<h1>{method} {path}</h1>'
+        '<p>Total {total:.2f} ms, of which {mongo_ms:.2f} ms in {n} '
+        'database commands.{streamed}</p>'
+        '<h2>Database commands</h2><table><tr><th>command</th>'
+        '<th>collection</th><th>ms</th><th>docs</th></tr>{rows}</table>'
+        '<h2>Call tree</h2><ul>{tree}</ul>'
+        '<h2>Pool threads</h2><ul>{threads}</ul></body></html>').format(
+            method=escape(report['method']), path=escape(report['url']),
+            total=report['total_ms'], mongo_ms=mongo['mongo_ms'],
+            n=mongo['ncommands'], rows=rows,
+            streamed='' if report['body_rendered'] else
+            ' The streamed response body is not included.',
+            tree=_html_node(report['tree'], report['total_ms']),
+            threads=''.join(_html_node(t, report['total_ms'])
+                            for t in report['threads']))
+
+
+def profile_app(app, recorder):
+    """Profile requests of staff users that ask for it."""
+    from flask import g, request, session
+
+    def wants_profile():
+        staff = app.config.get('PROFILER', {}).get('staff', ())
+        return session.get('user') in staff
+
+    @app.before_request
+    def start_profile():
+        if request.args.get('profile') != '1' or not wants_profile():
+            return
+        g.profile_recording = recorder.start('profile')
+        g.profile_tree = CallTree(request.endpoint or request.path)
+        g.profile_tree.start()
+
+    @app.after_request
+    def finish_profile(response):
+        tree = g.pop('profile_tree', None)
+        if tree is None:
+            return response
+        # Include the rendering of streamed responses, but not of event
+        # streams or files, which could take as long as they are open.
+        streamed = response.direct_passthrough or \
+            response.mimetype == 'text/event-stream'
+        if not streamed:
+            response.get_data()
+        # Replaced, the response would not be closed by the server.
+        response.close()
+        tree.stop()
+        rec = recorder.stop(g.pop('profile_recording'))
+        summary = rec.summary()
+        summary['commands'] = [
+            {'command': c[0], 'collection': c[1], 'ms': c[2], 'ndocs': c[3]}
+            for c in rec.commands]
+        min_ms = app.config.get('PROFILER', {}).get('min_ms', 0.05)
+        report = {
+            'method': request.method,
+            'url': request.full_path,
+            'status': response.status_code,
+            'body_rendered': not streamed,
+            'total_ms': round(1e3 * tree.root.total, 3),
+            'mongo': summary,
+            'tree': tree.root.to_dict(min_ms / 1e3),
+            'threads': [t.root.to_dict(min_ms / 1e3) for t in tree.threads],
+        }
+        fmt = 'json' if request.args.get('profile_format') == 'json' \
+            else 'html'
+        if fmt == 'json':
+            body, mimetype = json.dumps(report), 'application/json'
+        else:
+            body, mimetype = render_html(report), 'text/html'
+        profiled = app.response_class(body, mimetype=mimetype)
+        profiled.headers['Content-Disposition'] = \
+            'attachment; filename=profile-{}.{}'.format(
+                request.endpoint or 'request', fmt)
+        return profiled
+
+    @app.teardown_request
+    def stop_profile(exc=None):
+        tree = g.pop('profile_tree', None)
+        if tree is not None:
+            tree.stop()
+            recorder.stop(g.pop('profile_recording'))
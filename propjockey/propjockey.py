@@ -1,45 +1,151 @@
 from __future__ import absolute_import
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import hmac
+import logging
+import math
 from operator import itemgetter
 from functools import wraps
+import os
+import threading
+import time
+from urllib.parse import urlencode
 
+import click
 from flask import Flask, session, redirect, url_for, request
-from flask import g, jsonify, render_template, flash, abort
-from pymongo import ASCENDING, DESCENDING
+from flask import g, jsonify, render_template, flash, abort, Response
+from flask import copy_current_request_context, get_flashed_messages
+from flask import stream_with_context
+from markupsafe import Markup, escape
+from pymongo import ASCENDING, DESCENDING, monitoring
+from pymongo.errors import ExecutionTimeout
 from toolz import memoize, merge
-
-from .util import Bunch, get_collection, mongoconnect
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from . import accesslog, bus, idsets, metrics
+from .admission import Limiter
+from .cache import EntryCache, LRUCache, Version
+from .events import EventHub
+from .executor import RequestExecutor
+from .filtercache import FilterCache
+from .filtercache import normalize as normalize_filter
+from .indexes import check_query_plans, ensure_indexes
+from .instrument import QueryRecorder, instrument_app
+from .leaderboard import Leaderboard, build_rows, compare, publish
+from .notify import backlog_filter
+from .instrument import register as register_recorder
+from .prefetch import Prefetcher
+from .ratelimit import RateLimiter
+from .profiling import profile_app, trace_in_thread
+from .ranking import ActiveRanking
+from .ranking import available as ranking_available
+from .snapshot import build_snapshot, dump_snapshot, load_snapshot
+from .synthetic import generate
+from .settings import apply_test_clients, load_settings
+from .util import Bunch, ProcessCollection
+from .util import connect_collections as connect_clients
+from .util import anonymize_requesters
+from .workflows import WorkflowIdIndex
 from passwordless import Passwordless
 
 
 app = Flask(__name__)
 
-app.config.from_envvar('PROPJOCKEY_SETTINGS', silent=True)
+app.config.update(load_settings())
+
+if app.config.get('PROXY_FIX'):
+    # `request.remote_addr` is then the client's, as forwarded by the
+    # trusted proxies, for the /metrics allowlist and rate limits.
+    app.wsgi_app = ProxyFix(app.wsgi_app, **app.config['PROXY_FIX'])
 
 econf = app.config['ENTRIES']
 vconf = app.config['VOTES']
 wconf = app.config['WORKFLOWS']
 pconf = app.config['PASSWORDLESS']
 
+
+def set_test_config():
+    apply_test_clients(app.config)
+
 if app.config.get('USE_TEST_CLIENTS'):
     set_test_config()
-passwdless = Passwordless(app)
 
+# Listeners only see the commands of clients created after them, so
+# they are registered before any client, such as the token store's.
+query_recorder = QueryRecorder(**app.config.get('QUERY_LOG', {}))
+register_recorder(query_recorder)
+pool_stats = metrics.PoolStats()
+monitoring.register(pool_stats)
 
-def set_test_config():
-    def get_workflow_ids(eids, coll):
-        rv = sorted(coll.find({'eid': {'$in': eids}}), key=itemgetter('eid'))
-        return [d['wid'] for d in rv]
+passwdless = Passwordless(app)
 
-    app.config['CLIENTS'] = {
-        k: {'database': 'propjockey_test', 'collection': k}
-        for k in ['votes', 'entries', 'workflows']
-    }
-    app.config['PASSWORDLESS']['tokenstore_client'] = {
-        'database': 'propjockey_test',
-        'collection': 'auth_tokens'
-    }
-    wconf['get_workflow_ids'] = get_workflow_ids
+instrument_app(app, query_recorder)
+profile_app(app, query_recorder)
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    'propjockey_request_seconds', 'Time to serve a request, by endpoint.',
+    ['endpoint'])
+ROWS_SECONDS = metrics.REGISTRY.histogram(
+    'propjockey_rows_seconds',
+    'Time to serve /rows, by sections visited and format.',
+    ['sections', 'format'])
+VOTE_SECONDS = metrics.REGISTRY.histogram(
+    'propjockey_vote_seconds', 'Time to handle a vote, by outcome.',
+    ['how', 'category'])
+cache_stats = metrics.CacheStats()
+
+# Bumped on every change to votes, to drop data computed before it.
+vote_version = Version()
+prefetcher = None
+if app.config.get('PREFETCH', {}).get('enabled'):
+    prefetcher = Prefetcher(vote_version, **{
+        k: v for k, v in app.config['PREFETCH'].items() if k != 'enabled'})
+    cache_stats.add('prefetched_pages', prefetcher.cache)
+filter_cache = None
+if app.config.get('FILTER_CACHE', {}).get('enabled'):
+    filter_cache = FilterCache(econf, **{
+        k: v for k, v in app.config['FILTER_CACHE'].items()
+        if k != 'enabled'})
+    cache_stats.add('filters', filter_cache.cache)
+admission_stats = metrics.AdmissionStats()
+limiters = {}
+for endpoint, limits in app.config.get('ADMISSION', {}).get(
+        'endpoints', {}).items():
+    limiters[endpoint] = Limiter(**limits)
+    admission_stats.add(endpoint, limiters[endpoint])
+
+
+def unavailable(message):
+    """A 503 response asking the client to retry after a while."""
+    response = jsonify(error=message)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(
+        app.config.get('ADMISSION', {}).get('retry_after', 1))
+    return response
+
+
+@app.before_request
+def admit_request():
+    """Turn requests away when their endpoint is at its limit."""
+    limiter = limiters.get(request.endpoint)
+    if limiter is None:
+        return None
+    if not limiter.acquire():
+        return unavailable("too many requests, please retry")
+    g.admission = limiter
+
+
+@app.teardown_request
+def release_admission(exc=None):
+    limiter = g.pop('admission', None)
+    if limiter is not None:
+        limiter.release()
+
+
+@app.errorhandler(ExecutionTimeout)
+def query_timed_out(e):
+    return unavailable("query took too long, please retry")
 
 
 def login_required(f):
@@ -59,24 +165,168 @@ def index():
 
 def connect_collections():
     """Connects to and provides handles to the MongoDB collections."""
-    clients_config = app.config['CLIENTS']
-    b = Bunch()
-    b.clients = {name: mongoconnect(clients_config[name])
-                 for name in clients_config}
-    for name in clients_config:
-        setattr(b, name, get_collection(b.clients, clients_config, name))
-    return b
+    return connect_clients(app.config['CLIENTS'])
+
+
+# Clients are shared by the threads of a process, and opened anew in a
+# forked worker or when the `CLIENTS` setting changes.
+_shared = {'pid': None, 'config': None, 'bunch': None}
+_shared_lock = threading.Lock()
+
+
+def shared_collections():
+    """Return collections on the clients of this process."""
+    with _shared_lock:
+        if (_shared['pid'] != os.getpid() or
+                _shared['config'] != app.config['CLIENTS']):
+            bunch = connect_collections()
+            _shared.update(pid=os.getpid(), bunch=bunch,
+                           config=copy.deepcopy(app.config['CLIENTS']))
+        return _shared['bunch']
+
+
+def close_shared_clients():
+    """Close the clients of this process, e.g. before forking workers,
+    which must not share their sockets. Those of the token store,
+    invalidation bus and rate limits are closed too."""
+    with _shared_lock:
+        bunch = _shared['bunch']
+        _shared.update(pid=None, config=None, bunch=None)
+    if bunch is not None:
+        for client in bunch.clients.values():
+            client.close()
+    ProcessCollection.close_all()
 
 
 def get_collections():
-    """Opens new client connections if there are none yet for the
-    current application context.
-    """
+    """Provides the collections for the current application context."""
     if not hasattr(g, 'bunch'):
-        g.bunch = connect_collections()
+        g.bunch = shared_collections()
     return g.bunch
 
 
+parallel_pool = None
+if app.config.get('PARALLEL', {}).get('workers'):
+    parallel_pool = ThreadPoolExecutor(
+        max_workers=app.config['PARALLEL']['workers'])
+
+
+def in_request_context(fn):
+    """Wrap `fn` to run in the current request's context from another
+    thread, with the same collections and query recordings, and traced
+    if the request is profiled."""
+    bunch = get_collections()
+    recordings = query_recorder.current()
+    tree = g.get('profile_tree')
+    if tree is not None:
+        fn = trace_in_thread(fn, tree)
+
+    @copy_current_request_context
+    def run(*args, **kwargs):
+        g.bunch = bunch
+        with query_recorder.attached(recordings):
+            return fn(*args, **kwargs)
+    return run
+
+
+def request_executor():
+    """Return the executor for independent queries of this request."""
+    if 'executor' not in g:
+        g.executor = RequestExecutor(parallel_pool, wrap=in_request_context)
+    return g.executor
+
+
+@app.teardown_request
+def close_request_executor(exc=None):
+    executor = g.pop('executor', None)
+    if executor is not None:
+        executor.close()
+
+
+_query_plans = {'checked': False}
+
+
+@app.before_request
+def check_query_plans_once():
+    """Warn once per process about hot queries lacking an index.
+
+    Enabled by the `CHECK_QUERY_PLANS` setting.
+    """
+    if _query_plans['checked'] or not app.config.get('CHECK_QUERY_PLANS'):
+        return
+    _query_plans['checked'] = True
+    check_query_plans(get_collections(), econf, vconf)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def observe_request(response):
+    start = g.pop('request_start', None)
+    if start is None or request.endpoint is None:
+        return response
+    seconds = time.time() - start
+    REQUEST_SECONDS.observe(seconds, endpoint=request.endpoint)
+    if request.endpoint == 'rows':
+        ROWS_SECONDS.observe(
+            seconds, sections='>'.join(g.get('rows_sections', [])),
+            format=('html' if request.args.get('format') == 'html'
+                    else 'json'))
+    elif request.endpoint == 'vote' and 'vote_category' in g:
+        how = request.form.get('how')
+        VOTE_SECONDS.observe(seconds, how=how if how in ('up', 'down')
+                             else 'other', category=g.vote_category)
+    return response
+
+
+def alias_key():
+    """Key for requester aliases, stable across runs."""
+    return app.config.get('ALIAS_KEY', app.config['APP_SECRET_KEY'])
+
+
+access_recorder = None
+if app.config.get('ACCESS_LOG', {}).get('path'):
+    access_recorder = accesslog.AccessRecorder(
+        app.config['ACCESS_LOG']['path'], alias_key(),
+        sample=app.config['ACCESS_LOG'].get('sample', 1.0))
+
+
+@app.after_request
+def record_access(response):
+    """Log /rows and /vote requests for replay, if `ACCESS_LOG` is set."""
+    start = g.get('request_start')
+    if (access_recorder is None or start is None or
+            request.endpoint not in ('rows', 'vote')):
+        return response
+    if request.endpoint == 'rows':
+        params = accesslog.rows_params(request.args, econf['rows_per_page'])
+    else:
+        params = accesslog.vote_params(request.form)
+    rec = g.get('query_recording')
+    access_recorder.record(
+        start, request.endpoint, session.get('user'), params,
+        response.status_code, time.time() - start,
+        len(rec.commands) if rec is not None else None)
+    return response
+
+
+@app.route('/metrics')
+def metrics_view():
+    """Metrics in Prometheus text format, for clients allowed by the
+    `METRICS` setting."""
+    mconf = app.config.get('METRICS', {})
+    token = mconf.get('token')
+    auth = request.headers.get('Authorization', '')
+    if not ((token and hmac.compare_digest(auth, 'Bearer ' + token)) or
+            request.remote_addr in mconf.get('allow_ips', [])):
+        abort(403)
+    return Response(metrics.REGISTRY.render(),
+                    content_type=metrics.CONTENT_TYPE)
+
+
 def tablerow_data(votedoc_entry_wid, prop_missing=True):
     votedoc, entry, w_id = votedoc_entry_wid
     entry['description'] = econf['describe_entry'](
@@ -95,7 +345,7 @@ def tablerow_data(votedoc_entry_wid, prop_missing=True):
 
     if votedoc:
         votedoc['nvotes'] = votedoc[vconf['nvotes']]
-        if 'user' in session:
+        if 'user' in session and 'votedfor' not in votedoc:
             votedoc['votedfor'] = vconf['user_voted'](
                 session['user'], prefilter=False, votes_doc=votedoc)
         for k, _ in list(votedoc.items()):
@@ -107,6 +357,23 @@ def tablerow_data(votedoc_entry_wid, prop_missing=True):
     return merge(entry, votedoc or {})
 
 
+def max_time_ms(collection):
+    """Time limit for queries on 'votes' or 'entries', from the
+    `QUERY_TIME_LIMITS` setting, or None."""
+    return app.config.get('QUERY_TIME_LIMITS', {}).get(collection + '_ms')
+
+
+def idset_options(collection, nin=False):
+    """Keyword arguments of `idsets` queries on `collection`, from the
+    `ID_SETS` setting."""
+    sconf = app.config.get('ID_SETS', {})
+    options = {'chunk_size': sconf.get('chunk_size', idsets.CHUNK_SIZE),
+               'max_time_ms': max_time_ms(collection)}
+    if nin:
+        options['max_nin'] = sconf.get('max_nin', idsets.MAX_NIN)
+    return options
+
+
 def find_votes(completed=False, user_only=False, sortdir=DESCENDING):
     db = get_collections()
     filt = vconf['filter_completed' if completed else 'filter_active'].copy()
@@ -115,26 +382,32 @@ def find_votes(completed=False, user_only=False, sortdir=DESCENDING):
     return db.votes.find(
         filt,
         votedoc_projection(),
-        sort=[(vconf['nvotes'], sortdir)])
+        sort=[(vconf['nvotes'], sortdir)],
+        max_time_ms=max_time_ms('votes'))
 
 
-def get_workflow_ids(entry_ids):
+def get_workflow_ids(entry_ids, db=None):
     """Return list of workflows ids corresponding to given ids in order.
 
     If no workflow corresponds to a given entry id, yield `None`.
     """
-    db = get_collections()
+    db = db or get_collections()
+    index = workflow_id_index(db)
+    if index:
+        return index.lookup(entry_ids, db.workflows)
     return wconf['get_workflow_ids'](entry_ids, db.workflows)
 
 
-def entries_by_filter(entry_filter, sort=None, skip=0, limit=0):
-    db = get_collections()
-    return db.entries.find(
-        entry_filter,
-        entry_projection(),
-        sort=sort,
-        skip=skip,
-        limit=limit)
+def workflow_id_index(db):
+    """Return the local workflow-id index if configured, else None.
+
+    The index lives in the votes database, in the collection named by
+    the `index_collection` WORKFLOWS setting.
+    """
+    if not wconf.get('index_collection'):
+        return None
+    coll = db.votes.database[wconf['index_collection']]
+    return WorkflowIdIndex(coll, wconf)
 
 
 def order_by_idlist(entries, entry_ids):
@@ -151,6 +424,43 @@ def order_by_idlist(entries, entry_ids):
     return [emap[e_id] for e_id in entry_ids_present]
 
 
+description_html_cache = LRUCache(**app.config.get('FRAGMENT_CACHE', {}))
+row_fragment_cache = LRUCache(**app.config.get('FRAGMENT_CACHE', {}))
+cache_stats.add('description_html', description_html_cache)
+cache_stats.add('row_fragments', row_fragment_cache)
+
+# Stands in for the per-request redirect path in cached row fragments.
+REDIRECT_PATH_MARKER = '__redirect_path__'
+
+
+def description_html(description):
+    html = description_html_cache.get(description)
+    if html is None:
+        html = econf['describe_entry_html'](description)
+        description_html_cache.set(description, html)
+    return html
+
+
+def row_fragment(row):
+    """Return the table row markup for `row`, from cache if possible."""
+    key = (row['id'], row.get('nvotes'), row.get('votedfor'),
+           row.get('p_link'), row.get('w_link'), row['extrasort'],
+           row['description'])
+    html = row_fragment_cache.get(key)
+    if html is None:
+        html = app.jinja_env.get_template('_row.html').render(
+            row=dict(row, description=description_html(row['description'])),
+            redirect_path=REDIRECT_PATH_MARKER)
+        row_fragment_cache.set(key, html)
+    return html
+
+
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
+
+
 def format_rows(data):
     fmt = request.args.get('format', 'json')
     if fmt == 'json':
@@ -162,16 +472,21 @@ def format_rows(data):
     params = _rows_params()
     params.update({'filter': request.args.get('filter')})
     extrasort_label = econf['extrasort']['label']
-    rows = data['rows']
-    for r in rows:
-        r['description'] = econf['describe_entry_html'](r['description'])
-    return render_template(
+    redirect_path = str(escape(request.full_path))
+    row_fragments = [
+        Markup(row_fragment(r).replace(REDIRECT_PATH_MARKER, redirect_path))
+        for r in data['rows']]
+    # Pop flashed messages now, while the session can still be saved.
+    get_flashed_messages(with_categories=True)
+    return stream_template(
         'index.html',
         prop_displayname=econf['prop_displayname'],
-        rows=rows,
+        row_fragments=row_fragments,
         params=params,
         extrasort_label=extrasort_label,
-        no_more_rows=data.get('nomore'))
+        no_more_rows=data.get('nomore'),
+        partial=data.get('partial'),
+        events=event_hub is not None)
 
 
 def _rows_params():
@@ -183,9 +498,12 @@ def _rows_params():
         ASCENDING if request.args.get('ssort', 'incr') == 'incr'
         else DESCENDING)
     user_filter = None
+    filter_string = normalize_filter(request.args.get('filter'))
     # TODO want to wrap below in try/except for bad input
-    if request.args.get('filter'):
-        user_filter = econf['filter']['transform'](request.args.get('filter'))
+    if filter_string and filter_cache is not None:
+        user_filter = filter_cache.resolve(filter_string)
+    elif filter_string:
+        user_filter = econf['filter']['transform'](filter_string)
     which = set(request.args.getlist('which')
                 or ['active', 'inactive_missing', 'inactive_has'])
     pagesize = request.args.get('psize', econf['rows_per_page'], type=int)
@@ -196,16 +514,57 @@ def _rows_params():
         primary_sort_dir=primary_sort_dir,
         secondary_sort_dir=secondary_sort_dir,
         user_filter=user_filter,
+        filter=filter_string,
         which=which,
         pagesize=pagesize,
         pagenum=pagenum,
         skip=skip)
 
 
+def _page_key(params, user):
+    """Normalized /rows parameters and user, identifying a page."""
+    return (user, params['user_only'], params['primary_sort_dir'],
+            params['secondary_sort_dir'], params['filter'],
+            tuple(sorted(params['which'])), params['pagesize'],
+            params['pagenum'])
+
+
+def _prefetch_next_page(params, user):
+    """Compute the next page in the background, for the same user."""
+    args = request.args.copy()
+    args['pnum'] = params['pagenum'] + 1
+    environ = dict(request.environ,
+                   QUERY_STRING=urlencode(list(args.items(multi=True))))
+    next_params = dict(params, pagenum=params['pagenum'] + 1)
+
+    def compute():
+        with app.request_context(environ):
+            data = rows_data()
+        # A partial page is computed again when requested.
+        return None if data.get('partial') else data
+    prefetcher.submit(_page_key(next_params, user), compute)
+
+
 @app.route('/rows')
 @login_required
 def rows():
     params = _rows_params()
+    if prefetcher is None:
+        return format_rows(rows_data(params))
+    user = session['user']
+    data = prefetcher.get(_page_key(params, user))
+    if data is None:
+        data = rows_data(params)
+    else:
+        g.rows_sections = ['prefetched']
+    if not data.get('nomore'):
+        _prefetch_next_page(params, user)
+    return format_rows(data)
+
+
+def rows_data(params=None):
+    """Return the page of rows for the request's parameters."""
+    params = params or _rows_params()
     user_only = params['user_only']
     primary_sort_dir = params['primary_sort_dir']
     secondary_sort_dir = params['secondary_sort_dir']
@@ -214,25 +573,65 @@ def rows():
     pagesize = params['pagesize']
     skip = params['skip']
 
-    active_votedocs, active_entry_ids = votedocs_and_eids(
-        completed=False, user_only=user_only, sortdir=primary_sort_dir)
+    sections = g.rows_sections = []
+    executor = request_executor()
+    if user_only:
+        completed_future = executor.submit(
+            votedocs_and_eids, completed=True, user_only=user_only,
+            sortdir=primary_sort_dir)
+    # Active rows are ranked, in order of preference, with arrays over
+    # the leaderboard snapshot, from the snapshot's records, or from
+    # the votes collection.
+    ranking = None if user_only else active_ranking()
+    selected = ranking.select(user_filter) if ranking is not None else None
+    active_votedocs = None
+    if selected is None and not user_only:
+        active_votedocs = leaderboard_votedocs(primary_sort_dir)
+    from_snapshot = selected is not None or active_votedocs is not None
+    if selected is not None:
+        active_entry_ids = ranking.e_ids
+    elif from_snapshot:
+        active_entry_ids = [d[vconf['entry_id']] for d in active_votedocs]
+    else:
+        active_votedocs, active_entry_ids = votedocs_and_eids(
+            completed=False, user_only=user_only, sortdir=primary_sort_dir)
+    count_futures = {}
+    if user_filter is not None and not user_only and filter_cache is None:
+        # Count the inactive sections while the active one is built.
+        count_futures = {
+            prop_missing: executor.submit(
+                count_inactive, active_entry_ids, user_filter, prop_missing)
+            for prop_missing, section in [(True, 'inactive_missing'),
+                                          (False, 'inactive_has')]
+            if section in which}
     result = []
     if 'active' in which:
-        rows = rows_active(active_votedocs, active_entry_ids,
-                           primary_sort_dir, secondary_sort_dir,
-                           user_filter=user_filter, user_only=user_only)
-        if skip < len(rows):
-            result += rows[skip:]
+        sections.append('active')
+        if selected is not None:
+            count, rows = rows_ranked(
+                ranking, selected, primary_sort_dir, secondary_sort_dir,
+                skip, pagesize + 1)
+        elif from_snapshot and not user_filter:
+            count, rows = rows_active_window(
+                active_votedocs, primary_sort_dir, secondary_sort_dir,
+                skip, pagesize + 1)
+        else:
+            rows = rows_active(active_votedocs, active_entry_ids,
+                               primary_sort_dir, secondary_sort_dir,
+                               user_filter=user_filter, user_only=user_only)
+            count, rows = len(rows), rows[skip:]
+        if skip < count:
+            result += rows
             skip = 0
         else:
-            skip -= len(rows)
+            skip -= count
     if len(result) > pagesize:
         result = result[:pagesize]
-        return format_rows({'rows': result})
+        return {'rows': result}
     if ((user_filter is None and not user_only) or
             (len(result) == 1 and user_filter and
              econf['e_id'] in user_filter)):
-        return format_rows({'rows': result, 'nomore': True})
+        return {'rows': result, 'nomore': True}
 
     # At this point, there may be few results, or a user simply wants
     # to fetch more. If `user_filter` is not None, we can return
@@ -250,54 +649,49 @@ def rows():
     # mongo cursor, i.e. we avoid setting *no* limit.
     limit = deficit + 1
     if user_only:
-        _, completed_entry_ids = votedocs_and_eids(
-            completed=True, user_only=user_only, sortdir=primary_sort_dir)
-        e_id_constraint = {'$in': completed_entry_ids}
+        sections.append('completed')
+        _, completed_entry_ids = completed_future.result()
         prop_missing = False
-        cursor = entries_inactive(
-            e_id_constraint, user_filter, prop_missing=prop_missing,
-            sort=sort, skip=skip, limit=limit)
-        result += rows_inactive(list(cursor), prop_missing=prop_missing)
+        entries = entries_inactive(
+            completed_entry_ids, user_filter, prop_missing=prop_missing,
+            sort=sort, skip=skip, limit=limit, exclude=False)
+        try:
+            entries = list(entries)
+        except ExecutionTimeout:
+            return partial_rows(result, pagesize)
+        result += rows_inactive(entries, prop_missing=prop_missing)
         if len(result) > pagesize:
             result = result[:pagesize]
-            return format_rows({'rows': result})
-        else:
-            return format_rows({'rows': result, 'nomore': True})
-
-    e_id_constraint = {'$nin': active_entry_ids}
-    if 'inactive_missing' in which:
-        prop_missing = True
-        cursor = entries_inactive(
-            e_id_constraint, user_filter, prop_missing=prop_missing,
-            sort=sort, skip=0, limit=limit)
-        if skip < cursor.count():
-            cursor = cursor.skip(skip)
-            result += rows_inactive(list(cursor), prop_missing=prop_missing)
-            skip = 0
-        else:
-            skip -= cursor.count()
-    if len(result) > pagesize:
-        result = result[:pagesize]
-        return format_rows({'rows': result})
-
-    deficit = pagesize - len(result)
-    limit = deficit + 1
-    if 'inactive_has' in which:
-        prop_missing = False
-        cursor = entries_inactive(
-            e_id_constraint, user_filter, prop_missing=prop_missing,
-            sort=sort, skip=0, limit=limit)
-        if skip < cursor.count():
-            cursor = cursor.skip(skip)
-            result += rows_inactive(list(cursor), prop_missing=prop_missing)
-            skip = 0
+            return {'rows': result}
         else:
-            skip -= cursor.count()
+            return {'rows': result, 'nomore': True}
+
+    for section, prop_missing in [('inactive_missing', True),
+                                  ('inactive_has', False)]:
+        if section not in which or len(result) > pagesize:
+            continue
+        sections.append(section)
+        limit = pagesize - len(result) + 1
+        try:
+            count, entries = inactive_page(
+                params, active_entry_ids, prop_missing, skip, limit,
+                count_futures.get(prop_missing))
+        except ExecutionTimeout:
+            return partial_rows(result, pagesize)
+        result += rows_inactive(entries, prop_missing=prop_missing)
+        skip = 0 if skip < count else skip - count
     if len(result) > pagesize:
         result = result[:pagesize]
-        return format_rows({'rows': result})
+        return {'rows': result}
     else:
-        return format_rows({'rows': result, 'nomore': True})
+        return {'rows': result, 'nomore': True}
+
+
+def partial_rows(result, pagesize):
+    """Rows found before an inactive section timed out, marked as
+    partial rather than failing the page."""
+    g.rows_sections.append('timed_out')
+    return {'rows': result[:pagesize], 'partial': True}
 
 
 def votedocs_and_eids(completed=False, user_only=False, sortdir=DESCENDING):
@@ -309,6 +703,110 @@ def votedocs_and_eids(completed=False, user_only=False, sortdir=DESCENDING):
     return votedocs, entry_ids
 
 
+def usable_snapshot():
+    """Return the leaderboard snapshot, or None if there is none as
+    recent as the votes this worker knows of."""
+    snapshot = leaderboard.current() if leaderboard is not None else None
+    if snapshot is None:
+        return None
+    if invalidation_bus is not None and (
+            snapshot.seq < invalidation_bus.known_seq()):
+        return None
+    max_age = app.config['LEADERBOARD'].get('max_age', 60)
+    if (snapshot.built_at < _local_votes['time'] or
+            time.time() - snapshot.built_at > max_age):
+        return None
+    return snapshot
+
+
+def user_voted_ids(e_ids=None):
+    """Return ids of entries, of `e_ids` if given, with an active vote
+    of the user."""
+    if 'user' not in session:
+        return set()
+    filt = vconf['filter_active'].copy()
+    filt.update(vconf['user_voted'](session['user'], prefilter=True))
+    if e_ids is not None:
+        filt[vconf['entry_id']] = {'$in': e_ids}
+    return {d[vconf['entry_id']] for d in get_collections().votes.find(
+        filt, {vconf['entry_id']: 1, '_id': 0},
+        max_time_ms=max_time_ms('votes'))}
+
+
+# The ranking of the last snapshot used, built once per generation.
+_active_ranking = {'key': None, 'ranking': None}
+
+
+def active_ranking():
+    """Return an `ActiveRanking` of the usable snapshot, or None."""
+    snapshot = usable_snapshot() if ranking_available else None
+    if snapshot is None:
+        return None
+    key = (snapshot.stat.st_ino, snapshot.generation, snapshot.built_at)
+    if _active_ranking['key'] != key:
+        field = app.config['LEADERBOARD'].get('chemsys_field', 'chemsys')
+        records = list(snapshot.records())
+        chemsys = {e[econf['e_id']]: e.get(field) for e in idsets.find_in(
+            get_collections().entries, {}, econf['e_id'],
+            [r[0] for r in records], {econf['e_id']: 1, field: 1, '_id': 0},
+            **idset_options('entries'))}
+        _active_ranking.update(key=key, ranking=ActiveRanking.from_records(
+            records, chemsys, field))
+    return _active_ranking['ranking']
+
+
+def leaderboard_votedocs(sortdir=DESCENDING):
+    """Return active votedocs from the leaderboard snapshot, or None
+    if it is not usable.
+
+    Votedocs have the extrasort value, and `votedfor` for the user.
+    """
+    snapshot = usable_snapshot()
+    if snapshot is None:
+        return None
+    voted = user_voted_ids()
+    votedocs = [{vconf['entry_id']: e_id, vconf['nvotes']: nvotes,
+                 'extrasort': extrasort, 'votedfor': e_id in voted}
+                for e_id, nvotes, extrasort in snapshot.records()]
+    if sortdir == ASCENDING:
+        votedocs.reverse()
+    return votedocs
+
+
+def rows_active_window(votedocs, primary_sort_dir, secondary_sort_dir,
+                       skip, limit):
+    """Return the number of active rows, and rows `skip` to
+    `skip + limit` of them, for votedocs from `leaderboard_votedocs`.
+
+    As the votedocs carry sort keys, only entries of the window are
+    fetched.
+    """
+    votedocs = sorted(votedocs, key=itemgetter('extrasort'),
+                      reverse=secondary_sort_dir == DESCENDING)
+    votedocs.sort(key=itemgetter(vconf['nvotes']),
+                  reverse=primary_sort_dir == DESCENDING)
+    window = votedocs[skip:skip + limit]
+    rows = rows_active(window, [d[vconf['entry_id']] for d in window],
+                       primary_sort_dir, secondary_sort_dir)
+    return len(votedocs), rows
+
+
+def rows_ranked(ranking, selected, primary_sort_dir, secondary_sort_dir,
+                skip, limit):
+    """As `rows_active_window`, for `selected` entries of `ranking`."""
+    count, indexes = ranking.page(
+        primary_sort_dir == DESCENDING, secondary_sort_dir == DESCENDING,
+        skip, limit, selected)
+    e_ids = [ranking.e_ids[i] for i in indexes]
+    voted = user_voted_ids(e_ids)
+    votedocs = [{vconf['entry_id']: e_id,
+                 vconf['nvotes']: int(ranking.nvotes[i]),
+                 'votedfor': e_id in voted}
+                for e_id, i in zip(e_ids, indexes)]
+    return count, rows_active(votedocs, e_ids, primary_sort_dir,
+                              secondary_sort_dir)
+
+
 def rows_active(active_votedocs, active_entry_ids,
                 primary_sort_dir, secondary_sort_dir,
                 user_filter=None, user_only=False):
@@ -317,15 +815,27 @@ def rows_active(active_votedocs, active_entry_ids,
     # require all vote-active entry ids, in sorted order, from the
     # votes collection to form a basis filter for querying the entries
     # collection.
-    filt = {econf['e_id']: {'$in': active_entry_ids}}
-    # override econf['e_id'] filter spec with `user_filter`'s.
+    db = get_collections()
+    candidate_ids = active_entry_ids
     if user_filter:
-        filt.update(user_filter)
+        matching = {e[econf['e_id']] for e in idsets.find_in(
+            db.entries, user_filter, econf['e_id'], active_entry_ids,
+            {econf['e_id']: 1, '_id': 0}, **idset_options('entries'))}
+        candidate_ids = [e_id for e_id in active_entry_ids
+                         if e_id in matching]
     # Fetch/construct equal-length lists of entries, workflow_ids, and
-    # votedocs, keeping nvotes-sorted order.
-    entries = order_by_idlist(entries_by_filter(filt), active_entry_ids)
+    # votedocs, keeping nvotes-sorted order. Workflow ids are looked up
+    # while entries are fetched, and again in the rare case that some
+    # candidates have no entry.
+    workflows_future = request_executor().submit(
+        get_workflow_ids, candidate_ids)
+    entries = order_by_idlist(
+        entry_cache.get_many(db.entries, candidate_ids).values(),
+        active_entry_ids)
     entry_ids = [e[econf['e_id']] for e in entries]
-    workflow_ids = get_workflow_ids(entry_ids)
+    workflow_ids = workflows_future.result()
+    if entry_ids != candidate_ids:
+        workflow_ids = get_workflow_ids(entry_ids)
     entry_ids_set = set(entry_ids)
     votedocs = [d for d in active_votedocs
                 if d[vconf['entry_id']] in entry_ids_set]
@@ -340,18 +850,67 @@ def rows_active(active_votedocs, active_entry_ids,
 def rows_inactive(entries, prop_missing=True):
     if not entries:
         return []
+    if not prop_missing:
+        entry_cache.gained_property([e[econf['e_id']] for e in entries])
     nones = len(entries) * [None]
     return [tablerow_data(z, prop_missing=prop_missing)
             for z in zip(nones, entries, nones)]
 
 
-def entries_inactive(e_id_constraint, user_filter, prop_missing=True,
-                     sort=None, skip=0, limit=0):
-    filt = {econf['e_id']: e_id_constraint}
-    if user_filter is not None:
-        filt.update(user_filter)
+def inactive_page(params, active_entry_ids, prop_missing, skip, limit,
+                  count_future=None):
+    """Return the number of entries in an inactive section, and those
+    of the requested page, which are none if `skip` passes the end."""
+    sort = [(econf['extrasort']['field'], params['secondary_sort_dir'])]
+    if filter_cache is not None:
+        db = get_collections()
+        count, e_ids = filter_cache.page(
+            db.entries, params['filter'], prop_missing,
+            set(active_entry_ids),
+            descending=params['secondary_sort_dir'] == DESCENDING,
+            skip=skip, limit=limit, max_time_ms=max_time_ms('entries'))
+        if not prop_missing:
+            entry_cache.gained_property(e_ids)
+        entries = order_by_idlist(
+            entry_cache.get_many(db.entries, e_ids).values(), e_ids)
+        return count, entries
+    if count_future is not None:
+        count = count_future.result()
+    else:
+        count = count_inactive(active_entry_ids, params['user_filter'],
+                               prop_missing)
+    if skip >= count:
+        return count, []
+    entries = entries_inactive(
+        active_entry_ids, params['user_filter'], prop_missing=prop_missing,
+        sort=sort, skip=skip, limit=limit)
+    return count, list(entries)
+
+
+def inactive_filter(user_filter, prop_missing=True):
+    filt = dict(user_filter or {})
     filt.update(econf['missing_property' if prop_missing else 'has_property'])
-    return entries_by_filter(filt, sort=sort, skip=skip, limit=limit)
+    return filt
+
+
+def count_inactive(e_ids, user_filter, prop_missing=True, exclude=True):
+    """Count entries of an inactive section with ids not in `e_ids`,
+    or in them if not `exclude`."""
+    filt = inactive_filter(user_filter, prop_missing)
+    count = idsets.count_not_in if exclude else idsets.count_in
+    return count(get_collections().entries, filt, econf['e_id'], e_ids,
+                 **idset_options('entries', nin=exclude))
+
+
+def entries_inactive(e_ids, user_filter, prop_missing=True, sort=None,
+                     skip=0, limit=0, exclude=True):
+    """Iterate over entries of an inactive section with ids not in
+    `e_ids`, or in them if not `exclude`."""
+    filt = inactive_filter(user_filter, prop_missing)
+    find = idsets.find_not_in if exclude else idsets.find_in
+    return find(get_collections().entries, filt, econf['e_id'], e_ids,
+                entry_projection(), sort=sort, skip=skip, limit=limit,
+                **idset_options('entries', nin=exclude))
 
 
 @memoize
@@ -366,6 +925,111 @@ def entry_projection():
     return projdict
 
 
+entry_cache = EntryCache(econf, entry_projection(),
+                         **app.config.get('ENTRY_CACHE', {}))
+cache_stats.add('entries', entry_cache.cache)
+
+
+def apply_invalidation(event):
+    """Drop local data made stale by an event of another worker."""
+    if event['kind'] == bus.COMPLETED:
+        entry_cache.invalidate(event['e_ids'])
+    if event['kind'] in (bus.COMPLETED, bus.RESET):
+        if filter_cache is not None:
+            filter_cache.invalidate()
+    if event['kind'] == bus.RESET:
+        entry_cache.invalidate()
+    vote_version.bump()
+
+
+invalidation_bus = bus.InvalidationBus.from_config(app.config)
+if invalidation_bus is not None:
+    invalidation_bus.subscribe(apply_invalidation)
+
+
+def poll_events():
+    """Apply events of other workers, for subscribers to /events."""
+    with app.app_context():
+        invalidation_bus.poll(force=True)
+
+
+event_hub = EventHub.from_config(
+    app.config, poll=poll_events if invalidation_bus is not None else None)
+if event_hub is not None:
+    metrics.REGISTRY.callback(
+        'propjockey_event_subscribers', 'Clients connected to /events.',
+        'gauge', lambda: [({}, event_hub.subscribers)])
+    metrics.REGISTRY.callback(
+        'propjockey_event_subscribers_rejected_total',
+        'Connections to /events refused, at max_subscribers.', 'counter',
+        lambda: [({}, event_hub.rejected)])
+
+
+def vote_deltas(e_ids):
+    """Return `[e_id, nvotes, state]` of the vote documents of
+    `e_ids`, state being 'active' or 'completed'."""
+    db = get_collections()
+    projection = {vconf['entry_id']: 1, vconf['nvotes']: 1, '_id': 0}
+    deltas = {}
+    for state in ['active', 'completed']:
+        for doc in idsets.find_in(
+                db.votes, vconf['filter_' + state], vconf['entry_id'], e_ids,
+                projection, **idset_options('votes')):
+            deltas[doc[vconf['entry_id']]] = [
+                doc[vconf['entry_id']], doc.get(vconf['nvotes'], 0), state]
+    return [deltas[e_id] for e_id in dict.fromkeys(e_ids) if e_id in deltas]
+
+
+def stream_votes(e_ids):
+    """Send the vote counts of `e_ids` to subscribers to /events."""
+    if event_hub is None:
+        return
+    if not event_hub.subscribers:
+        event_hub.skip()
+        return
+    deltas = vote_deltas(e_ids)
+    if deltas:
+        event_hub.publish('votes', deltas)
+
+
+def stream_invalidation(event):
+    """Pass on changes to votes made by other workers and `notify`."""
+    if event['kind'] == bus.RESET:
+        event_hub.publish(bus.RESET, {})
+    else:
+        stream_votes(event['e_ids'])
+
+
+if event_hub is not None and invalidation_bus is not None:
+    invalidation_bus.subscribe(stream_invalidation)
+
+leaderboard = None
+if app.config.get('LEADERBOARD', {}).get('path'):
+    leaderboard = Leaderboard(
+        app.config['LEADERBOARD']['path'],
+        check_seconds=app.config['LEADERBOARD'].get('check_seconds', 1))
+
+
+@app.before_request
+def poll_invalidations():
+    if invalidation_bus is not None:
+        invalidation_bus.poll()
+
+
+# When this worker last changed votes, which snapshots must postdate.
+_local_votes = {'time': 0}
+
+
+def votes_changed(e_ids):
+    """Drop data computed before votes on `e_ids` changed, here and,
+    through the invalidation bus, in other workers."""
+    _local_votes['time'] = time.time()
+    vote_version.bump()
+    if invalidation_bus is not None:
+        invalidation_bus.publish(bus.VOTES, e_ids)
+    stream_votes(e_ids)
+
+
 @memoize
 def votedoc_projection():
     projlist = [vconf['entry_id']]
@@ -377,13 +1041,61 @@ def votedoc_projection():
     return projdict
 
 
+def notify_backlog_filter():
+    """Filter for completed votes whose requesters are not notified."""
+    return backlog_filter(vconf)
+
+
+def _notify_backlog():
+    return [({}, get_collections().votes.count_documents(
+        notify_backlog_filter()))]
+
+metrics.REGISTRY.callback(
+    'propjockey_unnotified_votes',
+    'Completed votes whose requesters are not yet notified.', 'gauge',
+    metrics.CachedValue(_notify_backlog,
+                        app.config.get('METRICS', {}).get('backlog_ttl', 60)))
+
+
+rate_limiter = RateLimiter.from_config(app.config)
+if rate_limiter is not None:
+    metrics.REGISTRY.callback(
+        'propjockey_rate_limited_total',
+        'Requests refused by a rate limit, by endpoint and scope.',
+        'counter', lambda: [
+            ({'endpoint': endpoint, 'scope': scope}, n)
+            for (endpoint, scope), n in sorted(rate_limiter.limited.items())])
+RATE_LIMITED = "Too many requests. Please try again in {:.0f} seconds."
+
+
+def rate_limited(endpoint, user=None):
+    """Take a token from the buckets of `endpoint` for this request.
+    Return 0, or the seconds until it would be allowed. The address is
+    the client's, as forwarded by the proxies of `PROXY_FIX`."""
+    if rate_limiter is None:
+        return 0
+    return rate_limiter.check(endpoint, user=user, ip=request.remote_addr)
+
+
+def too_many_requests(wait, body):
+    response = jsonify(body)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(math.ceil(wait)))
+    return response
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         user = request.form['user']
+        # The honeypot turns bots away before anything else.
         if request.form['honey'] == '':
-            message, category = passwdless.request_token(user)
-            flash(message, category)
+            wait = rate_limited('login', user)
+            if wait:
+                flash(RATE_LIMITED.format(math.ceil(wait)), 'danger')
+            else:
+                message, category = passwdless.request_token(user)
+                flash(message, category)
         return redirect(url_for('index'))
     return render_template(
         'login.html',
@@ -420,9 +1132,27 @@ def authtoken():
     user = request.form.get('user')
     if not user:
         abort(400)
+    wait = rate_limited('authtoken', user)
+    if wait:
+        return too_many_requests(wait, {'error': RATE_LIMITED.format(
+            math.ceil(wait))})
     return jsonify({'uri': passwdless.request_token(user, deliver=False)})
 
 
+@app.route('/events')
+@login_required
+def events():
+    """Stream vote-count changes as server-sent events."""
+    if event_hub is None:
+        abort(404)
+    stream = event_hub.subscribe(request.headers.get('Last-Event-ID'))
+    if stream is None:
+        return unavailable("too many event streams, please retry")
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @app.route('/vote', methods=['POST'])
 def vote():
     user = session.get('user')
@@ -430,7 +1160,18 @@ def vote():
     how = request.form.get('how')
     redirect_path = request.form.get('redirect_path')
 
+    wait = rate_limited('vote', user)
+    if wait:
+        g.vote_category = 'limited'
+        message = RATE_LIMITED.format(math.ceil(wait))
+        if not redirect_path:
+            return too_many_requests(wait, (message, 'error'))
+        flash(message, 'danger')
+        return redirect(redirect_path)
     message, category = _vote(user, eid, how)
+    g.vote_category = category
+    if category == 'success':
+        votes_changed([eid])
     if not redirect_path:
         return jsonify((message, category))
     else:
@@ -485,10 +1226,9 @@ def _vote(user, eid, how):
         completed_doc = db.votes.find_one(filt)
         if completed_doc:
             return "cannot vote on completed entry", ERROR
-        filt = {econf['e_id']: eid}
-        filt.update(econf['missing_property'])
-        entry_exists = db.entries.find(filt).count() == 1
-        if not entry_exists:
+        # Entries gaining the property are dropped from the cache through
+        # the invalidation bus, which is polled before requests.
+        if entry_cache.has_property(db.entries, eid) is not False:
             return "cannot vote on non-existent entry {}".format(eid), ERROR
         if how == 'down':
             return "cannot downvote entry with missing property", ERROR
@@ -497,34 +1237,338 @@ def _vote(user, eid, how):
                 user, {}, db.votes, 'up', filt_for_update), SUCCESS
 
 
-@app.cli.command('make_test_db')
-def make_test_db():
+warmup_logger = logging.getLogger('propjockey.warmup')
+# Seconds taken by each step of the last warm-up, and how it ended.
+# Optional steps that failed are listed in `warnings` instead.
+_warmup = {'state': 'pending', 'steps': {}, 'error': None, 'at': 0,
+           'warnings': {}}
+# Steps that only prime caches, whose failure leaves the app ready.
+OPTIONAL_WARMUP_STEPS = {'filters'}
+_warmup_cond = threading.Condition()
+
+
+def warm_up(before_fork=False):
+    """Do what the first requests would otherwise pay for: connect,
+    ensure indexes, compile templates and fill the leaderboard, entry
+    and filter caches. Return whether it succeeded, after waiting for
+    one already running.
+
+    Before forking workers, the clients are closed again, as workers
+    must open their own; caches and compiled templates carry over.
+    """
+    with _warmup_cond:
+        _warmup_cond.wait_for(lambda: _warmup['state'] != 'running')
+        if _warmup['state'] == 'done':
+            return True
+        _warmup.update(state='running', steps={}, error=None, warnings={},
+                       at=time.time())
+    return _run_warm_up(before_fork)
+
+
+def start_warm_up():
+    """Warm up in a thread, unless warm-up is running or done, or failed
+    less than `retry_seconds` ago. Return whether it started."""
+    retry_seconds = app.config.get('WARMUP', {}).get('retry_seconds', 10)
+    with _warmup_cond:
+        state = _warmup['state']
+        if state in ('running', 'done') or (
+                state == 'failed' and
+                time.time() - _warmup['at'] <= retry_seconds):
+            return False
+        _warmup.update(state='running', steps={}, error=None, warnings={},
+                       at=time.time())
+    thread = threading.Thread(target=_run_warm_up, name='propjockey-warmup')
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def _run_warm_up(before_fork=False):
+    wuconf = app.config.get('WARMUP', {})
+    steps = [('connect', _warm_connect), ('projections', _warm_projections),
+             ('templates', _warm_templates),
+             ('leaderboard', _warm_leaderboard),
+             ('filters', lambda: _warm_filters(wuconf.get('filters', [])))]
+    if wuconf.get('ensure_indexes'):
+        steps.insert(1, ('indexes', lambda: ensure_indexes(
+            get_collections(), econf, vconf)))
+    try:
+        with app.test_request_context():
+            for name, step in steps:
+                start = time.time()
+                try:
+                    step()
+                except Exception as e:
+                    if name not in OPTIONAL_WARMUP_STEPS:
+                        raise
+                    warmup_logger.exception("warm-up step %s failed", name)
+                    _warmup['warnings'][name] = str(e)
+                    continue
+                _warmup['steps'][name] = round(time.time() - start, 4)
+    except Exception as e:
+        warmup_logger.exception("warm-up failed")
+        with _warmup_cond:
+            _warmup.update(state='failed', error=str(e))
+            _warmup_cond.notify_all()
+        return False
+    finally:
+        if before_fork:
+            close_shared_clients()
+    with _warmup_cond:
+        _warmup['state'] = 'done'
+        _warmup_cond.notify_all()
+    warmup_logger.info("warm-up done: %s", _warmup['steps'])
+    return True
+
+
+@app.before_request
+def warm_up_in_background():
+    """Start warm-up from the first request if `create_app` did not,
+    e.g. when serving `propjockey:app`."""
+    if (app.config.get('WARMUP', {}).get('enabled') and
+            _warmup['state'] != 'done'):
+        start_warm_up()
+
+
+def warm_worker():
+    """Open this worker's clients, e.g. from gunicorn's `post_fork`."""
+    with app.app_context():
+        _warm_connect()
+
+
+def _warm_connect():
+    db = get_collections()
+    for name in app.config['CLIENTS']:
+        getattr(db, name).find_one({}, {'_id': 1})
+
+
+def _warm_projections():
+    entry_projection()
+    votedoc_projection()
+
+
+def _warm_templates():
+    for name in ['layout.html', 'index.html', '_row.html', 'login.html']:
+        app.jinja_env.get_template(name)
+
+
+def _warm_leaderboard():
+    if leaderboard is not None:
+        leaderboard.current()
+        active_ranking()
+    _, e_ids = votedocs_and_eids()
+    entry_cache.get_many(get_collections().entries, e_ids)
+
+
+def _warm_filters(filter_strings):
+    if filter_cache is None:
+        return
+    for filter_string in filter_strings:
+        # /rows does not look up empty filters.
+        if not normalize_filter(filter_string):
+            continue
+        for prop_missing in (True, False):
+            filter_cache.ids(get_collections().entries, filter_string,
+                             prop_missing)
+
+
+def create_app(warm=None, before_fork=None):
+    """Return the app, warmed up if `warm`, by default if the `WARMUP`
+    setting is enabled. For gunicorn, with `--preload` to warm up once
+    in the master: `gunicorn --preload 'propjockey:create_app()'`.
+    """
+    wuconf = app.config.get('WARMUP', {})
+    if warm is None:
+        warm = wuconf.get('enabled', False)
+    if before_fork is None:
+        before_fork = wuconf.get('before_fork', False)
+    if warm and _warmup['state'] != 'done':
+        warm_up(before_fork=before_fork)
+    return app
+
+
+@app.route('/ready')
+def ready():
+    """Whether warm-up is done, for load balancers and deploy tools.
+
+    Like any request, this starts warm-up if it is pending, or retries
+    a failed one at most every `retry_seconds`.
+    """
+    if not app.config.get('WARMUP', {}).get('enabled'):
+        return jsonify(ready=True)
+    body = {'ready': _warmup['state'] == 'done', 'state': _warmup['state'],
+            'steps': _warmup['steps']}
+    if _warmup['error']:
+        body['error'] = _warmup['error']
+    if _warmup['warnings']:
+        body['warnings'] = _warmup['warnings']
+    return jsonify(body), 200 if body['ready'] else 503
+
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create indexes needed by hot queries, if missing."""
+    db = get_collections()
+    for name, keys, created in ensure_indexes(db, econf, vconf):
+        print("{:7s} {}: {}".format(
+            'created' if created else 'exists', name,
+            ', '.join('{}:{}'.format(*k) for k in keys)))
+    check_query_plans(db, econf, vconf)
+
+
+@app.cli.command('sync-workflow-ids')
+def sync_workflow_ids():
+    """Refresh the local entry-to-workflow id index."""
+    db = get_collections()
+    index = workflow_id_index(db)
+    if not index:
+        print("No WORKFLOWS['index_collection'] configured.")
+        return
+    index.ensure_indexes()
+    print("{} workflow ids synced".format(index.sync(db.workflows)))
+
+
+@app.cli.command('publish-leaderboard')
+@click.option('--interval', type=float, default=None,
+              help='Seconds between checks for new votes.')
+@click.option('--once', is_flag=True, help='Publish one snapshot and exit.')
+def publish_leaderboard(interval, once):
+    """Keep the shared leaderboard snapshot of this host up to date."""
+    lconf = app.config.get('LEADERBOARD', {})
+    if not lconf.get('path'):
+        print("No LEADERBOARD['path'] configured.")
+        return
+    interval = lconf.get('interval', 5) if interval is None else interval
+    # Republish well within `max_age`, even without new votes.
+    max_interval = lconf.get('max_age', 60) / 3
+    db = get_collections()
+    published_seq, published_at = None, 0
+    while True:
+        seq = -1
+        if invalidation_bus is not None:
+            seq = invalidation_bus.latest_seq()
+        if (seq == -1 or seq != published_seq or
+                time.time() - published_at > max_interval):
+            rows = build_rows(db.votes, db.entries, econf, vconf)
+            generation = publish(lconf['path'], rows, seq)
+            print("Published generation {} ({} entries)".format(
+                generation, len(rows)))
+            published_seq, published_at = seq, time.time()
+        if once:
+            return
+        time.sleep(interval)
+
+
+@app.cli.command('check-leaderboard')
+def check_leaderboard():
+    """Compare the leaderboard snapshot with active votes."""
+    snapshot = leaderboard.current() if leaderboard is not None else None
+    if snapshot is None:
+        raise click.ClickException("No leaderboard snapshot.")
+    problems = leaderboard_problems(snapshot)
+    if problems:
+        raise click.ClickException("\n".join(problems))
+    print("Generation {}: {} entries match.".format(
+        snapshot.generation, len(snapshot)))
+
+
+def leaderboard_problems(snapshot):
+    """Return differences between `snapshot` and `find_votes`."""
+    votedocs, e_ids = votedocs_and_eids()
+    present = entry_cache.get_many(get_collections().entries, e_ids)
+    return compare(snapshot, [
+        (d[vconf['entry_id']], d[vconf['nvotes']]) for d in votedocs
+        if d[vconf['entry_id']] in present])
+
+
+def testdb_collections():
+    """Return a Bunch of the local test database collections."""
     from pymongo import MongoClient
-    client = MongoClient()
-    tdb = client.propjockey_test
+    tdb = MongoClient().propjockey_test
+    return Bunch(**{name: tdb[name]
+                    for name in ['votes', 'entries', 'workflows']})
+
+
+@app.cli.command('make_test_db')
+@click.option('--sample', type=int, default=None,
+              help='Copy only voted entries plus this many random others.')
+@click.option('--batch-size', type=int, default=1000)
+@click.option('--dump', 'dump_path', type=click.Path(), default=None,
+              help='Also write a portable gzipped dump to this path.')
+def make_test_db(sample, batch_size, dump_path):
+    tdb = testdb_collections()
     using_test_clients = app.config['USE_TEST_CLIENTS']
     app.config['USE_TEST_CLIENTS'] = False
     db = get_collections()
     app.config['USE_TEST_CLIENTS'] = using_test_clients
 
-    tdb.votes.drop()
-    tdb.votes.insert_many(db.votes.find())
-    from .util import make_requesters_aliases, set_requesters_aliases
-    alias_map = make_requesters_aliases(tdb.votes, vconf['requesters'])
-    set_requesters_aliases(tdb.votes, vconf['requesters'], alias_map)
-    print("{} votes".format(tdb.votes.count()))
-
-    entry_ids = [d[vconf['entry_id']] for d in tdb.votes.find()]
-    wids = get_workflow_ids(entry_ids)
-    tdb.workflows.drop()
-    tdb.workflows.insert_many([{'eid': eid, 'wid': wid} for (eid, wid)
-                               in zip(entry_ids, wids) if wid])
-    print("{} workflows".format(tdb.workflows.count()))
-
-    tdb.entries.drop()
     proj = {f: 1 for f in econf['filter_fields']}
     proj.update(entry_projection())
-    tdb.entries.insert_many(list(db.entries.find({}, proj)))
-    print("{} entries".format(tdb.entries.count()))
+    stats = build_snapshot(
+        db, tdb, econf, vconf, lambda ids: get_workflow_ids(ids, db),
+        proj, sample=sample, batch_size=batch_size)
+    for s in stats:
+        print(s)
+    nupdated, _ = anonymize_requesters(
+        tdb.votes, vconf['requesters'], alias_key(), batch_size=batch_size)
+    print("{} votes anonymized".format(nupdated))
+    if dump_path:
+        dump_snapshot(tdb, dump_path, batch_size=batch_size)
+        print("Wrote {}".format(dump_path))
+
+
+@app.cli.command('anonymize_test_db')
+@click.option('--batch-size', type=int, default=1000)
+@click.option('--restart', is_flag=True,
+              help='Start over rather than resume an interrupted run.')
+def anonymize_test_db(batch_size, restart):
+    """Alias requesters in the test votes collection. Safe to re-run.
+
+    The last `_id` done is saved after each batch, in the
+    `anonymize_progress` collection, for an interrupted run to resume.
+    """
+    votes = testdb_collections().votes
+    progress = votes.database.anonymize_progress
+    doc = None if restart else progress.find_one({'_id': votes.name})
+
+    def save(last_id):
+        progress.replace_one({'_id': votes.name},
+                             {'_id': votes.name, 'last_id': last_id},
+                             upsert=True)
+    nupdated, _ = anonymize_requesters(
+        votes, vconf['requesters'], alias_key(), batch_size=batch_size,
+        start_after=doc['last_id'] if doc else None, progress=save)
+    progress.delete_one({'_id': votes.name})
+    print("{} votes anonymized".format(nupdated))
+
+
+@app.cli.command('load_test_db')
+@click.argument('path', type=click.Path(exists=True))
+def load_test_db(path):
+    """Replace the test database with the contents of a dump."""
+    for s in load_snapshot(path, testdb_collections()):
+        print(s)
+
+
+@app.cli.command('make_synthetic_db')
+@click.option('--entries', type=int, default=150000)
+@click.option('--votes', type=int, default=5000,
+              help='Number of entries with votes.')
+@click.option('--users', type=int, default=2000)
+@click.option('--completed', type=float, default=0.5,
+              help='Fraction of voted entries with the property.')
+@click.option('--seed', type=int, default=0)
+@click.option('--dump', 'dump_path', type=click.Path(), default=None,
+              help='Also write a portable gzipped dump to this path.')
+def make_synthetic_db(entries, votes, users, completed, seed, dump_path):
+    """Replace the test database with generated data."""
+    tdb = testdb_collections()
+    stats = generate(tdb, econf, vconf, n_entries=entries, n_voted=votes,
+                     n_users=users, completed_fraction=completed, seed=seed)
+    for s in stats:
+        print(s)
+    if dump_path:
+        dump_snapshot(tdb, dump_path)
+        print("Wrote {}".format(dump_path))
 
 app.secret_key = app.config['APP_SECRET_KEY']
@@ -0,0 +1,101 @@
+"""Rank entries with active votes with NumPy arrays.
+
+`ActiveRanking` holds, for the entries of a leaderboard snapshot, their
+number of votes, extrasort value and chemical system, numbered among
+the distinct systems. A page of /rows is then a top-k selection and a
+lexsort over arrays, and only the entries of the page become dicts.
+Filters that select chemical systems, e.g.
+`{'chemsys': {'$in': ['Fe-O', ...]}}`, are matched against the system
+strings exactly, as MongoDB matches them; for other filters `select`
+returns None, and callers fall back to querying entries.
+
+NumPy is optional. Without it, `available` is False.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+available = np is not None
+
+
+class ActiveRanking(object):
+    """Columns of the entries with active votes, in snapshot order
+    (descending votes, then entry id). `systems` numbers the distinct
+    chemical systems, and `codes` holds the number of each entry's.
+    """
+
+    def __init__(self, e_ids, nvotes, extrasort, chemsys, field='chemsys'):
+        self.e_ids = list(e_ids)
+        self.nvotes = np.asarray(nvotes, dtype=np.int64)
+        self.extrasort = np.asarray(extrasort, dtype=np.float64)
+        # Entries share few distinct systems.
+        self.systems = {}
+        codes = [self.systems.setdefault(c, len(self.systems))
+                 for c in chemsys]
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.field = field
+
+    @classmethod
+    def from_records(cls, records, chemsys, field='chemsys'):
+        """From (entry id, nvotes, extrasort) records and a dict of
+        entry id -> chemical system."""
+        records = list(records)
+        return cls([r[0] for r in records], [r[1] for r in records],
+                   [r[2] for r in records],
+                   [chemsys.get(r[0]) for r in records], field)
+
+    def __len__(self):
+        return len(self.e_ids)
+
+    def select(self, user_filter):
+        """Return a boolean array of entries matching `user_filter`, or
+        None if it is not a filter on chemical systems."""
+        if not user_filter:
+            return np.ones(len(self), dtype=bool)
+        if set(user_filter) != {self.field}:
+            return None
+        spec = user_filter[self.field]
+        if isinstance(spec, str):
+            targets = [spec]
+        elif isinstance(spec, dict) and set(spec) == {'$in'}:
+            targets = spec['$in']
+        else:
+            return None
+        # As in MongoDB, None matches entries without a system.
+        if not all(t is None or isinstance(t, str) for t in targets):
+            return None
+        wanted = np.zeros(len(self.systems), dtype=bool)
+        for target in targets:
+            if target in self.systems:
+                wanted[self.systems[target]] = True
+        return wanted[self.codes]
+
+    def page(self, primary_desc=True, secondary_desc=False, skip=0,
+             limit=10, selected=None):
+        """Return the number of selected entries and the indexes of
+        those ranked `skip` to `skip + limit`, by votes, then extrasort.
+
+        Ties keep snapshot order, reversed for ascending votes, as do
+        the stable sorts of `rows_active_window`.
+        """
+        idx = (np.flatnonzero(selected) if selected is not None
+               else np.arange(len(self)))
+        count = len(idx)
+        if not primary_desc:
+            idx = idx[::-1]
+        primary = self.nvotes[idx]
+        if primary_desc:
+            primary = -primary
+        k = skip + limit
+        if k < count:
+            # Only entries with as many votes as the k-th can rank
+            # within the first k.
+            kth = np.partition(primary, k - 1)[k - 1]
+            keep = primary <= kth
+            idx, primary = idx[keep], primary[keep]
+        secondary = self.extrasort[idx]
+        if secondary_desc:
+            secondary = -secondary
+        order = np.lexsort((secondary, primary))
+        return count, idx[order][skip:k]
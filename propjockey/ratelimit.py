@@ -0,0 +1,173 @@
+"""Token-bucket rate limits per user, per client address and overall.
+
+Each bucket holds up to `burst` tokens and refills at `per_minute`. It
+is stored as the time at which it would be full again (the "theoretical
+arrival time" of the generic cell rate algorithm), so taking a token is
+a single comparison and update. `MemoryBuckets` keeps them in the
+process. `MongoBuckets` shares them between workers through a
+collection, updating a bucket only if it is unchanged since it was
+read, and lets a TTL index drop those that are full again.
+
+`RateLimiter` applies the limits of the `RATE_LIMITS` setting, e.g.
+
+    {'login': {'user': {'per_minute': 3, 'burst': 3},
+               'ip': {'per_minute': 10, 'burst': 5},
+               'global': {'per_minute': 600, 'burst': 100}}}
+
+taking a token from the user's bucket, then the address's, then the
+global one. If one is empty, the tokens taken before it are given back,
+so that a request turned away by one limit counts against none.
+"""
+import datetime
+import logging
+import threading
+import time
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from .util import ProcessCollection
+
+SCOPES = ['user', 'ip', 'global']
+
+logger = logging.getLogger(__name__)
+
+
+def _spacing(limit):
+    """Seconds per token, and how far ahead of now a bucket may be."""
+    interval = 60.0 / limit['per_minute']
+    return interval, interval * (limit.get('burst', 1) - 1)
+
+
+class MemoryBuckets(object):
+    """Buckets of this process."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._tat = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, limit, now=None):
+        """Take a token. Return 0, or the seconds until one is left."""
+        now = time.time() if now is None else now
+        interval, tolerance = _spacing(limit)
+        with self._lock:
+            tat = max(self._tat.get(key, now), now)
+            if tat - now > tolerance:
+                return tat - now - tolerance
+            if key not in self._tat and len(self._tat) >= self.max_keys:
+                self._prune(now)
+            self._tat[key] = tat + interval
+        return 0
+
+    def refund(self, key, limit):
+        """Give back a token taken from the bucket."""
+        interval, _ = _spacing(limit)
+        with self._lock:
+            if key in self._tat:
+                self._tat[key] -= interval
+
+    def _prune(self, now):
+        self._tat = {k: t for k, t in self._tat.items() if t > now}
+
+
+class MongoBuckets(object):
+    """Buckets shared through `collection`, with documents
+    `{_id: key, tat: seconds, expires: date}`."""
+
+    def __init__(self, collection, retries=5):
+        self.collection = collection
+        self.retries = retries
+        self._ensured = False
+
+    def ensure(self):
+        """Create the TTL index that drops full buckets."""
+        self.collection.create_index([('expires', ASCENDING)],
+                                     expireAfterSeconds=0)
+        self._ensured = True
+
+    def take(self, key, limit, now=None):
+        if not self._ensured:
+            self.ensure()
+        now = time.time() if now is None else now
+        interval, tolerance = _spacing(limit)
+        for _ in range(self.retries):
+            doc = self.collection.find_one({'_id': key})
+            tat = max(doc['tat'], now) if doc else now
+            if tat - now > tolerance:
+                return tat - now - tolerance
+            update = {'tat': tat + interval,
+                      'expires': datetime.datetime.utcfromtimestamp(
+                          tat + interval)}
+            if doc is None:
+                try:
+                    self.collection.insert_one(dict(update, _id=key))
+                    return 0
+                except DuplicateKeyError:
+                    continue
+            result = self.collection.update_one(
+                {'_id': key, 'tat': doc['tat']}, {'$set': update})
+            if result.modified_count:
+                return 0
+        # Others keep taking tokens from this bucket.
+        return interval
+
+    def refund(self, key, limit):
+        interval, _ = _spacing(limit)
+        self.collection.update_one({'_id': key},
+                                   {'$inc': {'tat': -interval}})
+
+
+class RateLimiter(object):
+    """Apply `limits`, by endpoint and scope, with buckets from
+    `buckets`."""
+
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = limits
+        self.limited = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the limiter of the `RATE_LIMITS` setting, if any. With
+        a `client`, buckets are shared through its collection."""
+        limits = dict(config.get('RATE_LIMITS') or {})
+        client = limits.pop('client', None)
+        if not limits:
+            return None
+        if client:
+            buckets = MongoBuckets(ProcessCollection(client))
+        else:
+            buckets = MemoryBuckets()
+        return cls(buckets, limits)
+
+    def check(self, endpoint, user=None, ip=None, now=None):
+        """Take a token for a request. Return 0, or the seconds until
+        the request would be allowed."""
+        ids = {'user': user, 'ip': ip, 'global': ''}
+        taken = []
+        for scope in SCOPES:
+            limit = self.limits.get(endpoint, {}).get(scope)
+            if limit is None or ids[scope] is None:
+                continue
+            key = '{}:{}:{}'.format(endpoint, scope, ids[scope])
+            try:
+                wait = self.buckets.take(key, limit, now)
+            except PyMongoError:
+                # Rather serve without limits than not at all.
+                logger.exception("rate limit %s unavailable", key)
+                continue
+            if wait:
+                self.limited[endpoint, scope] = (
+                    self.limited.get((endpoint, scope), 0) + 1)
+                self._refund(taken)
+                return wait
+            taken.append((key, limit))
+        return 0
+
+    def _refund(self, taken):
+        for key, limit in taken:
+            try:
+                self.buckets.refund(key, limit)
+            except PyMongoError:
+                logger.exception("rate limit %s not refunded", key)
@@ -0,0 +1,70 @@
+"""Load settings without importing the web app.
+
+Settings are the upper-case names of the Python file named by the
+`PROPJOCKEY_SETTINGS` environment variable, as for Flask's
+`Config.from_envvar`, so that tools such as `propjockey-notify` need
+not import Flask.
+"""
+import os
+import types
+
+ENVVAR = 'PROPJOCKEY_SETTINGS'
+# Set to 'memory' for the test clients to use the in-process backend,
+# loaded with the bundled test archive, rather than a mongod.
+TEST_BACKEND_ENVVAR = 'PROPJOCKEY_TEST_BACKEND'
+TEST_SNAPSHOT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests',
+    'propjockey_test_example.gz')
+
+
+def load_settings(path=None):
+    """Return the settings in `path`, by default the file named by
+    `PROPJOCKEY_SETTINGS`, or none if neither is given."""
+    path = path or os.environ.get(ENVVAR)
+    if not path:
+        return {}
+    module = types.ModuleType('config')
+    module.__file__ = path
+    with open(path, 'rb') as f:
+        exec(compile(f.read(), path, 'exec'), module.__dict__)
+    return {k: getattr(module, k) for k in dir(module) if k.isupper()}
+
+
+def apply_test_clients(config):
+    """Point `config` at the local test database, or at the in-process
+    backend if `PROPJOCKEY_TEST_BACKEND` is 'memory'."""
+    def get_workflow_ids(eids, coll):
+        wids = {d['eid']: d['wid'] for d in coll.find({'eid': {'$in': eids}})}
+        return [wids.get(eid) for eid in eids]
+
+    config['CLIENTS'] = {
+        k: {'database': 'propjockey_test', 'collection': k}
+        for k in ['votes', 'entries', 'workflows']
+    }
+    config['PASSWORDLESS']['tokenstore_client'] = {
+        'database': 'propjockey_test',
+        'collection': 'auth_tokens'
+    }
+    config['WORKFLOWS']['get_workflow_ids'] = get_workflow_ids
+    # Those of the invalidation bus and shared rate limits, if enabled.
+    shared = []
+    for name, collection in [('INVALIDATION', 'invalidations'),
+                             ('RATE_LIMITS', 'rate_limits')]:
+        if (config.get(name) or {}).get('client'):
+            config[name] = dict(config[name], client={
+                'database': 'propjockey_test', 'collection': collection})
+            shared.append(config[name]['client'])
+    if os.environ.get(TEST_BACKEND_ENVVAR) == 'memory':
+        for cfg in config['CLIENTS'].values():
+            cfg.update({'backend': 'memory', 'snapshot': TEST_SNAPSHOT})
+        config['PASSWORDLESS']['tokenstore_client']['backend'] = 'memory'
+        for cfg in shared:
+            cfg['backend'] = 'memory'
+
+
+def load_config(path=None):
+    """As `load_settings`, also applying `USE_TEST_CLIENTS`."""
+    config = load_settings(path)
+    if config.get('USE_TEST_CLIENTS'):
+        apply_test_clients(config)
+    return config
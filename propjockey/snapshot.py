@@ -0,0 +1,203 @@
+"""Build, dump and load test database snapshots with bounded memory.
+
+Collections are streamed in fixed-size batches, and copied in parallel.
+Dumps are gzipped JSON lines (MongoDB extended JSON), one
+`{"collection": ..., "doc": ...}` object per line, so they can be read
+without MongoDB tools. Gzipped `mongodump --archive` files can also be
+loaded.
+"""
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import struct
+import time
+
+from bson import BSON, json_util
+
+MONGODUMP_MAGIC = b'\x6d\xe2\x99\x81'
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class CopyStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.ndocs = 0
+        self.start = time.time()
+        self.seconds = 0.0
+
+    def add(self, n):
+        self.ndocs += n
+        self.seconds = time.time() - self.start
+
+    def __str__(self):
+        rate = self.ndocs / self.seconds if self.seconds else 0
+        return "{} {}: {:.1f}s, {:.0f} docs/s".format(
+            self.ndocs, self.name, self.seconds, rate)
+
+
+def insert_batches(dst, docs, name, batch_size=1000):
+    """Insert `docs` into `dst` in batches. Return a `CopyStats`."""
+    stats = CopyStats(name)
+    for batch in batched(docs, batch_size):
+        dst.insert_many(batch, ordered=False)
+        stats.add(len(batch))
+    return stats
+
+
+def sample_entries(entries, e_id, include_ids, n_others, projection,
+                   batch_size=1000):
+    """Yield entries with ids in `include_ids`, then `n_others` others.
+
+    Other entries are sampled at random by the server.
+    """
+    for ids in batched(include_ids, batch_size):
+        for doc in entries.find({e_id: {'$in': ids}}, projection,
+                                batch_size=batch_size):
+            yield doc
+    if n_others:
+        pipeline = [
+            {'$match': {e_id: {'$nin': list(include_ids)}}},
+            {'$sample': {'size': n_others}},
+            {'$project': projection},
+        ]
+        for doc in entries.aggregate(pipeline, allowDiskUse=True,
+                                     batchSize=batch_size):
+            yield doc
+
+
+def build_snapshot(db, tdb, econf, vconf, get_workflow_ids, projection,
+                   sample=None, batch_size=1000):
+    """Copy votes, workflows and entries from `db` to `tdb` in parallel.
+
+    `db` and `tdb` are Bunches of collections. `get_workflow_ids` maps a
+    list of entry ids to workflow ids, and entries are copied with
+    `projection`. If `sample` is given, copy only entries with votes
+    plus `sample` random other entries. Returns a list of `CopyStats`.
+    """
+    voted_ids = db.votes.distinct(vconf['entry_id'])
+
+    def copy_votes():
+        return insert_batches(
+            tdb.votes, db.votes.find(batch_size=batch_size), 'votes',
+            batch_size)
+
+    def copy_workflows():
+        def docs():
+            for ids in batched(voted_ids, batch_size):
+                for eid, wid in zip(ids, get_workflow_ids(ids)):
+                    if wid:
+                        yield {'eid': eid, 'wid': wid}
+        return insert_batches(tdb.workflows, docs(), 'workflows', batch_size)
+
+    def copy_entries():
+        if sample is None:
+            docs = db.entries.find({}, projection, batch_size=batch_size)
+        else:
+            docs = sample_entries(db.entries, econf['e_id'], voted_ids,
+                                  sample, projection, batch_size)
+        return insert_batches(tdb.entries, docs, 'entries', batch_size)
+
+    for name in ['votes', 'workflows', 'entries']:
+        getattr(tdb, name).drop()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(f) for f in
+                   (copy_votes, copy_workflows, copy_entries)]
+        return [f.result() for f in futures]
+
+
+def dump_snapshot(tdb, path, names=('votes', 'workflows', 'entries'),
+                  batch_size=1000):
+    """Write collections of `tdb` to a gzipped JSON-lines file."""
+    with gzip.open(path, 'wt') as f:
+        for name in names:
+            for doc in getattr(tdb, name).find(batch_size=batch_size):
+                f.write(json.dumps({'collection': name, 'doc': doc},
+                                   default=json_util.default))
+                f.write('\n')
+
+
+def iter_dump(f):
+    """Yield (collection name, document) pairs from a dump file."""
+    for line in f:
+        item = json.loads(line.decode('utf-8'),
+                          object_hook=json_util.object_hook)
+        yield item['collection'], item['doc']
+
+
+def iter_mongodump_archive(f):
+    """Yield (collection name, document) pairs from a mongodump archive.
+
+    An archive is a magic number and a header document, then collection
+    metadata documents, then blocks that each start with a namespace
+    document followed by that namespace's documents. Runs of documents
+    are ended by a -1 terminator.
+    """
+    def read_doc():
+        head = f.read(4)
+        if len(head) < 4:
+            raise EOFError
+        size, = struct.unpack('<i', head)
+        if size == -1:
+            return None
+        return BSON(head + f.read(size - 4)).decode()
+
+    if f.read(4) != MONGODUMP_MAGIC:
+        raise ValueError("Not a mongodump archive")
+    read_doc()
+    while read_doc() is not None:
+        pass
+    while True:
+        try:
+            namespace = read_doc()
+        except EOFError:
+            return
+        if namespace is None:
+            continue
+        doc = read_doc()
+        while doc is not None:
+            yield namespace['collection'], doc
+            doc = read_doc()
+
+
+def load_snapshot(path, tdb, batch_size=1000):
+    """Load a dump or gzipped mongodump archive into `tdb`.
+
+    `tdb` is a Bunch of collections, or a database. Existing collections
+    of the same names are dropped. Returns a list of `CopyStats`.
+    """
+    stats, dropped = {}, set()
+
+    def flush(name, batch):
+        if name not in dropped:
+            getattr(tdb, name).drop()
+            dropped.add(name)
+        getattr(tdb, name).insert_many(batch, ordered=False)
+        stats.setdefault(name, CopyStats(name)).add(len(batch))
+
+    batches = {}
+    with gzip.open(path, 'rb') as f:
+        is_archive = f.peek(4)[:4] == MONGODUMP_MAGIC
+        items = iter_mongodump_archive(f) if is_archive else iter_dump(f)
+        for name, doc in items:
+            batch = batches.setdefault(name, [])
+            batch.append(doc)
+            if len(batch) == batch_size:
+                flush(name, batch)
+                batches[name] = []
+    for name, batch in batches.items():
+        if batch:
+            flush(name, batch)
+    return list(stats.values())
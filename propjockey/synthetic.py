@@ -0,0 +1,110 @@
+"""Synthetic entries, votes and workflows at configurable scale.
+
+Documents follow the field names of the ENTRIES and VOTES settings.
+Entries have materials-like formulas and chemical systems, and votes
+per entry follow a Zipf distribution, so that there are a few very
+popular entries and a long tail of entries with a single vote.
+Workflows are `{'eid': ..., 'wid': ...}` documents, as in the test
+database.
+"""
+
+import random
+
+from .snapshot import insert_batches
+
+ELEMENTS = (
+    "H Li Be B C N O F Na Mg Al Si P S Cl K Ca Sc Ti V Cr Mn Fe Co Ni Cu "
+    "Zn Ga Ge As Se Br Rb Sr Y Zr Nb Mo Ru Rh Pd Ag Cd In Sn Sb Te I Cs "
+    "Ba La Ce Nd Sm Gd Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi U").split()
+SPACEGROUPS = ['Fm-3m', 'P6_3/mmc', 'Pnma', 'P2_1/c', 'C2/m', 'R-3m',
+               'I4/mmm', 'P-1', 'Fd-3m', 'P4/mmm', 'C2/c', 'Pm-3m']
+NELEMENTS_WEIGHTS = [5, 30, 45, 15, 5]
+
+
+def _set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def zipf(rng, a, maximum):
+    """Sample from a Zipf distribution with exponent `a`, at most `maximum`.
+
+    Uses inverse transform sampling of the continuous approximation.
+    """
+    u = rng.random()
+    return min(maximum, int((1 - u) ** (-1.0 / (a - 1))))
+
+
+def make_entry(rng, econf, e_id, has_property=False):
+    """Return an entry with a random formula, spacegroup and extrasort."""
+    nelements = rng.choices(range(1, 6), NELEMENTS_WEIGHTS)[0]
+    # Oxygen is in many materials.
+    elements = set(rng.sample(ELEMENTS, nelements))
+    if nelements > 1 and rng.random() < 0.4:
+        elements.pop()
+        elements.add('O')
+    counts = {el: rng.choice([1, 1, 2, 3, 4]) for el in elements}
+    formula = ''.join('{}{}'.format(el, n if n > 1 else '')
+                      for el, n in sorted(counts.items()))
+    entry = {econf['e_id']: e_id, 'chemsys': '-'.join(sorted(elements))}
+    fields = econf.get('description_fields', [])
+    for field, value in zip(fields, [formula, rng.choice(SPACEGROUPS)]):
+        _set_path(entry, field, value)
+    # Most entries are close to the convex hull.
+    _set_path(entry, econf['extrasort']['field'], rng.expovariate(20))
+    if has_property:
+        for field, spec in econf['has_property'].items():
+            if spec == {'$exists': True}:
+                _set_path(entry, field, {'K_VRH': rng.uniform(10, 400)})
+            elif not isinstance(spec, dict):
+                _set_path(entry, field, spec)
+    return entry
+
+
+def make_vote(rng, vconf, eid, users, zipf_a, completed=False):
+    """Return a vote document for entry `eid`."""
+    nvotes = zipf(rng, zipf_a, len(users))
+    requesters = rng.sample(users, nvotes)
+    doc = {
+        vconf['entry_id']: eid,
+        vconf['prop_field']: vconf['prop_value'],
+        vconf['requesters']: requesters,
+        vconf['nvotes']: nvotes,
+    }
+    if completed:
+        doc.update(vconf['filter_completed'])
+        doc[vconf['requesters_notified']] = rng.random() < 0.9
+    return doc
+
+
+def generate(db, econf, vconf, n_entries=150000, n_voted=5000,
+             n_users=2000, completed_fraction=0.5, workflow_fraction=0.6,
+             zipf_a=2.0, seed=0, batch_size=1000):
+    """Fill the votes, entries and workflows collections of `db`.
+
+    `db` is a Bunch of collections or a database. Of `n_voted` entries
+    with votes, `completed_fraction` have the property and completed
+    votes, and `workflow_fraction` of the rest have a workflow. Existing
+    collections are dropped. Returns a list of `CopyStats`.
+    """
+    rng = random.Random(seed)
+    users = ['user{}@example.gov'.format(i) for i in range(n_users)]
+    e_ids = ['mp-{}'.format(i) for i in range(n_entries)]
+    voted = set(rng.sample(range(n_entries), min(n_voted, n_entries)))
+    completed = {i for i in voted if rng.random() < completed_fraction}
+
+    for name in ['votes', 'entries', 'workflows']:
+        getattr(db, name).drop()
+
+    entries = (make_entry(rng, econf, e_ids[i], has_property=i in completed)
+               for i in range(n_entries))
+    votes = (make_vote(rng, vconf, e_ids[i], users, zipf_a, i in completed)
+             for i in sorted(voted))
+    workflows = ({'eid': e_ids[i], 'wid': wid}
+                 for wid, i in enumerate(sorted(voted - completed))
+                 if rng.random() < workflow_fraction)
+    return [insert_batches(db.entries, entries, 'entries', batch_size),
+            insert_batches(db.votes, votes, 'votes', batch_size),
+            insert_batches(db.workflows, workflows, 'workflows', batch_size)]
@@ -1,8 +1,12 @@
 """Collection of helper utilities for the main propjockey application."""
 
-import uuid
+import hashlib
+import hmac
+import os
+import threading
+import weakref
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient, UpdateOne
 
 
 class Bunch:
@@ -23,35 +27,121 @@ def config_to_uri(cfg):
 
 
 def mongoconnect(cfg, connect=False):
+    """Return a client for `cfg`, which may select the memory backend."""
+    if cfg.get('backend') == 'memory':
+        from .memstore import MemoryClient
+        client = MemoryClient()
+        if cfg.get('snapshot'):
+            client.load_once(cfg['snapshot'], cfg['database'])
+        return client
     return MongoClient(config_to_uri(cfg), connect=connect)
 
 
+class ProcessCollection(object):
+    """The collection of client config `cfg`, on a client opened by
+    each process on first use, as forked workers must not use the
+    clients of their parent. Other attributes are the collection's."""
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._pid = None
+        self._client = None
+        self._collection = None
+        self._lock = threading.Lock()
+        self._instances.add(self)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def get(self):
+        """Return the collection on this process's client."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._client = mongoconnect(self.cfg)
+                self._collection = self._client[self.cfg['database']][
+                    self.cfg['collection']]
+                self._pid = os.getpid()
+            return self._collection
+
+    def close(self):
+        """Close this process's client, if open."""
+        with self._lock:
+            client = self._client if self._pid == os.getpid() else None
+            self._pid = self._client = self._collection = None
+        if client is not None:
+            client.close()
+
+    @classmethod
+    def close_all(cls):
+        """Close the clients of every instance, e.g. before forking."""
+        for instance in list(cls._instances):
+            instance.close()
+
+
 def get_collection(connector, config, name):
     conn, cfg, n = connector, config, name
     return conn[n][cfg[n]['database']][cfg[n]['collection']]
 
 
-def make_requesters_aliases(votes_collection, requesters_field):
-    alias_map = {}
-    aliases = set()
-    for d in votes_collection.find():
-        for user in d[requesters_field]:
-            if user not in alias_map:
-                candidate = uuid.uuid4().hex
-                while candidate in aliases:
-                    candidate = uuid.uuid4().hex
-                aliases.add(candidate)
-                alias_map[user] = candidate + '@aliased.gov'
-    return alias_map
-
-
-def set_requesters_aliases(votes_collection, requesters_field, alias_map):
-    # XXX There be dragons in iterating over a cursor rather than
-    # pre-fetching all docs with `list()` prior to iteration, unless
-    # you add a {'$snapshot": True} query modifier to the cursor,
-    # except that doesn't work with sharded collections.
-    for d in list(votes_collection.find({}, {requesters_field: 1})):
-        aliased = [alias_map[user] for user in d[requesters_field]]
-        votes_collection.update_one(
-            {'_id': d['_id']},
-            {'$set': {requesters_field: aliased}})
+def connect_collections(clients_config):
+    """Return a Bunch of collections, and their `clients`, by name."""
+    b = Bunch()
+    b.clients = {name: mongoconnect(clients_config[name])
+                 for name in clients_config}
+    for name in clients_config:
+        setattr(b, name, get_collection(b.clients, clients_config, name))
+    return b
+
+
+def requester_alias(user, key, domain='aliased.gov'):
+    """Return a stable alias email for `user`, keyed by `key`."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    digest = hmac.new(key, user.encode('utf-8'), hashlib.sha256)
+    return "{}@{}".format(digest.hexdigest()[:32], domain)
+
+
+def anonymize_requesters(votes_collection, requesters_field, key,
+                         batch_size=1000, start_after=None,
+                         domain='aliased.gov', progress=None):
+    """Replace requesters with aliases from `requester_alias`, in one pass.
+
+    Documents are streamed in `_id` order, so each is visited once even
+    though it is updated during iteration, and updates are applied with
+    unordered bulk writes, one per `batch_size` documents visited.
+    Requesters already aliased are left as is, so an interrupted run can
+    simply be re-run, or resumed by passing as `start_after` the last
+    `_id` handed to `progress` after each batch was written.
+
+    Returns the number of documents updated and the `_id` of the last
+    document visited.
+    """
+    filt = {} if start_after is None else {'_id': {'$gt': start_after}}
+    cursor = votes_collection.find(
+        filt, {requesters_field: 1}, sort=[('_id', ASCENDING)],
+        batch_size=batch_size)
+    suffix = '@' + domain
+    nupdated, last_id, ops = 0, start_after, []
+
+    def write():
+        if ops:
+            votes_collection.bulk_write(ops, ordered=False)
+        if progress is not None and last_id is not None:
+            progress(last_id)
+        return len(ops)
+
+    for i, d in enumerate(cursor, 1):
+        users = d.get(requesters_field, [])
+        aliased = [u if u.endswith(suffix) else
+                   requester_alias(u, key, domain) for u in users]
+        if aliased != users:
+            ops.append(UpdateOne({'_id': d['_id']},
+                                 {'$set': {requesters_field: aliased}}))
+        last_id = d['_id']
+        if i % batch_size == 0:
+            nupdated += write()
+            ops = []
+    nupdated += write()
+    return nupdated, last_id
@@ -0,0 +1,95 @@
+"""Locally synced mapping of entry ids to workflow ids.
+
+Looking up workflow ids on the (remote, large) workflows collection for
+every page of rows is slow. `WorkflowIdIndex` keeps a compact
+collection of `{_id: entry id, wid: workflow id}` documents next to the
+votes. It is refreshed incrementally, using the greatest workflow id
+seen so far as a watermark, and falls back to the live lookup for ids
+it does not know yet.
+"""
+
+from datetime import datetime
+
+from pymongo import DESCENDING, UpdateOne
+
+from .idsets import find_in
+
+
+class WorkflowIdIndex(object):
+    def __init__(self, collection, wconf):
+        """`collection` holds the mapping. `wconf` is the WORKFLOWS setting.
+
+        `wconf['iter_workflow_ids'](workflow_collection, after_wid)`
+        must yield (entry id, workflow id) pairs for workflows with id
+        greater than `after_wid` (all workflows if None), in increasing
+        workflow id order. `wconf['get_workflow_ids']` is the live lookup.
+        """
+        self.collection = collection
+        self.iter_workflow_ids = wconf['iter_workflow_ids']
+        self.get_workflow_ids = wconf['get_workflow_ids']
+        self.missing_ttl = wconf.get('index_missing_ttl', 3600)
+
+    def ensure_indexes(self):
+        self.collection.create_index([('wid', DESCENDING)])
+        # Forget that an entry had no workflow after a while, in case
+        # syncing is not scheduled.
+        self.collection.create_index(
+            'missing_since', expireAfterSeconds=self.missing_ttl)
+
+    def watermark(self):
+        """Return the greatest synced workflow id.
+
+        Ids recorded by `lookup` are excluded, since workflows with
+        smaller ids may not have been synced yet.
+        """
+        doc = self.collection.find_one(
+            {'wid': {'$ne': None}, 'live': {'$ne': True}}, {'wid': 1},
+            sort=[('wid', DESCENDING)])
+        return doc['wid'] if doc else None
+
+    def sync(self, workflow_collection, batch_size=1000):
+        """Fetch workflows newer than the watermark. Return # synced."""
+        n = 0
+        batch = []
+        pairs = self.iter_workflow_ids(workflow_collection, self.watermark())
+        for eid, wid in pairs:
+            batch.append(UpdateOne(
+                {'_id': eid},
+                {'$set': {'wid': wid},
+                 '$unset': {'missing_since': '', 'live': ''}},
+                upsert=True))
+            if len(batch) == batch_size:
+                n += self._write(batch)
+                batch = []
+        if batch:
+            n += self._write(batch)
+        return n
+
+    def _write(self, batch):
+        self.collection.bulk_write(batch, ordered=True)
+        return len(batch)
+
+    def lookup(self, entry_ids, workflow_collection):
+        """Return workflow ids for `entry_ids` in order, None if absent.
+
+        Ids unknown to the index are looked up live and recorded,
+        including the absence of a workflow.
+        """
+        known = {d['_id']: d['wid'] for d in find_in(
+            self.collection, {}, '_id', entry_ids, {'wid': 1})}
+        unknown = [eid for eid in entry_ids if eid not in known]
+        if unknown:
+            wids = self.get_workflow_ids(unknown, workflow_collection)
+            now = datetime.utcnow()
+            updates = []
+            for eid, wid in zip(unknown, wids):
+                known[eid] = wid
+                if wid:
+                    update = {'$set': {'wid': wid, 'live': True}}
+                else:
+                    # Don't clobber a concurrently synced workflow id.
+                    update = {'$setOnInsert': {'wid': None,
+                                               'missing_since': now}}
+                updates.append(UpdateOne({'_id': eid}, update, upsert=True))
+            self.collection.bulk_write(updates, ordered=False)
+        return [known.get(eid) for eid in entry_ids]
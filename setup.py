@@ -4,12 +4,20 @@ setup(
     name='propjockey',
     packages=['propjockey'],
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'propjockey-notify = propjockey.notify:main',
+        ],
+    },
     install_requires=[
         'flask',
         'pymongo',
         'requests',
         'toolz',
     ],
+    extras_require={
+        'ranking': ['numpy'],
+    },
     setup_requires=[
         'pytest-runner',
     ],
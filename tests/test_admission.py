@@ -0,0 +1,29 @@
+import threading
+import time
+
+from propjockey.admission import Limiter
+
+
+def test_limiter_queues_then_rejects():
+    limiter = Limiter(max_concurrent=1, queue=1, queue_seconds=5)
+    assert limiter.acquire()
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(limiter.acquire()))
+    waiter.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+    # The queue is full.
+    assert not limiter.acquire()
+    limiter.release()
+    waiter.join()
+    assert waited == [True]
+    assert (limiter.active, limiter.admitted, limiter.rejected) == (1, 2, 1)
+
+
+def test_limiter_times_out_in_queue():
+    limiter = Limiter(max_concurrent=1, queue=4, queue_seconds=0.01)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert (limiter.timed_out, limiter.waiting) == (1, 0)
+    limiter.release()
+    assert limiter.acquire()
@@ -0,0 +1,63 @@
+import pytest
+
+from propjockey import bus
+from propjockey.memstore import MemoryClient
+
+
+@pytest.fixture
+def coll():
+    client = MemoryClient()
+    client.drop_database('propjockey_bus_test')
+    return client['propjockey_bus_test'].invalidations
+
+
+def worker(coll, host, **kwargs):
+    b = bus.InvalidationBus(coll, poll_seconds=0, host=host, **kwargs)
+    b.seen = []
+    b.subscribe(b.seen.append)
+    b.poll()
+    return b
+
+
+def test_events_reach_other_workers(coll):
+    a, b = worker(coll, 'a'), worker(coll, 'b')
+    a.publish(bus.VOTES, ['mp-1'])
+    b.publish(bus.COMPLETED, ['mp-2', 'mp-3'])
+    assert coll.database.invalidations.capped_max == 10000
+    a.poll(), b.poll()
+    assert [(e['kind'], e['e_ids']) for e in a.seen] == \
+        [(bus.COMPLETED, ['mp-2', 'mp-3'])]
+    assert [(e['kind'], e['e_ids']) for e in b.seen] == \
+        [(bus.VOTES, ['mp-1'])]
+    assert a.poll() == [] and a.last_seq == 2
+    # A new worker starts from the latest event.
+    assert worker(coll, 'c').last_seq == 2
+
+
+def test_poll_interval(coll):
+    a, b = worker(coll, 'a'), worker(coll, 'b')
+    b.poll_seconds = 60
+    b.poll()
+    a.publish(bus.VOTES, ['mp-1'])
+    assert b.poll() == []
+    assert len(b.poll(force=True)) == 1
+
+
+def test_missed_events_reset(coll):
+    a, b = worker(coll, 'a', max_events=3), worker(coll, 'b', max_events=3)
+    for i in range(5):
+        a.publish(bus.VOTES, ['mp-{}'.format(i)])
+    assert coll.count_documents({}) == 3
+    b.poll()
+    assert [e['kind'] for e in b.seen] == [bus.RESET] and b.resets == 1
+    assert b.last_seq == 5
+
+
+def test_gap_waits_then_resets(coll):
+    a, b = worker(coll, 'a'), worker(coll, 'b', gap_seconds=0)
+    # A publisher that numbered an event but died before inserting it.
+    a.counter.update_one({'_id': 'seq'}, {'$inc': {'seq': 1}}, upsert=True)
+    a.publish(bus.VOTES, ['mp-1'])
+    assert b.poll() == [] and b.last_seq == 0
+    assert [e['kind'] for e in b.poll()] == [bus.RESET]
+    assert b.last_seq == 2
@@ -0,0 +1,31 @@
+import time
+
+from propjockey.cache import LRUCache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_bounded_by_bytes():
+    cache = LRUCache(maxbytes=10, sizeof=len)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'y' * 3)
+    cache.set('c', 'z' * 3)
+    assert cache.get('a') is None
+    assert cache.nbytes == 6 and len(cache) == 2
+
+
+def test_lru_ttl():
+    cache = LRUCache(ttl=0.05)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None and len(cache) == 0
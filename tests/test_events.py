@@ -0,0 +1,80 @@
+import threading
+import time
+
+from propjockey.events import RESET, EventHub
+
+
+def messages(stream, n):
+    it = iter(stream)
+    return [next(it) for _ in range(n)]
+
+
+def test_stream_batches_events_and_heartbeats():
+    hub = EventHub(heartbeat_seconds=0.01, max_seconds=5, retry_ms=100)
+    stream = hub.subscribe()
+    it = iter(stream)
+    assert next(it) == 'retry: 100\n\n'
+    assert next(it) == ': keep-alive\n\n'
+    hub.publish('votes', [['mp-1', 2, 'active']])
+    hub.publish('votes', [['mp-2', 1, 'completed']])
+    assert next(it) == (
+        'id: {0}-1\nevent: votes\ndata: [["mp-1",2,"active"]]\n\n'
+        'id: {0}-2\nevent: votes\ndata: [["mp-2",1,"completed"]]\n\n'
+    ).format(hub.name)
+    assert hub.subscribers == 1
+    stream.close()
+    stream.close()
+    assert hub.subscribers == 0
+
+
+def test_waiting_subscriber_is_woken():
+    hub = EventHub(heartbeat_seconds=5, max_seconds=5)
+    it = iter(hub.subscribe())
+    next(it)
+    timer = threading.Timer(0.05, hub.publish, ['votes', []])
+    timer.start()
+    start = time.time()
+    assert 'event: votes' in next(it)
+    assert time.time() - start < 1
+
+
+def test_resume_from_last_event_id():
+    hub = EventHub(buffer_size=2, heartbeat_seconds=0.01, max_seconds=5)
+    first = hub.publish('votes', [1])
+    hub.publish('votes', [2])
+    event_id = '{}-{}'.format(hub.name, first)
+    assert 'data: [2]' in messages(hub.subscribe(event_id), 2)[1]
+    # Events no longer buffered, or skipped while no one was connected,
+    # or from another worker cannot be resumed from.
+    hub.publish('votes', [3])
+    hub.skip()
+    for last_id in [event_id, '{}-{}'.format(hub.name, hub.last_id - 1),
+                    'other-1']:
+        reset = messages(hub.subscribe(last_id), 2)[1]
+        assert reset == 'id: {}-{}\nevent: {}\ndata: {{}}\n\n'.format(
+            hub.name, hub.last_id, RESET)
+    assert hub.since(0) is None and hub.since(hub.last_id) == []
+
+
+def test_max_subscribers_and_lifetime():
+    hub = EventHub(max_subscribers=1, heartbeat_seconds=0.01,
+                   max_seconds=0.05)
+    stream = hub.subscribe()
+    assert hub.subscribe() is None and hub.rejected == 1
+    assert list(stream)[-1] == ': keep-alive\n\n'
+    stream.close()
+    assert hub.subscribe() is not None
+
+
+def test_polls_only_while_subscribed():
+    polled = []
+    hub = EventHub(poll=lambda: polled.append(1), poll_seconds=0.01)
+    stream = hub.subscribe()
+    while len(polled) < 3:
+        time.sleep(0.01)
+    stream.close()
+    while hub._pump is not None:
+        time.sleep(0.01)
+    n = len(polled)
+    time.sleep(0.05)
+    assert len(polled) == n
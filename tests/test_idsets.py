@@ -0,0 +1,72 @@
+import pytest
+from pymongo import ASCENDING, DESCENDING
+
+from propjockey import idsets
+from propjockey.memstore import MemoryClient
+
+SORT = [('group', ASCENDING), ('score', DESCENDING)]
+
+
+@pytest.fixture
+def coll():
+    client = MemoryClient()
+    client.drop_database('propjockey_idsets_test')
+    coll = client['propjockey_idsets_test'].docs
+    coll.insert_many([
+        {'eid': 'e{:02d}'.format(i), 'group': i % 3 or None,
+         'score': (7 * i) % 11, 'kind': 'odd' if i % 2 else 'even'}
+        for i in range(40)])
+    return coll
+
+
+def plain(coll, filt, projection=None, sort=None, skip=0, limit=0):
+    return list(coll.find(filt, projection, sort=sort, skip=skip,
+                          limit=limit))
+
+
+def test_chunks_drop_repeats():
+    assert list(idsets.chunks(['a', 'b', 'a', 'c', 'd'], 2)) == [
+        ['a', 'b'], ['c', 'd']]
+
+
+def test_with_ids_keeps_own_constraint():
+    assert idsets.with_ids({'kind': 'odd'}, 'eid', {'$in': [1]}) == {
+        'kind': 'odd', 'eid': {'$in': [1]}}
+    assert idsets.with_ids({'eid': {'$gt': 0}}, 'eid', {'$in': [1]}) == {
+        '$and': [{'eid': {'$gt': 0}}, {'eid': {'$in': [1]}}]}
+
+
+def test_find_in_merges_chunks_in_order(coll):
+    ids = ['e{:02d}'.format(i) for i in range(0, 40, 3)] + ['missing']
+    filt = {'kind': 'odd'}
+    expected = plain(coll, dict(filt, eid={'$in': ids}),
+                     {'eid': 1, '_id': 0}, sort=SORT)
+    for skip, limit in [(0, 0), (0, 3), (2, 3), (5, 0), (20, 5)]:
+        found = list(idsets.find_in(
+            coll, filt, 'eid', ids, {'eid': 1, '_id': 0}, sort=SORT,
+            skip=skip, limit=limit, chunk_size=2))
+        # Sort fields added to the projection are stripped again.
+        assert found == expected[skip:skip + limit if limit else None]
+    assert idsets.count_in(coll, filt, 'eid', ids, chunk_size=2) == len(
+        expected)
+
+
+def test_find_not_in_past_max_nin(coll):
+    ids = ['e{:02d}'.format(i) for i in range(0, 40, 4)]
+    filt = {'kind': 'even'}
+    expected = plain(coll, dict(filt, eid={'$nin': ids}),
+                     {'eid': 1, 'score': 1, '_id': 0}, sort=SORT)
+    for max_nin in [100, 3]:
+        found = list(idsets.find_not_in(
+            coll, filt, 'eid', ids, {'eid': 1, 'score': 1, '_id': 0},
+            sort=SORT, skip=1, limit=4, chunk_size=2, max_nin=max_nin))
+        assert found == expected[1:5]
+        assert idsets.count_not_in(coll, filt, 'eid', ids, chunk_size=2,
+                                   max_nin=max_nin) == len(expected)
+
+
+def test_update_in(coll):
+    ids = ['e00', 'e01', 'e02', 'e01']
+    assert idsets.update_in(coll, 'eid', ids, {'$set': {'done': True}},
+                            chunk_size=2) == 3
+    assert coll.count_documents({'done': True}) == 3
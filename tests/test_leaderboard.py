@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from propjockey.leaderboard import Leaderboard, Snapshot, compare, publish
+
+ROWS = [('mp-2', 5, 0.5), ('mp-10', 3, 0.0), ('mp-1', 3, 12.25)]
+
+
+def test_snapshot_roundtrip(tmpdir):
+    path = str(tmpdir.join('leaderboard'))
+    assert publish(path, ROWS, seq=7) == 1
+    snapshot = Snapshot(path)
+    assert (snapshot.generation, snapshot.seq, len(snapshot)) == (1, 7, 3)
+    assert list(snapshot.records()) == ROWS
+    assert snapshot.e_id(1) == 'mp-10'
+    assert compare(snapshot, [(e_id, n) for e_id, n, _ in ROWS]) == []
+    assert compare(snapshot, [('mp-2', 5), ('mp-10', 4), ('mp-3', 1)]) == [
+        'mp-3 missing', 'mp-1 has no active votes',
+        'mp-10 has 3 votes, not 4']
+
+
+def test_leaderboard_swaps_generations(tmpdir):
+    path = str(tmpdir.join('leaderboard'))
+    leaderboard = Leaderboard(path, check_seconds=0)
+    assert leaderboard.current() is None
+    publish(path, ROWS)
+    first = leaderboard.current()
+    assert first.generation == 1 and leaderboard.current() is first
+    publish(path, ROWS[:1])
+    second = leaderboard.current()
+    assert second.generation == 2 and list(second.records()) == ROWS[:1]
+    # Readers of the old generation are unaffected.
+    assert list(first.records()) == ROWS
+    assert leaderboard.swaps == 2
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
+
+
+def test_truncated_snapshot(tmpdir):
+    path = str(tmpdir.join('leaderboard'))
+    publish(path, ROWS)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError):
+        Snapshot(path)
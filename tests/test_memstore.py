@@ -0,0 +1,137 @@
+import pytest
+from pymongo import DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from propjockey import memstore
+from propjockey.memstore import MemoryClient
+
+
+@pytest.fixture
+def coll():
+    client = MemoryClient()
+    client.drop_database('propjockey_memstore_test')
+    coll = client['propjockey_memstore_test'].votes
+    coll.insert_many([
+        {'_id': 1, 'eid': 'a', 'n': 2, 'who': ['x', 'y'], 'state': 'DONE'},
+        {'_id': 2, 'eid': 'b', 'n': 1, 'who': ['y'], 'sg': {'symbol': 'P1'}},
+        {'_id': 3, 'eid': 'c', 'n': 3, 'who': []},
+    ])
+    return coll
+
+
+def ids(cursor):
+    return [d['_id'] for d in cursor]
+
+
+def test_query_operators(coll):
+    assert ids(coll.find({'state': {'$ne': 'DONE'}})) == [2, 3]
+    assert ids(coll.find({'who': 'y'})) == [1, 2]
+    assert ids(coll.find({'eid': {'$nin': ['a', 'b']}})) == [3]
+    assert ids(coll.find({'sg.symbol': {'$exists': True}})) == [2]
+    assert ids(coll.find({'n': {'$gte': 2}, 'who': {'$size': 0}})) == [3]
+    assert ids(coll.find({'$or': [{'eid': 'a'}, {'n': 3}]})) == [1, 3]
+
+
+def test_cursor_projection_sort_skip_limit(coll):
+    cursor = coll.find({}, {'_id': 0, 'eid': 1, 'sg.symbol': 1},
+                       sort=[('n', DESCENDING)])
+    assert cursor.count() == 3
+    assert list(cursor.skip(1).limit(1)) == [{'eid': 'a'}]
+    assert coll.find_one({'eid': 'b'}, {'sg.symbol': 1, '_id': 0}) == {
+        'sg': {'symbol': 'P1'}}
+
+
+def test_updates_and_upserts(coll):
+    coll.update_one({'eid': 'a'}, {'$inc': {'n': -1}, '$pull': {'who': 'x'}})
+    assert coll.find_one({'eid': 'a'}, {'n': 1, 'who': 1, '_id': 0}) == {
+        'n': 1, 'who': ['y']}
+    coll.update_one({'eid': 'd', 'prop': 'p'},
+                    {'$inc': {'n': 1}, '$push': {'who': 'z'}}, upsert=True)
+    assert coll.find_one({'eid': 'd'}, {'_id': 0}) == {
+        'eid': 'd', 'prop': 'p', 'n': 1, 'who': ['z']}
+    result = coll.bulk_write([UpdateOne({'eid': 'b'}, {'$set': {'n': 5}}),
+                              UpdateOne({'eid': 'e'}, {'$set': {'n': 0}},
+                                        upsert=True)])
+    assert (result.modified_count, result.upserted_count) == (1, 1)
+    assert coll.find_one_and_delete({'eid': 'e'})['n'] == 0
+    assert coll.count() == 4
+
+
+def test_hash_index(coll):
+    coll.create_index('who', unique=False)
+    cursor = coll.find({'who': {'$in': ['x', 'q']}})
+    assert cursor.explain()['queryPlanner']['winningPlan']['stage'] == 'FETCH'
+    assert ids(cursor) == [1]
+    coll.update_one({'_id': 3}, {'$push': {'who': 'x'}})
+    assert ids(coll.find({'who': 'x'})) == [1, 3]
+    coll.create_index('eid', unique=True)
+    with pytest.raises(DuplicateKeyError):
+        coll.insert_one({'eid': 'a'})
+
+
+def test_drop_keeps_handle(coll):
+    coll.drop()
+    coll.insert_one({'_id': 4})
+    assert ids(coll.database.votes.find()) == [4]
+
+
+class Listener(object):
+    def __init__(self):
+        self.events = []
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.events.append(event)
+
+    def failed(self, event):
+        self.events.append(event)
+
+
+def test_command_events(coll):
+    listener = Listener()
+    memstore.register(listener)
+    try:
+        list(coll.find({'n': {'$gt': 1}}))
+        coll.update_one({'_id': 1}, {'$inc': {'n': 1}})
+    finally:
+        memstore.unregister(listener)
+    find, update = listener.events
+    assert find.command_name == 'find'
+    assert len(find.reply['cursor']['firstBatch']) == 2
+    assert update.command_name == 'update'
+    assert update.duration_micros >= 0
+
+
+def test_load_once(monkeypatch):
+    import threading
+    import time
+    from propjockey import snapshot
+    calls = []
+
+    def load(path, db):
+        calls.append(path)
+        if path == 'broken':
+            raise IOError(path)
+        time.sleep(0.05)
+        db.votes.insert_one({'eid': 'a'})
+    monkeypatch.setattr(snapshot, 'load_snapshot', load)
+    client = MemoryClient()
+    client.drop_database('propjockey_load_test')
+    counts = []
+
+    def load_and_count():
+        client.load_once('dump', 'propjockey_load_test')
+        counts.append(client.propjockey_load_test.votes.count_documents({}))
+    threads = [threading.Thread(target=load_and_count) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Others wait for the first load rather than see an empty database.
+    assert counts == [1, 1, 1] and calls == ['dump']
+    for _ in range(2):
+        with pytest.raises(IOError):
+            client.load_once('broken', 'propjockey_load_test')
+    assert calls == ['dump', 'broken', 'broken']
@@ -0,0 +1,27 @@
+import pytest
+
+from propjockey.metrics import Registry
+
+
+def test_render():
+    registry = Registry()
+    c = registry.counter('requests_total', 'Requests.', ['code'])
+    c.inc(code=200)
+    c.inc(2, code=200)
+    h = registry.histogram('latency_seconds', 'Latency.', buckets=[.1, 1])
+    h.observe(.05)
+    h.observe(.5)
+    h.observe(5)
+    registry.callback('items', 'Items.', 'gauge', lambda: [({'a': 'x'}, 4)])
+    lines = registry.render().splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{code="200"} 3' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum 5.55' in lines
+    assert 'latency_seconds_count 3' in lines
+    assert 'items{a="x"} 4' in lines
+    assert registry.counter('requests_total', 'Requests.', ['code']) is c
+    with pytest.raises(ValueError):
+        c.inc(status=200)
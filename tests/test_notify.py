@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-c', code], capture_output=True,
+                          text=True)
+
+
+def test_notify_does_not_import_the_web_app():
+    rv = run_python(
+        "import sys\n"
+        "from propjockey.notify import notify\n"
+        "from propjockey.settings import load_config\n"
+        "load_config()\n"
+        "print(sorted(m for m in sys.modules\n"
+        "             if m in ('flask', 'propjockey.propjockey')))\n")
+    assert rv.returncode == 0, rv.stderr
+    assert rv.stdout.strip() == '[]'
+
+
+def test_import_passwordless_first():
+    rv = run_python("import passwordless\n"
+                    "from propjockey import app\n"
+                    "print(app.name)\n")
+    assert rv.returncode == 0, rv.stderr
+    assert rv.stdout.strip() == 'propjockey.propjockey'
@@ -1,13 +1,18 @@
 import json
 from itertools import tee, groupby
 from operator import itemgetter
+import os
 import re
 from six.moves import zip
+import threading
+import time
 import uuid
 
 import pytest
 from propjockey import propjockey
+from propjockey.util import requester_alias
 from passwordless import Passwordless
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 def pairwise(iterable):
@@ -18,16 +23,30 @@ def pairwise(iterable):
 
 permitted_test_user = str(uuid.uuid4())+'@example.gov'
 
+# Set PROPJOCKEY_TEST_BACKEND=memory to run against the bundled test
+# archive loaded into the in-process backend rather than a mongod.
+TEST_BACKEND = os.environ.get('PROPJOCKEY_TEST_BACKEND', 'mongo')
+TEST_SNAPSHOT = os.path.join(os.path.dirname(__file__),
+                             'propjockey_test_example.gz')
+
 
 def set_test_config():
     propjockey.app.config['CLIENTS'] = {
         k: {'database': 'propjockey_test', 'collection': k}
         for k in ['votes', 'entries', 'workflows']
     }
+    if TEST_BACKEND == 'memory':
+        for cfg in propjockey.app.config['CLIENTS'].values():
+            cfg.update({'backend': 'memory', 'snapshot': TEST_SNAPSHOT})
+        propjockey.app.config['PASSWORDLESS']['tokenstore_client'] = {
+            'backend': 'memory',
+            'database': 'propjockey_test',
+            'collection': 'auth_tokens',
+        }
 
     def get_workflow_ids(eids, coll):
-        rv = sorted(coll.find({'eid': {'$in': eids}}), key=itemgetter('eid'))
-        return [d['wid'] for d in rv]
+        wids = {d['eid']: d['wid'] for d in coll.find({'eid': {'$in': eids}})}
+        return [wids.get(eid) for eid in eids]
     propjockey.app.config['WORKFLOWS']['get_workflow_ids'] = get_workflow_ids
 
     propjockey.app.config['VOTES'].update({'max_active_votes_per_user': 10})
@@ -54,6 +73,10 @@ def client(request, user_unknown):
     set_test_config()
     assert propjockey.app.config['PASSWORDLESS']['DELIVERY_METHOD'] == 'null'
     propjockey.passwordless = Passwordless(propjockey.app)
+    # Routes use the app's instance, which must use the test config too.
+    propjockey.passwdless.init_app(propjockey.app)
+    # Warm up now rather than from the first request, in the background.
+    propjockey.create_app(before_fork=False)
     client = propjockey.app.test_client()
     ctx = propjockey.app.test_request_context()
     ctx.push()
@@ -63,6 +86,7 @@ def client(request, user_unknown):
 
 @pytest.fixture
 def db():
+    set_test_config()
     with propjockey.app.app_context():
         return propjockey.get_collections()
 
@@ -294,6 +318,35 @@ def test_voting(client, db, user_with_top_active_entry, user_unknown,
     db.votes.delete_one(filt)
 
 
+def test_vote_after_entry_gained_property(client, db, monkeypatch,
+                                          eid_inactive_missing):
+    from propjockey.bus import COMPLETED, InvalidationBus
+    from propjockey.memstore import MemoryClient
+    coll = MemoryClient()['propjockey_test'].invalidations
+    coll.drop()
+    here = InvalidationBus(coll, poll_seconds=0)
+    here.subscribe(propjockey.apply_invalidation)
+    monkeypatch.setattr(propjockey, 'invalidation_bus', here)
+    econf = propjockey.econf
+    eid = eid_inactive_missing
+    assert propjockey.entry_cache.has_property(db.entries, eid) is False
+    # The existence check is served from the cache.
+    with propjockey.query_recorder.recording() as rec:
+        client.post('/vote', data=dict(how='down', eid=eid))
+    assert db.entries.name not in [c[1] for c in rec.commands]
+    field = next(iter(econf['has_property']))
+    db.entries.update_one({econf['e_id']: eid}, {'$set': {field: {}}})
+    try:
+        # As notify does, once it finds the entry has the property.
+        InvalidationBus(coll, host='notify').publish(COMPLETED, [eid])
+        rv = client.post('/vote', data=dict(how='up', eid=eid))
+        assert 'non-existent' in str(rv.data)
+        assert propjockey.entry_cache.has_property(db.entries, eid) is True
+    finally:
+        db.entries.update_one({econf['e_id']: eid}, {'$unset': {field: ''}})
+        propjockey.entry_cache.invalidate([eid])
+
+
 def test_form_ui_and_table_display(client, user_with_top_active_entry):
     user, eid = user_with_top_active_entry
     login(client, user)
@@ -424,9 +477,553 @@ def test_app_auth(client, user_unknown):
     assert rv.status_code == 200 and '/authenticate?' in str(rv.data)
 
 
+def test_required_indexes():
+    from propjockey.indexes import required_indexes
+    econf, vconf = propjockey.econf, propjockey.vconf
+    indexes = required_indexes(econf, vconf)
+    leaderboard = indexes['votes'][0]
+    # Sort key follows the equality-matched filter fields.
+    keys = [k for k, _ in leaderboard]
+    assert (vconf['nvotes'], -1) in leaderboard
+    assert all(keys.index(k) < keys.index(vconf['nvotes'])
+               for k, v in vconf['filter_active'].items()
+               if not isinstance(v, dict))
+    assert any(keys[0] == vconf['requesters']
+               for keys in ([k for k, _ in spec]
+                            for spec in indexes['votes']))
+    assert [(econf['e_id'], 1)] in indexes['entries']
+
+
+def test_ensure_indexes_and_query_plans(db, caplog):
+    from propjockey.indexes import (check_query_plans, ensure_indexes,
+                                    required_indexes)
+    from propjockey.util import Bunch
+    econf, vconf = propjockey.econf, propjockey.vconf
+    tdb = db.votes.database.client['propjockey_test_indexes']
+    tdb.client.drop_database('propjockey_test_indexes')
+    copy = Bunch(votes=tdb.votes, entries=tdb.entries)
+    for name in ['votes', 'entries']:
+        getattr(copy, name).insert_many(
+            list(getattr(db, name).find().limit(200)))
+    try:
+        # Without indexes, hot queries scan their collections.
+        collscans = check_query_plans(copy, econf, vconf)
+        assert {'vote lookup', 'active entries'} <= set(collscans)
+        assert 'COLLSCAN' in caplog.text
+        # An index of the same keys under another name is not recreated.
+        keys = required_indexes(econf, vconf)['entries'][0]
+        copy.entries.create_index(keys, name='by_entry_id')
+        first = ensure_indexes(copy, econf, vconf)
+        assert [created for name, k, created in first
+                if name == 'entries' and k == keys] == [False]
+        assert sum(created for _, _, created in first) == len(first) - 1
+        # A second run finds every index and creates none.
+        second = ensure_indexes(copy, econf, vconf)
+        assert [(name, k) for name, k, _ in second] == \
+            [(name, k) for name, k, _ in first]
+        assert not any(created for _, _, created in second)
+        collscans_after = check_query_plans(copy, econf, vconf)
+        assert 'vote lookup' not in collscans_after
+        assert 'active entries' not in collscans_after
+    finally:
+        tdb.client.drop_database('propjockey_test_indexes')
+
+
+def test_workflow_id_index(db):
+    from propjockey.workflows import WorkflowIdIndex
+
+    def iter_workflow_ids(coll, after_wid=None):
+        filt = {} if after_wid is None else {'wid': {'$gt': after_wid}}
+        for d in coll.find(filt, sort=[('wid', 1)]):
+            yield d['eid'], d['wid']
+
+    def get_workflow_ids(eids, coll):
+        idmap = {d['eid']: d['wid'] for d in coll.find({'eid': {'$in': eids}})}
+        return [idmap.get(eid) for eid in eids]
+
+    coll = db.votes.database['test_workflow_ids']
+    coll.drop()
+    index = WorkflowIdIndex(coll, {'iter_workflow_ids': iter_workflow_ids,
+                                   'get_workflow_ids': get_workflow_ids})
+    docs = list(db.workflows.find(sort=[('wid', 1)]))
+    eids = [d['eid'] for d in docs] + ['no-such-entry']
+    # Unsynced ids fall back to the live lookup.
+    assert index.lookup(eids[-3:-1], db.workflows) == [
+        d['wid'] for d in docs[-2:]]
+    assert index.sync(db.workflows) == len(docs)
+    assert index.watermark() == docs[-1]['wid']
+    assert index.sync(db.workflows) == 0
+    assert index.lookup(eids, db.workflows) == [d['wid'] for d in docs] + [None]
+    coll.drop()
+
+
+def test_snapshot_dump_and_load(db, tmpdir):
+    from propjockey.snapshot import dump_snapshot, load_snapshot
+    from propjockey.util import Bunch
+    path = str(tmpdir.join('snapshot.gz'))
+    dump_snapshot(db, path, batch_size=100)
+    tdb = db.votes.database.client['propjockey_test_snapshot']
+    copy = Bunch(**{n: tdb[n] for n in ['votes', 'entries', 'workflows']})
+    stats = load_snapshot(path, copy, batch_size=100)
+    try:
+        assert {s.name: s.ndocs for s in stats} == {
+            n: getattr(db, n).count_documents({})
+            for n in ['votes', 'entries', 'workflows']}
+        assert copy.votes.find_one() == db.votes.find_one()
+    finally:
+        tdb.client.drop_database('propjockey_test_snapshot')
+
+
 def test_auth_lockdown(client):
     logout(client)
     rv = client.get('/', follow_redirects=True)
     assert 'user@example.gov' in str(rv.data)
     rv = client.get('/rows', follow_redirects=True)
     assert 'user@example.gov' in str(rv.data)
+
+
+@pytest.mark.parametrize('path,max_commands', [
+    ('/rows', 3),
+    ('/rows?filter=*-O', 7),
+    ('/rows?useronly=true', 5),
+])
+def test_rows_query_budget(client, path, max_commands):
+    with propjockey.query_recorder.max_commands(max_commands):
+        assert client.get(path).status_code == 200
+
+
+def test_query_log(client, caplog, monkeypatch):
+    monkeypatch.setattr(propjockey.query_recorder, 'slow_ms', 0)
+    with caplog.at_level('INFO', logger='propjockey'):
+        client.get('/rows')
+    lines = [json.loads(r.getMessage()) for r in caplog.records
+             if r.name == 'propjockey.queries']
+    assert lines[-1]['endpoint'] == 'rows'
+    assert lines[-1]['ncommands'] > 0 and lines[-1]['ndocs'] > 0
+    assert any(r.name == 'propjockey.slow_queries' for r in caplog.records)
+
+
+def test_metrics(client, monkeypatch):
+    client.get('/rows?format=html')
+    client.post('/vote', data={'eid': 'mp-nonexistent', 'how': 'up'})
+    monkeypatch.setitem(propjockey.app.config, 'METRICS', {})
+    assert client.get('/metrics').status_code == 403
+    monkeypatch.setitem(propjockey.app.config, 'METRICS', {'token': 's3cr3t'})
+    assert client.get('/metrics', headers={
+        'Authorization': 'Bearer wrong'}).status_code == 403
+    rv = client.get('/metrics', headers={'Authorization': 'Bearer s3cr3t'})
+    assert rv.status_code == 200
+    text = rv.data.decode()
+    assert 'propjockey_rows_seconds_count{sections="active",format="html"}' \
+        in text
+    assert 'propjockey_vote_seconds_count{how="up",category="error"}' in text
+    assert 'propjockey_cache_hits_total{cache="entries"}' in text
+    assert 'propjockey_unnotified_votes ' in text
+
+
+def test_metrics_behind_proxy(client, monkeypatch):
+    monkeypatch.setattr(propjockey.app, 'wsgi_app',
+                        ProxyFix(propjockey.app.wsgi_app, x_for=1))
+    monkeypatch.setitem(propjockey.app.config, 'METRICS',
+                        {'allow_ips': ['127.0.0.1', '203.0.113.5']})
+    proxy = {'REMOTE_ADDR': '127.0.0.1'}
+    assert client.get('/metrics', environ_base=proxy, headers={
+        'X-Forwarded-For': '203.0.113.5'}).status_code == 200
+    # The proxy's own address no longer grants access to its clients.
+    assert client.get('/metrics', environ_base=proxy, headers={
+        'X-Forwarded-For': '198.51.100.7'}).status_code == 403
+    # Only the address the trusted proxy appended counts.
+    assert client.get('/metrics', environ_base=proxy, headers={
+        'X-Forwarded-For': '203.0.113.5, 198.51.100.7'}).status_code == 403
+
+
+def test_profile(client, monkeypatch, user_unknown):
+    rv = client.get('/rows?profile=1')
+    assert 'Content-Disposition' not in rv.headers
+    monkeypatch.setitem(propjockey.app.config, 'PROFILER',
+                        {'staff': [user_unknown]})
+    rv = client.get('/rows?format=html&profile=1')
+    assert rv.headers['Content-Disposition'].endswith('profile-rows.html')
+    assert b'database commands' in rv.data
+    rv = client.get('/rows?profile=1&profile_format=json')
+    report = json.loads(rv.data)
+    assert report['mongo']['ncommands'] == len(report['mongo']['commands'])
+    assert report['tree']['name'] == 'rows'
+    names = json.dumps(report['tree'])
+    assert 'rows (propjockey.py' in names
+    assert report['body_rendered']
+    # Queries overlapped in pool threads are traced there.
+    assert report['threads']
+    assert all(' in ' in t['name'] and t['calls'] == 1 and t['children']
+               for t in report['threads'])
+
+
+def test_profile_event_stream(client, monkeypatch, user_unknown):
+    from propjockey.events import EventHub
+    hub = EventHub(heartbeat_seconds=60, max_seconds=60)
+    monkeypatch.setattr(propjockey, 'event_hub', hub)
+    monkeypatch.setitem(propjockey.app.config, 'PROFILER',
+                        {'staff': [user_unknown]})
+    start = time.time()
+    rv = client.get('/events?profile=1&profile_format=json')
+    # The stream is not drained into the profile, and is closed.
+    assert time.time() - start < 10
+    assert rv.headers['Content-Disposition'].endswith('profile-events.json')
+    assert json.loads(rv.data)['body_rendered'] is False
+    assert hub.subscribers == 0
+
+
+def test_row_fragments(client):
+    propjockey.row_fragment_cache.clear()
+    path = '/rows?format=html&psize=20&filter=*-O'
+    first = client.get(path).data
+    hits = propjockey.row_fragment_cache.hits
+    assert len(propjockey.row_fragment_cache) == first.count(b'<tr class=')
+    assert client.get(path).data == first
+    assert propjockey.row_fragment_cache.hits > hits
+    # Each row's vote form redirects back to the page it is on.
+    assert b'value="/rows?format=html&amp;psize=20&amp;filter=*-O"' in first
+    assert propjockey.REDIRECT_PATH_MARKER.encode() not in first
+
+
+def test_prefetch_next_page(client, monkeypatch, user_with_top_active_entry):
+    from propjockey.prefetch import Prefetcher
+    user, eid = user_with_top_active_entry
+    login(client, user)
+    prefetcher = Prefetcher(propjockey.vote_version, workers=1)
+    monkeypatch.setattr(propjockey, 'prefetcher', prefetcher)
+    page0 = get_rows(client.get('/rows?psize=5'))
+    for _ in range(100):
+        if not prefetcher._pending:
+            break
+        time.sleep(0.05)
+    assert prefetcher.submitted == 1 and len(prefetcher.cache) == 1
+    page1 = get_rows(client.get('/rows?psize=5&pnum=1'))
+    assert prefetcher.served == 1
+    assert [r['id'] for r in page1] != [r['id'] for r in page0]
+    assert client.post('/vote', data={'eid': eid, 'how': 'down'}).json[1] \
+        == 'success'
+    assert len(prefetcher.cache) == 0
+    client.post('/vote', data={'eid': eid, 'how': 'up'})
+    prefetcher.shutdown()
+
+
+def test_parallel_rows(client, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    paths = ['/rows?filter=*-O&psize=50', '/rows?filter=Fe-*&pnum=3',
+             '/rows?useronly=true']
+    serial = [client.get(path).data for path in paths]
+    monkeypatch.setattr(propjockey, 'parallel_pool', ThreadPoolExecutor(4))
+    with propjockey.query_recorder.max_commands(7):
+        assert client.get(paths[0]).data == serial[0]
+    assert [client.get(path).data for path in paths] == serial
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("workflow server down")
+    monkeypatch.setattr(propjockey, 'get_workflow_ids', fail)
+    with pytest.raises(RuntimeError):
+        client.get(paths[0])
+
+
+def test_filter_cache_pages(client, monkeypatch):
+    from propjockey.filtercache import FilterCache
+
+    def pages(path, n):
+        rows = []
+        for pnum in range(n):
+            rows += get_rows(client.get('{}&pnum={}'.format(path, pnum)))
+        return rows
+    path = '/rows?filter=*-O&psize=7&ssort=decr'
+    monkeypatch.setattr(propjockey, 'filter_cache', None)
+    expected = pages(path, 6)
+    filter_cache = FilterCache(propjockey.econf)
+    monkeypatch.setattr(propjockey, 'filter_cache', filter_cache)
+    rows = pages(path.replace('*-O', ' *-O '), 6)
+    # Ties in extrasort are now broken by entry id.
+    assert sorted(r['id'] for r in rows) == sorted(r['id'] for r in expected)
+    assert [r['extrasort'] for r in rows] == \
+        [r['extrasort'] for r in expected]
+    assert [('p_link' in r, 'nvotes' in r) for r in rows] == \
+        [('p_link' in r, 'nvotes' in r) for r in expected]
+    assert filter_cache.cache.hits > filter_cache.cache.misses
+    with propjockey.query_recorder.max_commands(4):
+        client.get(path + '&pnum=3')
+
+
+def test_invalidation_bus(client, monkeypatch, user_with_top_active_entry):
+    from propjockey.bus import COMPLETED, VOTES, InvalidationBus
+    from propjockey.memstore import MemoryClient
+    coll = MemoryClient()['propjockey_test'].invalidations
+    coll.drop()
+    here = InvalidationBus(coll, poll_seconds=0)
+    here.subscribe(propjockey.apply_invalidation)
+    other = InvalidationBus(coll, host='elsewhere')
+    monkeypatch.setattr(propjockey, 'invalidation_bus', here)
+    user, eid = user_with_top_active_entry
+    login(client, user)
+    assert client.post('/vote', data={'eid': eid, 'how': 'down'}).json[1] \
+        == 'success'
+    client.post('/vote', data={'eid': eid, 'how': 'up'})
+    assert [e['e_ids'] for e in coll.find({'kind': VOTES})] == \
+        [[eid], [eid]]
+
+    db = propjockey.get_collections()
+    propjockey.entry_cache.get_many(db.entries, [eid])
+    assert propjockey.entry_cache.cache.get(eid) is not None
+    version = propjockey.vote_version.value
+    other.publish(COMPLETED, [eid])
+    client.get('/login')
+    assert here.received == 1
+    assert propjockey.entry_cache.cache.get(eid) is None
+    assert propjockey.vote_version.value == version + 1
+
+
+def test_warm_up_and_ready(client, monkeypatch):
+    from propjockey.cache import EntryCache
+    from propjockey.filtercache import FilterCache
+    monkeypatch.setitem(propjockey.app.config, 'WARMUP', {'enabled': True})
+    monkeypatch.setitem(propjockey._warmup, 'state', 'pending')
+    monkeypatch.setattr(propjockey, 'entry_cache', EntryCache(
+        propjockey.econf, propjockey.entry_projection()))
+    monkeypatch.setattr(propjockey, 'filter_cache',
+                        FilterCache(propjockey.econf))
+    connected = threading.Event()
+    warm_connect = propjockey._warm_connect
+    monkeypatch.setattr(propjockey, '_warm_connect',
+                        lambda: connected.wait(10) and warm_connect())
+    # Without create_app, the first request starts warm-up.
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.json['state'] == 'running'
+    assert not propjockey.start_warm_up()
+    connected.set()
+    assert propjockey.warm_up()
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert set(response.json['steps']) == {
+        'connect', 'projections', 'templates', 'leaderboard', 'filters'}
+    assert len(propjockey.entry_cache.cache) > 0
+
+    propjockey._warmup['state'] = 'pending'
+    assert propjockey.create_app(before_fork=True) is propjockey.app
+    assert propjockey._shared['bunch'] is None
+    # The first page needs neither the active entries nor the filter,
+    # nor, without the workflow id index, more than the votes.
+    monkeypatch.delitem(propjockey.wconf, 'index_collection', raising=False)
+    with propjockey.query_recorder.max_commands(2):
+        client.get('/rows?filter=')
+    propjockey.warm_worker()
+    assert propjockey._shared['pid'] == os.getpid()
+
+
+def test_warm_up_filters(client, monkeypatch):
+    from propjockey.filtercache import FilterCache
+    transform = propjockey.econf['filter']['transform']
+    parsed = []
+
+    def parse(filter_string):
+        parsed.append(filter_string)
+        if filter_string == 'bad':
+            raise ValueError("cannot parse {}".format(filter_string))
+        return transform(filter_string)
+    econf = dict(propjockey.econf,
+                 filter=dict(propjockey.econf['filter'], transform=parse))
+    monkeypatch.setattr(propjockey, 'filter_cache', FilterCache(econf))
+    monkeypatch.setitem(propjockey.app.config, 'WARMUP', {
+        'enabled': True, 'filters': ['', ' ', 'Fe-O', 'bad']})
+    monkeypatch.setitem(propjockey._warmup, 'state', 'pending')
+    monkeypatch.setitem(propjockey._warmup, 'warnings', {})
+    # Empty filters are skipped, and a bad one does not hold readiness.
+    assert propjockey.warm_up()
+    assert parsed == ['Fe-O', 'bad']
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert 'filters' not in response.json['steps']
+    assert response.json['warnings'] == {'filters': 'cannot parse bad'}
+
+
+def test_access_log(client, monkeypatch, tmpdir, user_with_top_active_entry):
+    from propjockey import accesslog
+    path = str(tmpdir.join('access.jsonl'))
+    user, eid = user_with_top_active_entry
+    login(client, user)
+    recorder = accesslog.AccessRecorder(path, 'key')
+    monkeypatch.setattr(propjockey, 'access_recorder', recorder)
+    client.get('/rows?filter=%20*-O%20&psort=decr&pnum=2&which=active')
+    client.post('/vote', data={'eid': eid, 'how': 'down',
+                               'redirect_path': '/rows'})
+    client.post('/vote', data={'eid': eid, 'how': 'up'})
+    client.get('/login')
+    recorder.close()
+    recs = list(accesslog.read(path))
+    assert [r['ep'] for r in recs] == ['rows', 'vote', 'vote']
+    assert recs[0]['p'] == {'filter': '*-O', 'pnum': '2',
+                            'which': ['active']}
+    assert recs[1]['p'] == {'eid': eid, 'how': 'down'}
+    assert {r['u'] for r in recs} == {requester_alias(user, 'key')}
+    assert all(r['ops'] > 0 and r['ms'] > 0 for r in recs)
+
+
+def test_admission_and_time_limits(client, monkeypatch):
+    from pymongo.errors import ExecutionTimeout
+    from propjockey.admission import Limiter
+    limiter = Limiter(max_concurrent=1)
+    monkeypatch.setitem(propjockey.limiters, 'rows', limiter)
+    assert limiter.acquire()
+    rv = client.get('/rows')
+    assert rv.status_code == 503 and rv.headers['Retry-After']
+    limiter.release()
+    assert client.get('/rows').status_code == 200
+    assert limiter.active == 0
+
+    path = '/rows?filter=Fe-O&psize=50'
+    expected = get_rows(client.get(path))
+    nactive = len([r for r in expected if 'nvotes' in r])
+    assert 0 < nactive < len(expected)
+
+    def timeout(*args, **kwargs):
+        raise ExecutionTimeout("operation exceeded time limit", 50)
+    monkeypatch.setattr(propjockey, 'inactive_page', timeout)
+    rv = client.get(path)
+    assert rv.json['partial'] is True
+    assert get_rows(rv) == expected[:nactive]
+    assert b'took too long' in client.get(path + '&format=html').data
+    monkeypatch.setattr(propjockey, 'find_votes', timeout)
+    assert client.get(path).status_code == 503
+
+
+def test_large_id_sets(client, monkeypatch, user_with_completed):
+    login(client, user_with_completed)
+    monkeypatch.setattr(propjockey, 'filter_cache', None)
+    paths = ['/rows?filter=*-O&psize=7&ssort=decr&pnum={}'.format(pnum)
+             for pnum in range(3)] + ['/rows?useronly=true&psize=500']
+    expected = [get_rows(client.get(path)) for path in paths]
+    # Active ids are sent in chunks, and excluded client-side.
+    monkeypatch.setitem(propjockey.app.config, 'ID_SETS',
+                        {'chunk_size': 500, 'max_nin': 1000})
+    for path, rows in zip(paths, expected):
+        found = get_rows(client.get(path))
+        assert sorted(r['id'] for r in found) == sorted(r['id'] for r in rows)
+        assert [r.get('extrasort') for r in found] == \
+            [r.get('extrasort') for r in rows]
+
+
+def test_vote_events(client, db, monkeypatch, user_with_top_active_entry):
+    from propjockey.events import EventHub
+    user, eid = user_with_top_active_entry
+    login(client, user)
+    assert client.get('/events').status_code == 404
+    hub = EventHub(max_subscribers=1, heartbeat_seconds=0.01,
+                   max_seconds=5)
+    monkeypatch.setattr(propjockey, 'event_hub', hub)
+    assert b'EventSource' in client.get('/rows?format=html').data
+    rv = client.get('/events', buffered=False)
+    assert rv.mimetype == 'text/event-stream'
+    assert client.get('/events').status_code == 503
+    stream = iter(rv.response)
+    assert next(stream) == b'retry: 3000\n\n'
+    client.post('/vote', data={'eid': eid, 'how': 'down'})
+    vconf = propjockey.vconf
+    nvotes = db.votes.find_one({vconf['entry_id']: eid})[vconf['nvotes']]
+    message = next(m for m in stream if not m.startswith(b':'))
+    assert b'event: votes' in message
+    assert json.loads(message.split(b'data: ')[1]) == [
+        [eid, nvotes, 'active']]
+    client.post('/vote', data={'eid': eid, 'how': 'up'})
+    rv.close()
+    assert hub.subscribers == 0
+
+
+def test_rate_limits(client, monkeypatch, user_with_top_active_entry):
+    from propjockey.ratelimit import MemoryBuckets, RateLimiter
+    user, eid = user_with_top_active_entry
+    login(client, user)
+    limiter = RateLimiter(MemoryBuckets(), {
+        'login': {'ip': {'per_minute': 1, 'burst': 1}},
+        'vote': {'user': {'per_minute': 1, 'burst': 1}}})
+    monkeypatch.setattr(propjockey, 'rate_limiter', limiter)
+    requested = []
+    monkeypatch.setattr(propjockey.passwdless, 'request_token',
+                        lambda user: requested.append(user) or ('', 'info'))
+    # Bots filling in the honeypot do not use up the bucket.
+    client.post('/login', data={'user': 'a@example.gov', 'honey': 'x'})
+    for user in ['a@example.gov', 'b@example.gov']:
+        client.post('/login', data={'user': user, 'honey': ''})
+    assert requested == ['a@example.gov']
+    assert limiter.limited == {('login', 'ip'): 1}
+
+    assert client.post('/vote', data={'eid': eid, 'how': 'down'}).json[1] \
+        == 'success'
+    rv = client.post('/vote', data={'eid': eid, 'how': 'up'})
+    assert rv.status_code == 429 and int(rv.headers['Retry-After']) > 0
+    assert rv.json[1] == 'error'
+
+
+def test_rate_limits_behind_proxy(client, monkeypatch):
+    from propjockey.ratelimit import MemoryBuckets, RateLimiter
+    monkeypatch.setattr(propjockey.app, 'wsgi_app',
+                        ProxyFix(propjockey.app.wsgi_app, x_for=1))
+    limiter = RateLimiter(MemoryBuckets(), {
+        'login': {'ip': {'per_minute': 1, 'burst': 1}}})
+    monkeypatch.setattr(propjockey, 'rate_limiter', limiter)
+    requested = []
+    monkeypatch.setattr(propjockey.passwdless, 'request_token',
+                        lambda user: requested.append(user) or ('', 'info'))
+    # Clients of one proxy each have a bucket of their own.
+    for user, ip in [('a@example.gov', '203.0.113.5'),
+                     ('b@example.gov', '198.51.100.7'),
+                     ('c@example.gov', '203.0.113.5')]:
+        client.post('/login', data={'user': user, 'honey': ''},
+                    environ_base={'REMOTE_ADDR': '127.0.0.1'},
+                    headers={'X-Forwarded-For': ip})
+    assert requested == ['a@example.gov', 'b@example.gov']
+    assert limiter.limited == {('login', 'ip'): 1}
+
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_leaderboard_snapshot(client, monkeypatch, tmpdir, vectorized,
+                              user_with_top_active_entry):
+    from propjockey import ranking
+    from propjockey.leaderboard import Leaderboard, build_rows, publish
+    if vectorized and not ranking.available:
+        pytest.skip("NumPy is not installed")
+    monkeypatch.setattr(propjockey, 'ranking_available', vectorized)
+    user, eid = user_with_top_active_entry
+    login(client, user)
+    paths = ['/rows?psize=7&pnum={}'.format(i) for i in range(3)] + [
+        '/rows?psort=incr&ssort=decr&psize=7', '/rows?filter=*-O&psize=20',
+        '/rows?filter=Fe-O', '/rows?filter=Li-*-O&psort=incr']
+    live = [get_rows(client.get(path)) for path in paths]
+
+    path = str(tmpdir.join('leaderboard'))
+    db = propjockey.get_collections()
+    # As publish-leaderboard does, so that the snapshot is recent enough.
+    bus = propjockey.invalidation_bus
+    publish(path, build_rows(db.votes, db.entries, propjockey.econf,
+                             propjockey.vconf),
+            bus.latest_seq() if bus is not None else -1)
+    leaderboard = Leaderboard(path, check_seconds=0)
+    monkeypatch.setattr(propjockey, 'leaderboard', leaderboard)
+    monkeypatch.setitem(propjockey.app.config, 'LEADERBOARD', {'path': path})
+    monkeypatch.setitem(propjockey._local_votes, 'time', 0)
+    assert propjockey.leaderboard_problems(leaderboard.current()) == []
+    assert (propjockey.active_ranking() is not None) == vectorized
+    for path, expected in zip(paths, live):
+        with propjockey.query_recorder.recording() as rec:
+            rows = get_rows(client.get(path))
+        # Only the user's own votes are fetched.
+        assert sum(c[3] for c in rec.commands if c[1] == db.votes.name) \
+            < len(leaderboard.current()) / 10
+        assert [(r['nvotes'], r['extrasort'], r['votedfor']) for r in rows
+                if 'nvotes' in r] == \
+            [(r['nvotes'], r['extrasort'], r['votedfor']) for r in expected
+             if 'nvotes' in r]
+        assert sorted(r['id'] for r in rows) == \
+            sorted(r['id'] for r in expected)
+
+    # After a vote here, rows come from votes until a newer snapshot.
+    assert client.post('/vote', data={'eid': eid, 'how': 'down'}).json[1] \
+        == 'success'
+    assert propjockey.leaderboard_votedocs() is None
+    assert propjockey.leaderboard_problems(leaderboard.current()) != []
+    client.post('/vote', data={'eid': eid, 'how': 'up'})
@@ -0,0 +1,50 @@
+from operator import itemgetter
+import random
+
+import pytest
+
+from propjockey import ranking
+from propjockey.ranking import ActiveRanking
+
+pytestmark = pytest.mark.skipif(not ranking.available,
+                                reason="NumPy is not installed")
+
+
+@pytest.mark.parametrize('primary_desc', [True, False])
+@pytest.mark.parametrize('secondary_desc', [True, False])
+def test_page_matches_stable_sorts(primary_desc, secondary_desc):
+    rng = random.Random(1)
+    systems = ['Fe-O', 'Li-O', 'O-Si', 'Fe', 'X-Y']
+    records = sorted(
+        [('mp-{}'.format(i), rng.randint(1, 5), rng.choice([0.0, 0.5, 1.0]))
+         for i in range(300)], key=lambda r: (-r[1], r[0]))
+    chemsys = {r[0]: rng.choice(systems) for r in records}
+    active = ActiveRanking.from_records(records, chemsys)
+    user_filter = {'chemsys': {'$in': ['Fe-O', 'Li-O', 'X-Y']}}
+    selected = active.select(user_filter)
+
+    docs = [r for r in records if chemsys[r[0]] in ('Fe-O', 'Li-O', 'X-Y')]
+    if not primary_desc:
+        docs.reverse()
+    docs.sort(key=itemgetter(2), reverse=secondary_desc)
+    docs.sort(key=itemgetter(1), reverse=primary_desc)
+    for skip, limit in [(0, 11), (37, 11), (len(docs) - 3, 11)]:
+        count, indexes = active.page(primary_desc, secondary_desc, skip,
+                                     limit, selected)
+        assert count == len(docs)
+        assert [active.e_ids[i] for i in indexes] == \
+            [r[0] for r in docs[skip:skip + limit]]
+
+
+def test_select():
+    active = ActiveRanking.from_records(
+        [('a', 2, 0.0), ('b', 1, 0.0)], {'a': 'Fe-O'})
+    assert list(active.select(None)) == [True, True]
+    assert list(active.select({'chemsys': 'Fe-O'})) == [True, False]
+    # Systems are compared as strings, as MongoDB compares them.
+    assert list(active.select({'chemsys': 'O-Fe'})) == [False, False]
+    assert list(active.select({'chemsys': {'$in': ['O-Fe', None]}})) == \
+        [False, True]
+    assert active.select({'chemsys': {'$in': [{'$regex': 'Fe'}]}}) is None
+    assert active.select({'chemsys': 'Fe-O', 'nelements': 2}) is None
+    assert active.select({'chemsys': {'$regex': 'Fe'}}) is None
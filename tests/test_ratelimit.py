@@ -0,0 +1,66 @@
+import pytest
+
+from propjockey.memstore import MemoryClient
+from propjockey.ratelimit import MemoryBuckets, MongoBuckets, RateLimiter
+
+LIMIT = {'per_minute': 60, 'burst': 3}
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def buckets(request):
+    if request.param == 'memory':
+        return MemoryBuckets()
+    client = MemoryClient()
+    client.drop_database('propjockey_ratelimit_test')
+    return MongoBuckets(client['propjockey_ratelimit_test'].rate_limits)
+
+
+def test_bucket_bursts_then_refills(buckets):
+    assert [buckets.take('k', LIMIT, now=100) for _ in range(3)] == [0] * 3
+    assert buckets.take('k', LIMIT, now=100) == pytest.approx(1)
+    assert buckets.take('k', LIMIT, now=100.5) == pytest.approx(0.5)
+    assert buckets.take('k', LIMIT, now=101) == 0
+    assert buckets.take('k', LIMIT, now=101) > 0
+    assert buckets.take('other', LIMIT, now=101) == 0
+    # A full bucket holds no more than `burst`.
+    assert [buckets.take('k', LIMIT, now=200) for _ in range(4)][-1] > 0
+
+
+def test_limiter_scopes(buckets):
+    limiter = RateLimiter(buckets, {
+        'login': {'user': {'per_minute': 60, 'burst': 1},
+                  'global': {'per_minute': 60, 'burst': 2}}})
+    assert limiter.check('login', user='a', ip='1.2.3.4', now=0) == 0
+    assert limiter.check('login', user='a', ip='1.2.3.4', now=0) > 0
+    # A user's empty bucket leaves the global one alone.
+    assert limiter.check('login', user='b', ip='1.2.3.4', now=0) == 0
+    assert limiter.check('login', user='c', ip='1.2.3.4', now=0) > 0
+    assert limiter.check('vote', user='a', now=0) == 0
+    assert limiter.limited == {('login', 'user'): 1, ('login', 'global'): 1}
+
+
+def test_limiter_refunds_when_later_scope_is_empty(buckets):
+    limiter = RateLimiter(buckets, {
+        'login': {'user': {'per_minute': 60, 'burst': 2},
+                  'ip': {'per_minute': 60, 'burst': 2},
+                  'global': {'per_minute': 60, 'burst': 1}}})
+    assert limiter.check('login', user='a', ip='1.2.3.4', now=0) == 0
+    # Turned away by the global limit, b takes nothing from its own
+    # bucket or the address's.
+    for _ in range(3):
+        assert limiter.check('login', user='b', ip='5.6.7.8', now=0) > 0
+    assert buckets.take('login:user:b', {'per_minute': 60, 'burst': 2},
+                        now=0) == 0
+    assert buckets.take('login:ip:5.6.7.8', {'per_minute': 60, 'burst': 2},
+                        now=0) == 0
+    assert limiter.check('login', user='b', ip='5.6.7.8', now=1) == 0
+
+
+def test_mongo_buckets_are_shared():
+    coll = MemoryClient()['propjockey_ratelimit_test'].shared_limits
+    coll.drop()
+    a, b = MongoBuckets(coll), MongoBuckets(coll)
+    assert a.take('k', LIMIT, now=0) == b.take('k', LIMIT, now=0) == 0
+    assert a.take('k', LIMIT, now=0) == 0
+    assert b.take('k', LIMIT, now=0) > 0
+    assert coll.find_one({'_id': 'k'})['expires'] is not None
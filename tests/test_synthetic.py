@@ -0,0 +1,24 @@
+import propjockey  # noqa: F401
+from propjockey import propjockey as pj
+from propjockey.memstore import MemoryClient
+from propjockey.synthetic import generate
+
+
+def test_generate():
+    db = MemoryClient()['propjockey_synthetic_test']
+    econf, vconf = pj.econf, pj.vconf
+    entries, votes, workflows = generate(
+        db, econf, vconf, n_entries=2000, n_voted=200, n_users=50)
+    assert entries.ndocs == db.entries.count() == 2000
+    assert votes.ndocs == db.votes.count() == 200
+    ncompleted = db.votes.count(vconf['filter_completed'])
+    assert 60 < ncompleted < 140
+    assert db.entries.count(econf['has_property']) == ncompleted
+    nvotes = [d[vconf['nvotes']] for d in db.votes.find()]
+    assert min(nvotes) == 1 and max(nvotes) > 2
+    assert all(len(d[vconf['requesters']]) == d[vconf['nvotes']]
+               for d in db.votes.find())
+    active = set(db.votes.distinct(
+        vconf['entry_id'], vconf['filter_active']))
+    assert workflows.ndocs and set(db.workflows.distinct('eid')) <= active
+    assert len(db.entries.distinct('chemsys')) > 500
@@ -0,0 +1,40 @@
+import time
+import uuid
+
+import pytest
+import propjockey  # noqa: F401 (imported before passwordless, which uses it)
+from passwordless.token_store import MemoryTokenStore
+
+
+@pytest.fixture
+def store():
+    MemoryTokenStore.STORE.clear()
+    return MemoryTokenStore({'MEMORY_STORE_MAX_TOKENS': 3})
+
+
+def test_memory_pop_token_is_single_use(store):
+    token, user = uuid.uuid4().hex, 'user@example.gov'
+    store.store_or_update(token, user)
+    assert not store.pop_token('wrong', user)
+    assert store.pop_token(token, user)
+    assert not store.pop_token(token, user)
+
+
+def test_memory_token_expires(store):
+    token, user = uuid.uuid4().hex, 'user@example.gov'
+    store.store_or_update(token, user, ttl=0.05)
+    assert store.get_by_userid(user) == token
+    time.sleep(0.1)
+    assert store.get_by_userid(user) is None
+    assert not store.pop_token(token, user)
+
+
+def test_memory_store_evicts_least_recent(store):
+    users = ['u{}@example.gov'.format(i) for i in range(4)]
+    for u in users[:3]:
+        store.store_or_update(uuid.uuid4().hex, u)
+    # Refreshing a token makes it most recent.
+    store.store_or_update(uuid.uuid4().hex, users[0])
+    store.store_or_update(uuid.uuid4().hex, users[3])
+    assert store.get_by_userid(users[1]) is None
+    assert all(store.get_by_userid(u) for u in [users[0]] + users[2:])
@@ -0,0 +1,62 @@
+import pytest
+
+from propjockey import util
+from propjockey.memstore import MemoryClient
+from propjockey.util import (ProcessCollection, anonymize_requesters,
+                             config_to_uri, requester_alias)
+
+
+def test_requester_alias_is_stable_and_keyed():
+    user = 'user@example.gov'
+    alias = requester_alias(user, 'key')
+    assert alias == requester_alias(user, 'key')
+    assert alias.endswith('@aliased.gov') and user not in alias
+    assert alias != requester_alias(user, 'other key')
+    assert alias != requester_alias('other@example.gov', 'key')
+
+
+def test_config_to_uri():
+    cfg = {'database': 'db', 'username': 'u', 'password': 'p'}
+    assert config_to_uri(cfg) == 'mongodb://u:p@localhost:27017/db'
+
+
+def test_anonymize_requesters_resumes():
+    client = MemoryClient()
+    client.drop_database('propjockey_util_test')
+    votes = client.propjockey_util_test.votes
+    votes.insert_many([{'_id': i, 'who': ['u{}@example.gov'.format(i)]}
+                       for i in range(10)])
+    saved = []
+
+    def interrupt(last_id):
+        saved.append(last_id)
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        anonymize_requesters(votes, 'who', 'key', batch_size=4,
+                             progress=interrupt)
+    # The first batch was written before its progress was saved.
+    assert saved == [3]
+    assert votes.count_documents({'who': {'$regex': '@aliased.gov$'}}) == 4
+    assert anonymize_requesters(votes, 'who', 'key', batch_size=4,
+                                start_after=saved[-1],
+                                progress=saved.append) == (6, 9)
+    assert saved == [3, 7, 9]
+    assert all(requester_alias('u{}@example.gov'.format(d['_id']), 'key') ==
+               d['who'][0] for d in votes.find())
+
+
+def test_process_collection_reconnects_after_fork(monkeypatch):
+    coll = ProcessCollection({'backend': 'memory',
+                              'database': 'propjockey_util_test',
+                              'collection': 'tokens'})
+    assert coll._client is None
+    coll.drop()
+    coll.insert_one({'_id': 1})
+    assert coll.name == 'tokens' and coll.count_documents({}) == 1
+    parent = coll._client
+    assert coll.get() is coll.get()
+    monkeypatch.setattr(util.os, 'getpid', lambda: -1)
+    coll.get()
+    assert coll._client is not parent
+    ProcessCollection.close_all()
+    assert coll._client is None